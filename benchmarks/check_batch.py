@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking that batch exports parsing events with --workers produce
+the same files as a single export, against a local JCALAPI stand-in.
+"""
+
+import argparse
+import csv
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+
+from generate_calendar import DEFAULT_START, CalendarProfile, write_calendar
+from jcalapi_stub import JcalapiStub
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_EVENTS = 20000
+DEFAULT_USERS = 3
+DEFAULT_TIMEOUT = 300
+
+
+def run_export(stub, days, options, timeout):
+    """
+    Runs an export over the whole calendar in a new process.
+
+    Returns:
+        str: The standard error of the export.
+
+    Raises:
+        RuntimeError: If the export fails or doesn't finish in time.
+    """
+    command = [
+        sys.executable,
+        SCRIPT,
+        "--api-url",
+        stub.url,
+        "--start",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--end",
+        (DEFAULT_START + timedelta(days=days + 31)).strftime("%Y-%m-%d"),
+        *options,
+    ]
+    try:
+        process = subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"{' '.join(options)} didn't finish in {timeout}s") from e
+    if process.returncode:
+        logging.error(process.stderr)
+        raise RuntimeError(f"{' '.join(options)} failed")
+    return process.stderr
+
+
+def check_batch(stub, workdir, reference, batch_workers, args):
+    """
+    Runs a batch of args.users exports with --workers and compares each
+    file to the reference export.
+
+    Returns:
+        list: A message for each failure.
+    """
+    manifest = os.path.join(workdir, f"batch-{batch_workers}.csv")
+    outputs = {
+        f"USER{index}": os.path.join(workdir, f"batch-{batch_workers}-{index}.csv")
+        for index in range(args.users)
+    }
+    with open(manifest, "w", newline="", encoding="utf-8") as manifest_file:
+        writer = csv.writer(manifest_file)
+        writer.writerow(["sfdc_user_id", "output"])
+        writer.writerows(outputs.items())
+    options = [
+        "--batch",
+        manifest,
+        "--batch-workers",
+        str(batch_workers),
+        "--workers",
+        str(args.workers),
+    ]
+    failures = []
+    try:
+        stderr = run_export(stub, args.days, options, args.timeout)
+    except RuntimeError as e:
+        return [str(e)]
+    if "Batch finished" not in stderr:
+        failures.append(
+            f"--batch-workers {batch_workers}: the batch summary is missing"
+        )
+    for sfdc_user_id, output in outputs.items():
+        with open(reference, encoding="utf-8") as reference_file:
+            expected = reference_file.read().replace("REFERENCE", sfdc_user_id)
+        with open(output, encoding="utf-8") as output_file:
+            if output_file.read() != expected:
+                failures.append(
+                    f"--batch-workers {batch_workers}: {output} differs from "
+                    "the single export"
+                )
+    return failures
+
+
+def main():
+    """
+    Checks batch exports with worker processes.
+
+    Usage: check_batch.py [--events EVENTS] [--days DAYS] [--users USERS]
+                          [--workers WORKERS] [--timeout SECONDS]
+
+    Runs a batch with a single export thread, which deadlocks if its shards
+    are sent to the export threads instead of the worker processes, and a
+    batch with several export threads. Exits with code 1 if a batch fails,
+    hangs, loses its logs, or writes files differing from a single export.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check batch exports parsing events with --workers.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Seconds after which an export is considered hung",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix="sfdc-batch-") as workdir:
+        calendar = os.path.join(workdir, "calendar.json")
+        write_calendar(calendar, args.events, CalendarProfile(days=args.days))
+        with JcalapiStub(calendar) as stub:
+            reference = os.path.join(workdir, "reference.csv")
+            run_export(
+                stub,
+                args.days,
+                ["--sfdc-user-id", "REFERENCE", "--output", reference],
+                args.timeout,
+            )
+            for batch_workers in (1, args.users):
+                failures.extend(
+                    check_batch(stub, workdir, reference, batch_workers, args)
+                )
+    for failure in failures:
+        logging.error(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+    logging.info("Batch exports with --workers match the single export")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking the upload of Tasks with --bulk-upload against a local
+stand-in of the Salesforce Bulk API 2.0.
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from generate_calendar import DEFAULT_START, CalendarProfile, write_calendar
+from jcalapi_stub import JcalapiStub
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_EVENTS = 3000
+DEFAULT_BATCH_ROWS = 100
+ACCESS_TOKEN = "MOCK-TOKEN"
+INGEST_PATH = "/services/data/v59.0/jobs/ingest"
+FIELDS = [
+    "OwnerId",
+    "ActivityDate",
+    "WhatId",
+    "Status",
+    "Subject",
+    "Time_Spent_hrs__c",
+    "Description",
+]
+INVALID_ID_ERROR = "INVALID_CROSS_REFERENCE_KEY:invalid cross reference id:--"
+FAILED_JOB_ERROR = "InvalidBatch : mock failure"
+UPLOAD_ERROR = "Failed to upload Tasks to Salesforce"
+
+
+class MockSalesforce:
+    """Class representing a local stand-in for the Salesforce Bulk API 2.0"""
+
+    def __init__(self, fail_jobs=(), fail_uploads=(), host="127.0.0.1", port=0):
+        """
+        Initializes the mock without starting it.
+
+        Tasks whose WhatId lists several IDs are rejected like Salesforce
+        does, and returned by failedResults.
+
+        Args:
+            fail_jobs (tuple): The numbers (from 1, in order of creation) of
+                the jobs ending in the Failed state.
+            fail_uploads (tuple): The numbers of the jobs whose data upload
+                is answered with HTTP 500.
+            host (str): The listening address.
+            port (int): The listening port, 0 to pick a free one.
+        """
+        self.fail_jobs = set(fail_jobs)
+        self.fail_uploads = set(fail_uploads)
+        self.jobs = {}
+        self.created = []
+        self.errors = []
+        self.polls = 0
+        self.lock = threading.Lock()
+        self.numbers = itertools.count(1)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        """The base URL to pass as --sfdc-instance-url."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, status, body=None, content_type="application/json"):
+                data = b""
+                if body is not None:
+                    data = (
+                        body.encode()
+                        if isinstance(body, str)
+                        else json.dumps(body).encode()
+                    )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def fail(self, error):
+                with mock.lock:
+                    mock.errors.append(f"{self.command} {self.path}: {error}")
+                self.reply(400, [{"errorCode": "INVALID_REQUEST", "message": error}])
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def job(self, parts):
+                job = mock.jobs.get(parts[0]) if parts else None
+                if job is None:
+                    self.reply(404, [{"errorCode": "NOT_FOUND"}])
+                return job
+
+            def route(self):
+                path = urlparse(self.path).path.rstrip("/")
+                if not path.startswith(INGEST_PATH):
+                    self.reply(404, [{"errorCode": "NOT_FOUND"}])
+                    return None
+                if self.headers.get("Authorization") != f"Bearer {ACCESS_TOKEN}":
+                    self.reply(401, [{"errorCode": "INVALID_SESSION_ID"}])
+                    return None
+                return [part for part in path[len(INGEST_PATH) :].split("/") if part]
+
+            def do_POST(self):
+                parts = self.route()
+                if parts is None:
+                    return
+                spec = json.loads(self.body() or b"{}")
+                expected = {
+                    "object": "Task",
+                    "operation": "insert",
+                    "contentType": "CSV",
+                    "lineEnding": "LF",
+                }
+                if parts or spec != expected:
+                    self.fail(f"unexpected job {spec}")
+                    return
+                with mock.lock:
+                    number = next(mock.numbers)
+                    job_id = f"750{number:015d}"
+                    mock.jobs[job_id] = {
+                        "id": job_id,
+                        "number": number,
+                        "state": "Open",
+                        "rows": None,
+                    }
+                self.reply(200, {"id": job_id, "state": "Open"})
+
+            def do_PUT(self):
+                parts = self.route()
+                if parts is None:
+                    return
+                job = self.job(parts)
+                if job is None:
+                    return
+                data = self.body().decode("utf-8")
+                if parts[1:] != ["batches"] or job["state"] != "Open":
+                    self.fail(f"upload to a {job['state']} job")
+                    return
+                if self.headers.get("Content-Type") != "text/csv":
+                    self.fail("the data is not sent as text/csv")
+                    return
+                if job["number"] in mock.fail_uploads:
+                    self.reply(500, [{"errorCode": "SERVER_ERROR"}])
+                    return
+                reader = csv.reader(io.StringIO(data))
+                if next(reader, None) != FIELDS:
+                    self.fail("unexpected CSV header")
+                    return
+                job["rows"] = list(reader)
+                self.reply(201)
+
+            def do_PATCH(self):
+                parts = self.route()
+                if parts is None:
+                    return
+                job = self.job(parts)
+                if job is None:
+                    return
+                if json.loads(self.body() or b"{}") != {"state": "UploadComplete"}:
+                    self.fail("unexpected job update")
+                    return
+                if job["rows"] is None:
+                    self.fail("upload completed without data")
+                    return
+                job["state"] = "UploadComplete"
+                self.reply(200, {"id": job["id"], "state": job["state"]})
+
+            def do_GET(self):
+                parts = self.route()
+                if parts is None:
+                    return
+                job = self.job(parts)
+                if job is None:
+                    return
+                if parts[1:] == ["failedResults"]:
+                    self.failed_results(job)
+                    return
+                with mock.lock:
+                    mock.polls += 1
+                    if job["state"] == "UploadComplete":
+                        self.complete(job)
+                self.reply(
+                    200, {key: value for key, value in job.items() if key != "rows"}
+                )
+
+            def complete(self, job):
+                rows = job["rows"]
+                if job["number"] in mock.fail_jobs:
+                    job.update(state="Failed", errorMessage=FAILED_JOB_ERROR)
+                    return
+                failed = [row for row in rows if ";" in row[FIELDS.index("WhatId")]]
+                mock.created.extend(row for row in rows if row not in failed)
+                job.update(
+                    state="JobComplete",
+                    numberRecordsProcessed=len(rows),
+                    numberRecordsFailed=len(failed),
+                )
+
+            def failed_results(self, job):
+                if job["state"] != "JobComplete":
+                    self.fail(f"failedResults of a {job['state']} job")
+                    return
+                output = io.StringIO()
+                writer = csv.writer(output, lineterminator="\n")
+                writer.writerow(["sf__Id", "sf__Error", *FIELDS])
+                for row in job["rows"]:
+                    if ";" in row[FIELDS.index("WhatId")]:
+                        writer.writerow(["", INVALID_ID_ERROR, *row])
+                self.reply(200, output.getvalue(), "text/csv")
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        return Handler
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving requests."""
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def run_export(stub, output, options, args):
+    """
+    Runs an export over the whole calendar in a new process.
+
+    Returns:
+        tuple: The exit code and the standard error of the export.
+    """
+    command = [
+        sys.executable,
+        SCRIPT,
+        "--api-url",
+        stub.url,
+        "--sfdc-user-id",
+        "BENCHMARK",
+        "--start",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--end",
+        (DEFAULT_START + timedelta(days=args.days + 31)).strftime("%Y-%m-%d"),
+        "--output",
+        output,
+        *options,
+    ]
+    process = subprocess.run(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "SFDC_ACCESS_TOKEN": ACCESS_TOKEN},
+    )
+    logging.debug(process.stderr)
+    return process.returncode, process.stderr
+
+
+def read_rows(filename):
+    """Returns the rows of a CSV file without its header, or no rows if it is missing."""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, newline="", encoding="utf-8") as csv_file:
+        return list(csv.reader(csv_file))[1:]
+
+
+class BulkCheck:
+    """Class representing the runs of the check with one HTTP client"""
+
+    def __init__(self, stub, workdir, expected, args, http_client):
+        """
+        Initializes the check.
+
+        Args:
+            stub (JcalapiStub): The started stub serving the calendar.
+            workdir (str): The directory receiving the files of the exports.
+            expected (list): The rows of the CSV export of the calendar.
+            args (argparse.Namespace): The options of the check.
+            http_client (str): The --http-client of the exports.
+        """
+        self.stub = stub
+        self.workdir = workdir
+        self.args = args
+        self.http_client = http_client
+        self.valid = Counter(tuple(row) for row in expected if ";" not in row[2])
+        self.invalid = Counter(tuple(row) for row in expected if ";" in row[2])
+        self.failures = []
+        self.runs = 0
+
+    def upload(self, mock, extra=()):
+        """
+        Uploads the calendar to mock.
+
+        Returns:
+            tuple: The standard error of the export, and the rejected rows
+                with their error as first column.
+        """
+        self.runs += 1
+        output = os.path.join(self.workdir, f"{self.http_client}-{self.runs}.csv")
+        options = [
+            "--bulk-upload",
+            "--sfdc-instance-url",
+            mock.url,
+            "--bulk-batch-rows",
+            str(self.args.batch_rows),
+            "--http-client",
+            self.http_client,
+            *extra,
+        ]
+        code, stderr = run_export(self.stub, output, options, self.args)
+        self.check(code == 0, f"the export exited with code {code}")
+        rejected = read_rows(
+            os.path.join(self.workdir, f"{self.http_client}-{self.runs}-rejected.csv")
+        )
+        self.failures.extend(f"{self.http_client}: {error}" for error in mock.errors)
+        return stderr, rejected
+
+    def check(self, condition, message):
+        """Records a failure unless condition is true."""
+        if not condition:
+            self.failures.append(f"{self.http_client}: {message}")
+
+    def check_upload(self):
+        """Checks the Tasks created and rejected by a successful upload."""
+        with MockSalesforce() as mock:
+            stderr, rejected = self.upload(mock)
+        self.check(UPLOAD_ERROR not in stderr, "the upload failed")
+        self.check(mock.polls > 0, "the jobs were not polled")
+        self.check(
+            Counter(map(tuple, mock.created)) == self.valid,
+            "the Tasks created differ from the CSV export",
+        )
+        self.check(
+            Counter(tuple(row[1:]) for row in rejected) == self.invalid,
+            "the rejected Tasks differ from the Tasks with several WhatId",
+        )
+        self.check(
+            all(row[0] == INVALID_ID_ERROR for row in rejected),
+            "the rejected Tasks don't have the error of failedResults",
+        )
+
+    def check_failed_job(self):
+        """Checks that the rows of a failed job are rejected with its error."""
+        with MockSalesforce(fail_jobs={2}) as mock:
+            stderr, rejected = self.upload(mock)
+        failed_job = [row for row in rejected if row[0] == FAILED_JOB_ERROR]
+        self.check(UPLOAD_ERROR not in stderr, "the upload failed")
+        self.check(failed_job, "the rows of the failed job are not rejected")
+        self.check(
+            Counter(map(tuple, mock.created))
+            + Counter(tuple(row[1:]) for row in rejected)
+            == self.valid + self.invalid,
+            "the Tasks created and rejected differ from the CSV export",
+        )
+
+    def check_incremental(self):
+        """
+        Checks that --incremental records the Tasks of the completed jobs when
+        an upload fails, and uploads the others, and the rejected ones, again.
+        """
+        manifest = os.path.join(self.workdir, f"{self.http_client}.sqlite")
+        options = ["--incremental", manifest]
+        created = Counter()
+        with MockSalesforce(fail_uploads={3}) as mock:
+            stderr, _ = self.upload(mock, options)
+        created.update(map(tuple, mock.created))
+        self.check(UPLOAD_ERROR in stderr, "the failed data upload is not reported")
+        self.check(created, "no job completed before the failed upload")
+        with MockSalesforce() as mock:
+            stderr, rejected = self.upload(mock, options)
+        created.update(map(tuple, mock.created))
+        self.check(UPLOAD_ERROR not in stderr, "the retry failed")
+        self.check(
+            created == self.valid,
+            "the Tasks created by the failed upload and its retry differ "
+            "from the CSV export (missing or duplicated Tasks)",
+        )
+        with MockSalesforce() as mock:
+            stderr, rejected = self.upload(mock, options)
+        self.check(UPLOAD_ERROR not in stderr, "the last upload failed")
+        self.check(not mock.created, f"{len(mock.created)} Tasks created again")
+        self.check(
+            Counter(tuple(row[1:]) for row in rejected) == self.invalid,
+            "the rejected Tasks are not uploaded again",
+        )
+
+
+def main():
+    """
+    Checks --bulk-upload against a local Bulk API stand-in.
+
+    Usage: check_bulk.py [--events EVENTS] [--days DAYS] [--batch-rows ROWS]
+
+    With each --http-client, checks the Tasks created and rejected by an
+    upload, the rejection of the Tasks of a failed job, and the retry of an
+    --incremental upload interrupted by a failed data upload. Exits with
+    code 1 if a check fails.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check --bulk-upload against a local Bulk API stand-in.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=DEFAULT_BATCH_ROWS,
+        help="The --bulk-batch-rows of the uploads",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix="sfdc-bulk-") as workdir:
+        calendar = os.path.join(workdir, "calendar.json")
+        write_calendar(calendar, args.events, CalendarProfile(days=args.days))
+        with JcalapiStub(calendar) as stub:
+            reference = os.path.join(workdir, "reference.csv")
+            if run_export(stub, reference, [], args)[0]:
+                raise RuntimeError("The CSV export failed")
+            expected = read_rows(reference)
+            for http_client in ("requests", "stdlib"):
+                check = BulkCheck(stub, workdir, expected, args, http_client)
+                check.check_upload()
+                check.check_failed_job()
+                check.check_incremental()
+                failures.extend(check.failures)
+                logging.info(
+                    f"{http_client}: {check.runs} uploads of {len(expected)} Tasks "
+                    f"({sum(check.invalid.values())} with several WhatId)"
+                )
+    for failure in failures:
+        logging.error(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+    logging.info("Bulk uploads match the CSV export")
+
+
+if __name__ == "__main__":
+    main()
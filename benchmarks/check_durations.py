@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking that business_hours returns the same durations as the
+day by day loop it replaced, on random events.
+"""
+
+import argparse
+import importlib.util
+import logging
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_CASES = 200000
+ZONES = [
+    None,
+    timezone.utc,
+    timezone(timedelta(hours=-5)),
+    timezone(timedelta(hours=5, minutes=30)),
+    ZoneInfo("Europe/Paris"),
+    ZoneInfo("America/New_York"),
+    ZoneInfo("Australia/Sydney"),
+]
+
+
+def load_script():
+    """Imports import-sfdc-task.py as a module."""
+    spec = importlib.util.spec_from_file_location("import_sfdc_task", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reference_business_hours(start, end, max_hours_by_day, morning_hour, evening_hour):
+    """
+    Calculates the business hours spent between start and end day by day,
+    like EventEntry.calculate_duration_hours did before business_hours.
+    """
+    start = max(start, start.replace(hour=morning_hour, minute=0))
+    end = min(end, end.replace(hour=evening_hour, minute=0))
+    if start >= end:
+        return 0
+    total_hours = 0
+    while start.date() <= end.date():
+        if start.weekday() < 5:  # Exclude weekends (Monday = 0, Sunday = 6)
+            day_end = min(end, start.replace(hour=evening_hour, minute=0))
+            hours_this_day = (day_end - start).seconds / 3600
+            total_hours += min(hours_this_day, max_hours_by_day)
+        start = (start + timedelta(days=1)).replace(hour=morning_hour, minute=0)
+    return math.ceil(total_hours)
+
+
+def random_case(rng):
+    """
+    Returns the arguments of a random event, mixing short and multi-week
+    events, weekend starts, DST changes and unusual working hours.
+    """
+    zone = rng.choice(ZONES)
+    start = datetime(2023, 1, 1) + timedelta(
+        days=rng.randrange(3 * 365), minutes=rng.randrange(0, 24 * 60, 5)
+    )
+    duration = rng.choice(
+        [
+            timedelta(minutes=rng.randrange(0, 12 * 60, 5)),
+            timedelta(days=rng.randrange(1, 4), minutes=rng.randrange(24 * 60)),
+            timedelta(days=rng.randrange(4, 400), minutes=rng.randrange(24 * 60)),
+        ]
+    )
+    morning_hour = rng.choice([0, 6, 8, 8, 9])
+    evening_hour = rng.choice([morning_hour + 1, 17, 19, 19, 23])
+    max_hours_by_day = rng.choice([1, 4, 8, 8, 10, 24])
+    end = start + duration
+    if zone is not None:
+        start = start.replace(tzinfo=zone)
+        # The end of some events is in another zone, like invitations
+        end = end.replace(tzinfo=rng.choice([zone, zone, timezone.utc]))
+        end = end.astimezone(start.tzinfo) if rng.random() < 0.5 else end
+    return start, end, max_hours_by_day, morning_hour, evening_hour
+
+
+def main():
+    """
+    Compares business_hours to the day by day loop on random events.
+
+    Usage: check_durations.py [--cases CASES] [--seed SEED]
+
+    Exits with code 1 if a duration differs.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare business_hours to the day by day loop it replaced.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--cases", type=int, default=DEFAULT_CASES)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    business_hours = load_script().business_hours
+    rng = random.Random(args.seed)
+    cases = [random_case(rng) for _ in range(args.cases)]
+    timings = {}
+    results = {}
+    for name, function in (
+        ("day by day", reference_business_hours),
+        ("business_hours", business_hours),
+    ):
+        started = time.perf_counter()
+        results[name] = [function(*case) for case in cases]
+        timings[name] = time.perf_counter() - started
+    mismatches = [
+        (case, expected, actual)
+        for case, expected, actual in zip(
+            cases, results["day by day"], results["business_hours"]
+        )
+        if expected != actual
+    ]
+    logging.info(
+        ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        + f" for {len(cases)} events"
+    )
+    for case, expected, actual in mismatches[:10]:
+        logging.error(f"business_hours{case} = {actual} instead of {expected}")
+    if mismatches:
+        logging.error(f"Regression: {len(mismatches)} durations differ")
+        sys.exit(1)
+    logging.info("business_hours matches the day by day loop")
+
+
+if __name__ == "__main__":
+    main()
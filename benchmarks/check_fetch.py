@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking that exports from an API serving its events in pages, or
+rejecting the date range parameters, produce the same file as an export
+from JCALAPI.
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+
+from generate_calendar import DEFAULT_START, CalendarProfile, write_calendar
+from jcalapi_stub import DATE_RANGE_PARAMS, JcalapiStub
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_EVENTS = 20000
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_EXPORT_ARGS = ""
+# Name, whether the calendar is served in pages, and status rejecting the date range
+MODES = (
+    ("pages", True, None),
+    ("date range rejected with 400", False, 400),
+    ("pages, date range rejected with 422", True, 422),
+)
+
+
+def run_export(stub, output, options, args):
+    """
+    Runs an export over the whole calendar in a new process.
+
+    Returns:
+        str: The standard error of the export.
+
+    Raises:
+        RuntimeError: If the export fails.
+    """
+    command = [
+        sys.executable,
+        SCRIPT,
+        "--api-url",
+        stub.url,
+        "--sfdc-user-id",
+        "BENCHMARK",
+        "--start",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--end",
+        (DEFAULT_START + timedelta(days=args.days + 31)).strftime("%Y-%m-%d"),
+        "--output",
+        output,
+        *options,
+        *args.export_args.split(),
+    ]
+    process = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    if process.returncode:
+        logging.error(process.stderr)
+        raise RuntimeError(f"The export with {' '.join(options)} failed")
+    return process.stderr
+
+
+def check_requests(stub, paged, reject_params, stderr):
+    """
+    Checks the requests received by the stub during an export.
+
+    Returns:
+        list: A message for each failure.
+    """
+    failures = []
+    with_range = [
+        query
+        for query in stub.requests
+        if all(name in query for name in DATE_RANGE_PARAMS)
+    ]
+    if not with_range:
+        failures.append("the date range is not sent")
+    if reject_params:
+        if len(with_range) != 1:
+            failures.append(f"{len(with_range)} requests sent the rejected date range")
+        if "rejected query parameters" not in stderr:
+            failures.append("the fallback without the date range is not logged")
+    if paged:
+        pages = sorted(int(query.get("page", ["1"])[0]) for query in stub.requests)
+        expected = list(range(1, len(stub.pages) + 1))
+        if reject_params:
+            expected.insert(0, 1)
+        if pages != expected:
+            failures.append(f"pages {pages} were requested instead of {expected}")
+    return failures
+
+
+def main():
+    """
+    Checks exports from APIs paginating or rejecting the date range.
+
+    Usage: check_fetch.py [--events EVENTS] [--days DAYS] [--page-size SIZE]
+                          [--export-args ARGS]
+
+    Runs an export from a stub serving the calendar in pages with one and
+    several --fetch-workers, and from stubs rejecting the date range
+    parameters with 400 and 422. Exits with code 1 if an export writes a file
+    differing from the export of the whole calendar in one response, or if
+    the pages or the fallback requests are not the expected ones.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check exports from APIs paginating or rejecting the date range.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument(
+        "--export-args",
+        default=DEFAULT_EXPORT_ARGS,
+        help="Extra options passed to the exports",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix="sfdc-fetch-") as workdir:
+        calendar = os.path.join(workdir, "calendar.json")
+        write_calendar(calendar, args.events, CalendarProfile(days=args.days))
+        reference = os.path.join(workdir, "reference.csv")
+        with JcalapiStub(calendar) as stub:
+            run_export(stub, reference, [], args)
+        with open(reference, encoding="utf-8") as reference_file:
+            expected = reference_file.read()
+        for name, paged, reject_params in MODES:
+            for fetch_workers in (1, 4) if paged else (1,):
+                label = f"{name}, --fetch-workers {fetch_workers}"
+                output = os.path.join(workdir, "export.csv")
+                page_size = args.page_size if paged else 0
+                with JcalapiStub(
+                    calendar, page_size=page_size, reject_params=reject_params
+                ) as stub:
+                    try:
+                        stderr = run_export(
+                            stub, output, ["--fetch-workers", str(fetch_workers)], args
+                        )
+                    except RuntimeError as e:
+                        failures.append(f"{label}: {e}")
+                        continue
+                    failures.extend(
+                        f"{label}: {failure}"
+                        for failure in check_requests(
+                            stub, paged, reject_params, stderr
+                        )
+                    )
+                with open(output, encoding="utf-8") as output_file:
+                    if output_file.read() != expected:
+                        failures.append(f"{label}: the file differs from the reference")
+                logging.info(f"{label}: {len(stub.requests)} requests")
+    for failure in failures:
+        logging.error(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+    logging.info(
+        "Paginated and fallback exports match the export of the whole calendar"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking with tracemalloc the memory retained by the parsed events,
+with the lean EventEntry and with the previous representation of an event.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+from generate_calendar import generate_events
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_EVENTS = 10000
+DEFAULT_MAX_RATIO = 0.5
+
+
+def load_script():
+    """Imports import-sfdc-task.py as a module."""
+    spec = importlib.util.spec_from_file_location("import_sfdc_task", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PreviousAttendee:
+    """Class representing an attendee before __slots__, as a reference"""
+
+    def __init__(self, name, email, optional, response):
+        self.name = name
+        self.email = email
+        self.optional = optional
+        self.response = response
+
+
+class PreviousEventEntry:
+    """Class representing an event entry before the lean event model, as a
+    reference: all fields are kept in the __dict__ of each instance, and
+    attendees, companies and opportunities are built for each event"""
+
+    def __init__(
+        self,
+        script,
+        uid,
+        backend,
+        calendar,
+        organizer,
+        attendees,
+        summary,
+        description,
+        body,
+        location,
+        start,
+        end,
+        whole_day,
+        is_recurring,
+        status,
+        categories,
+        extra,
+        conference_url,
+    ):
+        self.uid = uid
+        self.backend = backend
+        self.calendar = calendar
+        self.organizer = organizer
+        self.attendees = [PreviousAttendee(**attendee) for attendee in attendees]
+        self.summary = summary
+        self.description = description
+        self.body = body
+        self.location = location
+        self.start = datetime.fromisoformat(start)
+        self.end = datetime.fromisoformat(end)
+        self.whole_day = whole_day
+        self.is_recurring = is_recurring
+        self.status = status
+        self.categories = categories
+        self.extra = extra
+        self.conference_url = conference_url
+        self.duration_hours = script.business_hours(self.start, self.end, 8, 8, 19)
+        self.subject = next(
+            (
+                category[4:]
+                for category in categories or []
+                if category.startswith("SU::")
+                and category[4:] in script.EventEntry.SUBJECT_LIST
+            ),
+            None,
+        )
+        self.companies = self._matches(categories, "CU::")
+        self.opportunities = self._matches(categories, "OP::")
+
+    @staticmethod
+    def _matches(categories, prefix):
+        matches = []
+        for category in categories or []:
+            if category.startswith(prefix):
+                parts = category.split("::")
+                if len(parts) >= 3:
+                    matches.append({"id": parts[2], "name": parts[1]})
+        return matches
+
+
+def measure(build):
+    """
+    Calls build while tracing the memory allocated.
+
+    Returns:
+        tuple: The memory retained by the result of build and the peak, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        entries = build()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del entries
+    return retained, peak
+
+
+def main():
+    """
+    Checks the memory retained by the parsed events.
+
+    Usage: check_memory.py [--events EVENTS] [--max-ratio RATIO]
+
+    The events are decoded with all their fields before tracing, so that
+    only the memory of the entries is measured. Exits with code 1 if the
+    lean entries retain more than RATIO times the memory of the previous
+    representation of the same events.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the memory retained by the parsed events.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=DEFAULT_MAX_RATIO,
+        help="Accepted ratio of the memory retained by the lean and previous entries",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    script = load_script()
+    text = json.dumps(list(generate_events(args.events)))
+    events = json.loads(text)
+    records = list(script.normalize_events(script.iter_json_array([text], None)))
+    projected = list(
+        script.normalize_events(
+            script.iter_json_array([text], frozenset(script.PROJECTED_FIELDS))
+        )
+    )
+    results = {
+        "previous entries": measure(
+            lambda: [PreviousEventEntry(script, **event) for event in events]
+        ),
+        "lean entries": measure(
+            lambda: [
+                script.EventEntry.from_record(record, 8, 8, 19) for record in records
+            ]
+        ),
+        "lean entries, default projection": measure(
+            lambda: [
+                script.EventEntry.from_record(record, 8, 8, 19) for record in projected
+            ]
+        ),
+    }
+    for name, (retained, peak) in results.items():
+        logging.info(
+            f"{name}: {retained / 2**20:.1f} MiB retained "
+            f"({retained / args.events:.0f} bytes per event), peak {peak / 2**20:.1f} MiB"
+        )
+    ratio = results["lean entries"][0] / results["previous entries"][0]
+    if ratio > args.max_ratio:
+        logging.error(f"Regression: the ratio of the retained memory is {ratio:.2f}")
+        sys.exit(1)
+    logging.info(f"The lean entries retain {ratio:.2f} times the memory")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module comparing the validation and parsing of events from EventRecords to
+the per-event parsing of ISO strings they replaced.
+"""
+
+import argparse
+import gc
+import importlib.util
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from generate_calendar import DEFAULT_START, CalendarProfile, generate_events
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_EVENTS = 100000
+DEFAULT_TOLERANCE = 0.15
+WORKING_HOURS = (8, 8, 19)
+
+
+def load_script():
+    """Imports import-sfdc-task.py as a module."""
+    spec = importlib.util.spec_from_file_location("import_sfdc_task", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reference_validate_events_timing(events, start_date, end_date, counters):
+    """
+    Validates the timing of raw events, parsing their ISO timestamps, like
+    validate_events_timing did before EventRecords.
+    """
+    for event in events:
+        counters["collected"] += 1
+        event_start = datetime.fromisoformat(event["start"])
+        event_end = datetime.fromisoformat(event["end"])
+        if (
+            start_date <= event_start <= end_date
+            and start_date <= event_end <= end_date
+        ):
+            counters["in_range"] += 1
+            yield event
+            logging.debug(
+                "INCLUDED - Event %s at %s is within the date range",
+                event["summary"],
+                event["start"],
+            )
+        else:
+            logging.debug(
+                "EXCLUDED - Event %s at %s is NOT within the date range",
+                event["summary"],
+                event["start"],
+            )
+
+
+def parse_before(script, events, start_date, end_date):
+    """Validates raw events, then parses their ISO timestamps again in EventEntry."""
+    counters = Counter()
+    return [
+        script.EventEntry(*WORKING_HOURS, **event)
+        for event in reference_validate_events_timing(
+            events, start_date, end_date, counters
+        )
+    ]
+
+
+def parse_after(script, events, start_date, end_date):
+    """Parses raw events once into EventRecords, then validates and parses them."""
+    counters = Counter()
+    records = script.normalize_events(events)
+    return [
+        script.EventEntry.from_record(record, *WORKING_HOURS)
+        for record in script.validate_events_timing(
+            records, start_date, end_date, counters
+        )
+    ]
+
+
+def summarize(entry):
+    """Returns the exported fields of an entry."""
+    return (
+        entry.uid,
+        entry.start,
+        entry.end,
+        entry.duration_hours,
+        entry.subject,
+        entry.companies,
+        entry.opportunities,
+    )
+
+
+def main():
+    """
+    Compares the validation and parsing of events before and after EventRecords.
+
+    Usage: check_parse.py [--events EVENTS] [--days DAYS] [--repeat REPEAT]
+                          [--tolerance TOLERANCE]
+
+    Exits with code 1 if both paths don't parse the same entries, or if the
+    parsing from EventRecords is slower than the per-event parsing by more
+    than the tolerance.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare the parsing of events before and after EventRecords.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per path, the fastest is kept"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Accepted relative slowdown",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    script = load_script()
+    events = list(generate_events(args.events, CalendarProfile(days=args.days)))
+    start_date = DEFAULT_START
+    end_date = DEFAULT_START + timedelta(days=args.days // 2)
+    timings = {}
+    results = {}
+    for name, parse in (("before", parse_before), ("after", parse_after)):
+        best = None
+        for _ in range(args.repeat):
+            entries = None
+            gc.collect()
+            started = time.perf_counter()
+            entries = parse(script, events, start_date, end_date)
+            seconds = time.perf_counter() - started
+            best = seconds if best is None else min(best, seconds)
+        timings[name] = best
+        results[name] = [summarize(entry) for entry in entries]
+        logging.info(
+            f"{name}: {best:.2f}s, {best / len(events) * 1e6:.2f} us/event, "
+            f"{len(entries)} of {len(events)} events in range"
+        )
+    failures = []
+    if results["before"] != results["after"]:
+        failures.append("the entries parsed from EventRecords differ")
+    if timings["after"] > timings["before"] * (1 + args.tolerance):
+        failures.append(
+            f"{timings['after']:.2f}s from EventRecords > {timings['before']:.2f}s"
+        )
+    for failure in failures:
+        logging.error(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+    logging.info(
+        f"Parsing from EventRecords takes {timings['after'] / timings['before']:.2f} "
+        "times the time of the per-event parsing"
+    )
+
+
+if __name__ == "__main__":
+    main()
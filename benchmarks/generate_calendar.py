@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module to generate synthetic calendars shaped like the JCALAPI /events
+answer, used by the benchmarks.
+"""
+
+import argparse
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+
+SUBJECTS = [
+    "BACK OFFICE TASKS",
+    "COMPANY/TEAM MEETINGS",
+    "LEARNING ACTIVITY",
+    "PARTNER ENGAGEMENT",
+    "PRE SALES ONSITE",
+    "SME SUPPORT",
+    "TRAVEL",
+    "VACATION",
+    "NOT A SUBJECT",
+]
+TIMEZONES = [timezone(timedelta(hours=hours)) for hours in (0, 1, 1, 2, -5)]
+DURATIONS = [0, 15, 30, 30, 45, 60, 60, 60, 90, 120, 240, 480]
+DEFAULT_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class CalendarProfile:
+    """Class representing the shape of a synthetic calendar"""
+
+    def __init__(
+        self,
+        days=365,
+        multi_day_share=0.05,
+        recurring_share=0.2,
+        subject_share=0.8,
+        company_share=0.5,
+        opportunity_share=0.3,
+        body_size=1000,
+    ):
+        """
+        Initializes a calendar profile.
+
+        Args:
+            days (int): Number of days covered by the calendar.
+            multi_day_share (float): Share of events lasting several days.
+            recurring_share (float): Share of events belonging to a weekly series.
+            subject_share (float): Share of events tagged with a SU:: category.
+            company_share (float): Share of events tagged with CU:: categories.
+            opportunity_share (float): Share of events tagged with OP:: categories.
+            body_size (int): Maximum size of the HTML body of an event.
+        """
+        self.days = days
+        self.multi_day_share = multi_day_share
+        self.recurring_share = recurring_share
+        self.subject_share = subject_share
+        self.company_share = company_share
+        self.opportunity_share = opportunity_share
+        self.body_size = body_size
+
+    def as_dict(self):
+        """Returns the profile as a dictionary, to be stored with the results."""
+        return dict(vars(self))
+
+
+def _categories(rng, profile):
+    """Returns a random list of categories, or None like untagged JCALAPI events."""
+    categories = []
+    if rng.random() < profile.subject_share:
+        categories.append("SU::" + rng.choice(SUBJECTS))
+    if rng.random() < profile.company_share:
+        for _ in range(rng.randint(1, 2)):
+            number = rng.randint(0, 999)
+            categories.append(f"CU::Customer {number}::001000000000{number:03d}")
+    if rng.random() < profile.opportunity_share:
+        number = rng.randint(0, 999)
+        categories.append(f"OP::Opportunity {number}::006000000000{number:03d}")
+    return categories or None
+
+
+def generate_events(count, profile=None, seed=0, start=DEFAULT_START):
+    """
+    Generates synthetic events.
+
+    Recurring events are generated as the weekly occurrences of a series
+    sharing the same uid, like JCALAPI returns them.
+
+    Args:
+        count (int): Number of events to generate.
+        profile (CalendarProfile): The shape of the calendar.
+        seed (int): Seed of the random generator, for reproducible calendars.
+        start (datetime): The first day of the calendar.
+
+    Yields:
+        dict: Each event, as decoded from the JCALAPI JSON answer.
+    """
+    profile = profile or CalendarProfile()
+    rng = random.Random(seed)
+    minutes = profile.days * 24 * 60
+    generated = 0
+    series = 0
+    while generated < count:
+        tz = rng.choice(TIMEZONES)
+        begin = start + timedelta(minutes=rng.randrange(0, minutes, 15))
+        if rng.random() < profile.multi_day_share:
+            duration = timedelta(days=rng.randint(1, 10), hours=rng.randint(0, 8))
+        else:
+            duration = timedelta(minutes=rng.choice(DURATIONS))
+        recurring = rng.random() < profile.recurring_share
+        occurrences = min(rng.randint(2, 20), count - generated) if recurring else 1
+        uid = f"event-{seed}-{series}"
+        series += 1
+        categories = _categories(rng, profile)
+        attendees = [
+            {
+                "name": f"Attendee {index}",
+                "email": f"attendee{index}@example.com",
+                "optional": index > 2,
+                "response": "Accept",
+            }
+            for index in range(rng.randint(0, 5))
+        ]
+        body = "<html>" + "x" * rng.randint(0, profile.body_size) + "</html>"
+        for occurrence in range(occurrences):
+            event_start = (begin + timedelta(weeks=occurrence)).astimezone(tz)
+            yield {
+                "uid": uid,
+                "backend": "ews",
+                "calendar": "Calendar",
+                "organizer": "organizer@example.com",
+                "attendees": attendees,
+                "summary": f"Meeting {series}, occurrence {occurrence}",
+                "description": "Agenda",
+                "body": body,
+                "location": "Room",
+                "start": event_start.isoformat(),
+                "end": (event_start + duration).isoformat(),
+                "whole_day": False,
+                "is_recurring": recurring,
+                "status": "busy",
+                "categories": categories,
+                "extra": None,
+                "conference_url": None,
+            }
+            generated += 1
+
+
+def write_calendar(filename, count, profile=None, seed=0):
+    """
+    Writes a synthetic calendar as a JSON array, one event at a time.
+
+    Args:
+        filename (str): The path of the JSON file.
+        count (int): Number of events to generate.
+        profile (CalendarProfile): The shape of the calendar.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        None
+    """
+    with open(filename, "w", encoding="utf-8") as calendar_file:
+        calendar_file.write("[")
+        for index, event in enumerate(generate_events(count, profile, seed)):
+            if index:
+                calendar_file.write(",\n")
+            calendar_file.write(json.dumps(event))
+        calendar_file.write("]")
+    logging.info(f"{count} events written to {filename}")
+
+
+def add_profile_arguments(parser):
+    """Adds the options of CalendarProfile to an argument parser."""
+    defaults = CalendarProfile()
+    parser.add_argument("--days", type=int, default=defaults.days)
+    parser.add_argument(
+        "--multi-day-share", type=float, default=defaults.multi_day_share
+    )
+    parser.add_argument(
+        "--recurring-share", type=float, default=defaults.recurring_share
+    )
+    parser.add_argument("--subject-share", type=float, default=defaults.subject_share)
+    parser.add_argument("--company-share", type=float, default=defaults.company_share)
+    parser.add_argument(
+        "--opportunity-share", type=float, default=defaults.opportunity_share
+    )
+    parser.add_argument("--body-size", type=int, default=defaults.body_size)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def profile_from_args(args):
+    """Returns the CalendarProfile described by the parsed options."""
+    return CalendarProfile(
+        days=args.days,
+        multi_day_share=args.multi_day_share,
+        recurring_share=args.recurring_share,
+        subject_share=args.subject_share,
+        company_share=args.company_share,
+        opportunity_share=args.opportunity_share,
+        body_size=args.body_size,
+    )
+
+
+def main():
+    """
+    Writes a synthetic calendar to a JSON file.
+
+    Usage: generate_calendar.py COUNT OUTPUT [--days DAYS] [--seed SEED]
+                                [--multi-day-share SHARE] [--recurring-share SHARE]
+                                [--subject-share SHARE] [--company-share SHARE]
+                                [--opportunity-share SHARE] [--body-size SIZE]
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic calendar.")
+    parser.add_argument("count", type=int, help="Number of events")
+    parser.add_argument("output", help="Output JSON file")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+    write_calendar(args.output, args.count, profile_from_args(args), args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module serving a calendar JSON file the way the JCALAPI Container does,
+used by the benchmarks. It can also serve it in pages or reject the date
+range parameters, like the APIs handled by fetch_events.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+COPY_BUFFER_SIZE = 256 * 1024
+DATE_RANGE_PARAMS = ("start", "end")
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+def page_ranges(calendar_file, page_size):
+    """
+    Finds the pages of a JSON array of events, reading it one chunk at a time
+    so that the calendar is never held in memory by the stub (the peak RSS
+    of the stub is inherited by the exports it starts).
+
+    Args:
+        calendar_file (str): The JSON array of events.
+        page_size (int): The number of events per page.
+
+    Returns:
+        list: The byte offsets of the start and of the end of each page, a
+            single empty page if the calendar has no events.
+    """
+    decoder = json.JSONDecoder()
+    events = []
+    with open(calendar_file, encoding="utf-8") as calendar:
+        text = calendar.read(COPY_BUFFER_SIZE)
+        position = len(text) - len(text.lstrip())
+        if not text.startswith("[", position):
+            raise ValueError(f"{calendar_file} is not a JSON array")
+        # The byte offset of text[position]
+        position += 1
+        offset = len(text[:position].encode())
+        while True:
+            start = SEPARATORS.match(text, position).end()
+            if text.startswith("]", start):
+                break
+            try:
+                _, end = decoder.raw_decode(text, start)
+            except json.JSONDecodeError:
+                chunk = calendar.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    raise
+                # The event continues in the next chunk
+                offset += len(text[position:start].encode())
+                text, position = text[start:] + chunk, 0
+                continue
+            first = offset + len(text[position:start].encode())
+            offset = first + len(text[start:end].encode())
+            events.append((first, offset))
+            position = end
+    return [
+        (events[index][0], events[min(index + page_size, len(events)) - 1][1])
+        for index in range(0, len(events), page_size)
+    ] or [(0, 0)]
+
+
+class JcalapiStub:
+    """Class representing a local stand-in for the JCALAPI Container"""
+
+    def __init__(
+        self, calendar_file, host="127.0.0.1", port=0, page_size=0, reject_params=None
+    ):
+        """
+        Initializes the stub without starting it.
+
+        Args:
+            calendar_file (str): The JSON array served by /events.
+            host (str): The listening address.
+            port (int): The listening port, 0 to pick a free one.
+            page_size (int): The number of events per page, announced by the
+                X-Total-Pages header and selected by the page parameter, or 0
+                to serve the whole calendar in one response.
+            reject_params (int): The HTTP status returned to the requests
+                sending the date range parameters (e.g. 400 or 422), or None
+                to ignore them like JCALAPI does.
+        """
+        self.calendar_file = calendar_file
+        self.last_update = str(os.path.getmtime(calendar_file))
+        self.reject_params = reject_params
+        self.pages = page_ranges(calendar_file, page_size) if page_size else None
+        # The query parameters of each /events request, in the order received
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        """The base URL to pass as --api-url."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # The date range parameters are ignored like JCALAPI does: the
+                # whole calendar is always returned.
+                url = urlparse(self.path)
+                path = url.path.rstrip("/")
+                query = parse_qs(url.query)
+                if path == "/events":
+                    with stub.lock:
+                        stub.requests.append(query)
+                    if stub.reject_params and any(
+                        name in query for name in DATE_RANGE_PARAMS
+                    ):
+                        self.send_error(stub.reject_params)
+                    elif stub.pages is not None:
+                        self.send_page(query)
+                    else:
+                        self.send_calendar()
+                elif path == "/meta":
+                    body = json.dumps({"last_update": stub.last_update}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def send_calendar(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header(
+                    "Content-Length", str(os.path.getsize(stub.calendar_file))
+                )
+                self.end_headers()
+                with open(stub.calendar_file, "rb") as calendar:
+                    shutil.copyfileobj(calendar, self.wfile, COPY_BUFFER_SIZE)
+
+            def send_page(self, query):
+                try:
+                    page = int(query.get("page", ["1"])[0])
+                except ValueError:
+                    page = 0
+                if not 1 <= page <= len(stub.pages):
+                    self.send_error(404)
+                    return
+                start, end = stub.pages[page - 1]
+                with open(stub.calendar_file, "rb") as calendar:
+                    calendar.seek(start)
+                    body = b"[" + calendar.read(end - start) + b"]"
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("X-Total-Pages", str(len(stub.pages)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        return Handler
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving requests."""
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_stub_arguments(parser):
+    """Adds the options changing how the stub serves the calendar to parser."""
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=0,
+        help="Events per page announced by X-Total-Pages, 0 for a single response",
+    )
+    parser.add_argument(
+        "--reject-params",
+        type=int,
+        choices=(400, 422),
+        help="HTTP status returned to the requests sending a date range",
+    )
+
+
+def main():
+    """
+    Serves a calendar JSON file until interrupted.
+
+    Usage: jcalapi_stub.py CALENDAR_FILE [--host HOST] [--port PORT]
+                           [--page-size SIZE] [--reject-params STATUS]
+    """
+    parser = argparse.ArgumentParser(description="Serve a calendar like JCALAPI.")
+    parser.add_argument("calendar_file", help="JSON array of events")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7042)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+    stub = JcalapiStub(
+        args.calendar_file, args.host, args.port, args.page_size, args.reject_params
+    )
+    logging.info(f"Serving {args.calendar_file} on {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
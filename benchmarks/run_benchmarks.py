@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module running the export end to end against a local JCALAPI stand-in at
+several calendar sizes, and comparing the results to a JSON baseline.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from generate_calendar import (
+    DEFAULT_START,
+    add_profile_arguments,
+    profile_from_args,
+    write_calendar,
+)
+from jcalapi_stub import JcalapiStub, add_stub_arguments
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+DEFAULT_TOLERANCE = 0.25
+
+# Function implementing each pipeline stage reported by --metrics-json
+STAGE_FUNCTIONS = {
+    "network": "fetch_events",
+    "decode": "iter_json_array",
+    "normalize": "normalize_events",
+    "expand": "expand_recurrences",
+    "cache": "EventCache",
+    "validate": "validate_events_timing",
+    "parse": "EventEntry.from_record",
+    "filter": "filter_events",
+    "write": "write_events_to_csv",
+}
+
+
+def calendar_path(workdir, count, args):
+    """Returns the path of the calendar generated for count events and a profile."""
+    profile = profile_from_args(args).as_dict()
+    name = "-".join(f"{value}" for _, value in sorted(profile.items()))
+    return os.path.join(workdir, f"calendar-{count}-{args.seed}-{name}.json")
+
+
+def run_export(stub, count, workdir, args):
+    """
+    Runs the export of one calendar in a new process.
+
+    Args:
+        stub (JcalapiStub): The started stub serving the calendar.
+        count (int): The number of events of the calendar.
+        workdir (str): The directory receiving the CSV and metrics files.
+        args (argparse.Namespace): The benchmark options.
+
+    Returns:
+        dict: The wall time, throughput, peak RSS, and the timings and peak
+            RSS when it finished of each function.
+    """
+    output = os.path.join(workdir, f"export-{count}.csv")
+    metrics_file = os.path.join(workdir, f"metrics-{count}.json")
+    end_date = DEFAULT_START + timedelta(days=args.days + 31)
+    command = [
+        sys.executable,
+        SCRIPT,
+        "--api-url",
+        stub.url,
+        "--sfdc-user-id",
+        "BENCHMARK",
+        "--start",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--end",
+        end_date.strftime("%Y-%m-%d"),
+        "--output",
+        output,
+        "--metrics-json",
+        metrics_file,
+        *args.export_args.split(),
+    ]
+    started = time.perf_counter()
+    process = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    seconds = time.perf_counter() - started
+    if process.returncode:
+        logging.error(process.stderr)
+        raise RuntimeError(f"The export of {count} events failed")
+    with open(metrics_file, encoding="utf-8") as metrics:
+        report = json.load(metrics)
+    export = report["exports"][0]
+    return {
+        "events": count,
+        "seconds": seconds,
+        "events_per_second": count / seconds,
+        "peak_rss_bytes": report["peak_rss_bytes"],
+        "functions": {
+            STAGE_FUNCTIONS.get(stage, stage): {
+                "seconds": stats["seconds"],
+                "items": stats["items"],
+                "peak_rss_bytes": stats.get("peak_rss_bytes"),
+                "items_per_second": (
+                    stats["items"] / stats["seconds"] if stats["seconds"] else None
+                ),
+            }
+            for stage, stats in export["stages"].items()
+        },
+        "counters": export["counters"],
+    }
+
+
+def run_size(count, workdir, args):
+    """
+    Benchmarks the export of a calendar of count events.
+
+    The calendar is generated once and reused by later runs. The best of
+    args.repeat runs is kept.
+
+    Returns:
+        dict: The results of the fastest run.
+    """
+    calendar = calendar_path(workdir, count, args)
+    if not os.path.exists(calendar):
+        write_calendar(calendar, count, profile_from_args(args), args.seed)
+    with JcalapiStub(
+        calendar, page_size=args.page_size, reject_params=args.reject_params
+    ) as stub:
+        runs = [run_export(stub, count, workdir, args) for _ in range(args.repeat)]
+    best = min(runs, key=lambda run: run["seconds"])
+    logging.info(
+        f"{count} events: {best['seconds']:.2f}s, "
+        f"{best['events_per_second']:.0f} events/s, "
+        f"peak RSS {best['peak_rss_bytes'] / 2**20:.1f} MiB"
+    )
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results to a baseline.
+
+    Args:
+        results (dict): The results of the current run.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The accepted relative loss of throughput and
+            increase of peak RSS.
+
+    Returns:
+        list: A message for each regression.
+    """
+    regressions = []
+    for size, result in results["sizes"].items():
+        reference = baseline.get("sizes", {}).get(size)
+        if reference is None:
+            continue
+        minimum = reference["events_per_second"] * (1 - tolerance)
+        if result["events_per_second"] < minimum:
+            regressions.append(
+                f"{size} events: {result['events_per_second']:.0f} events/s "
+                f"< {reference['events_per_second']:.0f} events/s in the baseline"
+            )
+        if result["peak_rss_bytes"] and reference["peak_rss_bytes"]:
+            maximum = reference["peak_rss_bytes"] * (1 + tolerance)
+            if result["peak_rss_bytes"] > maximum:
+                regressions.append(
+                    f"{size} events: peak RSS {result['peak_rss_bytes']} bytes "
+                    f"> {reference['peak_rss_bytes']} bytes in the baseline"
+                )
+    return regressions
+
+
+def main():
+    """
+    Runs the benchmarks.
+
+    Usage: run_benchmarks.py [--sizes SIZES] [--repeat REPEAT] [--workdir WORKDIR]
+                             [--export-args ARGS] [--output OUTPUT]
+                             [--baseline BASELINE] [--tolerance TOLERANCE]
+                             [--update-baseline] [--page-size SIZE]
+                             [--reject-params STATUS] [calendar options]
+
+    Exits with code 1 if the throughput or the peak RSS of a size regresses
+    by more than the tolerance compared to the baseline.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the export against a local JCALAPI stand-in.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes", default=DEFAULT_SIZES, help="Comma separated calendar sizes"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs per size, the best is kept"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory keeping the generated calendars between runs"
+    )
+    parser.add_argument(
+        "--export-args", default="", help="Extra options passed to the export"
+    )
+    parser.add_argument("--output", help="JSON file receiving the results")
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE, help="JSON baseline to compare to"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Accepted relative regression",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Write the results to the baseline instead of comparing them",
+    )
+    add_stub_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "calendar": {**profile_from_args(args).as_dict(), "seed": args.seed},
+        "export_args": args.export_args,
+        "stub": {"page_size": args.page_size, "reject_params": args.reject_params},
+        "sizes": {},
+    }
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        for size in args.sizes.split(","):
+            results["sizes"][size] = run_size(int(size), args.workdir, args)
+    else:
+        with tempfile.TemporaryDirectory(prefix="sfdc-benchmarks-") as workdir:
+            for size in args.sizes.split(","):
+                results["sizes"][size] = run_size(int(size), workdir, args)
+
+    content = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(content)
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline:
+            baseline.write(content)
+        logging.info(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        logging.info(f"No regression compared to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Module checking the startup time of a short export, from the imports
+reported by python -X importtime.
+"""
+
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+from generate_calendar import DEFAULT_START, CalendarProfile, write_calendar
+from jcalapi_stub import JcalapiStub
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARKS_DIR), "import-sfdc-task.py")
+DEFAULT_BUDGET_MS = 80
+DEFAULT_EXPORT_ARGS = "--http-client stdlib"
+# Modules a short export of a calendar without recurring series must not import
+HEAVY_MODULES = ("requests", "urllib3", "dateutil", "multiprocessing")
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def parse_import_times(stderr):
+    """
+    Parses the output of python -X importtime.
+
+    Args:
+        stderr (str): The standard error of the process.
+
+    Returns:
+        dict: The cumulative microseconds of each top-level import.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match and not match.group(2):
+            imports[match.group(3)] = int(match.group(1))
+    return imports
+
+
+def run_export(stub, workdir, export_args):
+    """
+    Runs a one day export with -X importtime.
+
+    Returns:
+        dict: The cumulative microseconds of each top-level import.
+    """
+    command = [
+        sys.executable,
+        "-X",
+        "importtime",
+        SCRIPT,
+        "--api-url",
+        stub.url,
+        "--sfdc-user-id",
+        "BENCHMARK",
+        "--start",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--end",
+        DEFAULT_START.strftime("%Y-%m-%d"),
+        "--output",
+        os.path.join(workdir, "export.csv"),
+        *export_args.split(),
+    ]
+    process = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    if process.returncode:
+        logging.error(process.stderr)
+        raise RuntimeError("The export failed")
+    return parse_import_times(process.stderr)
+
+
+def main():
+    """
+    Checks the startup time of a short export.
+
+    Usage: startup.py [--budget-ms BUDGET] [--export-args ARGS] [--repeat REPEAT]
+
+    Exits with code 1 if the export imports one of HEAVY_MODULES, or if its
+    imports take longer than the budget.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the startup time of a short export.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help="Accepted time spent importing modules, in milliseconds",
+    )
+    parser.add_argument(
+        "--export-args",
+        default=DEFAULT_EXPORT_ARGS,
+        help="Extra options passed to the export",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs, the fastest is kept"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, style="{", format="{levelname:8} {message}")
+
+    with tempfile.TemporaryDirectory(prefix="sfdc-startup-") as workdir:
+        calendar = os.path.join(workdir, "calendar.json")
+        write_calendar(calendar, 100, CalendarProfile(days=1))
+        with JcalapiStub(calendar) as stub:
+            runs = [
+                run_export(stub, workdir, args.export_args) for _ in range(args.repeat)
+            ]
+    imports = min(runs, key=lambda run: sum(run.values()))
+    total_ms = sum(imports.values()) / 1000
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:5]
+    logging.info(
+        f"Imports took {total_ms:.1f} ms, slowest: "
+        + ", ".join(f"{name} {us / 1000:.1f} ms" for name, us in slowest)
+    )
+    failures = [
+        f"{name} is imported" for name in imports if name.split(".")[0] in HEAVY_MODULES
+    ]
+    if total_ms > args.budget_ms:
+        failures.append(f"Imports took {total_ms:.1f} ms > {args.budget_ms} ms")
+    for failure in failures:
+        logging.error(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+    logging.info(f"Startup within the budget of {args.budget_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
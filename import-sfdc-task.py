@@ -9,18 +9,47 @@ Author: GUYARD Marc - mguyard@fortinet.com
 """
 
 import argparse
+import codecs
+import cProfile
 import logging
 import os
-from datetime import datetime, timedelta
+import re
+import signal
+import sys
+import sqlite3
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from itertools import chain
+import json
 import math
+import random
+from fractions import Fraction
 import csv
-import requests
-from dateutil.tz import tzlocal
+import gzip
+import hashlib
+import io
+import zlib
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Logger of the messages written for each event, silenced by --debug-summary
+EVENT_LOGGER = logging.getLogger("events")
 
 
 class Attendee:
     """Class representing a Attendee"""
 
+    __slots__ = ("name", "email", "optional", "response")
+
     def __init__(self, name, email, optional, response):
         """
         Initializes an Attendee object.
@@ -41,6 +70,41 @@ class Attendee:
 class EventEntry:
     """Class representing an event entry"""
 
+    __slots__ = (
+        "uid",
+        "summary",
+        "start",
+        "end",
+        "categories",
+        "classifier",
+        "duration_hours",
+        "subject",
+        "companies",
+        "opportunities",
+        "_details",
+        "_attendees",
+    )
+
+    DETAIL_FIELDS = (
+        "backend",
+        "calendar",
+        "organizer",
+        "attendees",
+        "description",
+        "body",
+        "location",
+        "whole_day",
+        "is_recurring",
+        "status",
+        "extra",
+        "conference_url",
+    )
+    DETAIL_INDEX = {name: index for index, name in enumerate(DETAIL_FIELDS)}
+    RECURRING_INDEX = DETAIL_INDEX["is_recurring"]
+    # Shared by the events whose detail fields were dropped at ingest, but
+    # is_recurring (kept for ExportManifest), keyed on themselves
+    SHARED_DETAILS = {}
+
     SUBJECT_LIST = [
         "BACK OFFICE TASKS",
         "COMPANY/TEAM MEETINGS",
@@ -78,6 +142,7 @@ class EventEntry:
         categories,
         extra,
         conference_url,
+        classifier=None,
     ):
         """
         Initializes an instance of the Event class.
@@ -93,8 +158,8 @@ class EventEntry:
             description (str): The description of the event.
             body (str): The body or content of the event.
             location (str): The location of the event.
-            start (str): The start date and time of the event in ISO format.
-            end (str): The end date and time of the event in ISO format.
+            start (str|datetime): The start date and time of the event in ISO format.
+            end (str|datetime): The end date and time of the event in ISO format.
             whole_day (bool): Indicates if the event is a whole day event.
             is_recurring (bool): Indicates if the event is recurring.
             status (str): The status of the event.
@@ -102,42 +167,137 @@ class EventEntry:
             extra (str): Extra information about the event.
             conference_url (str): The URL for the conference associated with
             the event.
+            classifier (CategoryClassifier): The classifier of the categories
+            (default: the classifier of SUBJECT_LIST).
         """
+        self._details = (
+            backend,
+            calendar,
+            organizer,
+            attendees,
+            description,
+            body,
+            location,
+            whole_day,
+            is_recurring,
+            status,
+            extra,
+            conference_url,
+        )
+        self._setup(
+            uid,
+            summary,
+            start if isinstance(start, datetime) else datetime.fromisoformat(start),
+            end if isinstance(end, datetime) else datetime.fromisoformat(end),
+            categories,
+            max_hours_by_day,
+            morning_hour,
+            evening_hour,
+            classifier,
+        )
+
+    def _setup(
+        self,
+        uid,
+        summary,
+        start,
+        end,
+        categories,
+        max_hours_by_day,
+        morning_hour,
+        evening_hour,
+        classifier,
+    ):
+        """Sets the fields used by the export and computes the derived ones."""
         self.uid = uid
-        self.backend = backend
-        self.calendar = calendar
-        self.organizer = organizer
-        self.attendees = [Attendee(**attendee) for attendee in attendees]
         self.summary = summary
-        self.description = description
-        self.body = body
-        self.location = location
-        self.start = datetime.fromisoformat(start)
-        self.end = datetime.fromisoformat(end)
-        self.whole_day = whole_day
-        self.is_recurring = is_recurring
-        self.status = status
+        self.start = start
+        self.end = end
+        self.classifier = classifier or CategoryClassifier.default()
+        if isinstance(categories, tuple):
+            categories = self.classifier.intern(categories)
         self.categories = categories
-        self.extra = extra
-        self.conference_url = conference_url
+        self._attendees = None
         self.duration_hours = self.calculate_duration_hours(
             max_hours_by_day, morning_hour, evening_hour
         )
-        self.subject = self.category_matches_subject_list()
-        self.companies = self.category_matches_company()
-        self.opportunities = self.category_matches_opportunities()
+        self.subject, self.companies, self.opportunities = self.classifier.classify(
+            tuple(categories) if categories else ()
+        )
+
+        if EVENT_LOGGER.isEnabledFor(logging.DEBUG):
+            EVENT_LOGGER.debug(
+                "%s - %s - %s - %s hours - %s - %d companies (%s) and %d opportunities",
+                self.start,
+                self.end,
+                self.summary,
+                self.duration_hours,
+                self.subject,
+                len(self.companies),
+                "; ".join([str(company["name"]) for company in self.companies]),
+                len(self.opportunities),
+            )
+
+    def __getattr__(self, name):
+        """Reads the fields not used by the export from the details tuple."""
+        if name in self.DETAIL_INDEX:
+            return self._details[self.DETAIL_INDEX[name]]
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
+
+    @property
+    def attendees(self):
+        """list: The attendees of the event, built on first access."""
+        if self._attendees is None:
+            self._attendees = [
+                Attendee(**attendee)
+                for attendee in self._details[self.DETAIL_INDEX["attendees"]] or []
+            ]
+        return self._attendees
+
+    @classmethod
+    def from_record(
+        cls, record, max_hours_by_day, morning_hour, evening_hour, classifier=None
+    ):
+        """
+        Creates an event entry from an EventRecord, reusing its parsed fields.
+
+        Only references to the other fields of the raw event are kept, in a
+        tuple: attendees are only materialized if they are accessed. Events
+        without these fields but is_recurring (see --include-fields) share
+        the same tuple, and events with the same categories share the same
+        categories tuple.
+
+        Args:
+            record (EventRecord): The normalized event.
+            max_hours_by_day (int): The maximum number of hours allowed per day.
+            morning_hour (int): The start hour of the day.
+            evening_hour (int): The end hour of the day.
+            classifier (CategoryClassifier): The classifier of the categories.
 
-        logging.debug(
-            "%s - %s - %s - %s hours - %s - %d companies (%s) and %d opportunities",
-            self.start,
-            self.end,
-            self.summary,
-            self.duration_hours,
-            self.subject,
-            len(self.companies),
-            "; ".join([str(company["name"]) for company in self.companies]),
-            len(self.opportunities),
+        Returns:
+            EventEntry: The event entry.
+        """
+        entry = cls.__new__(cls)
+        details = tuple(map(record.raw.get, cls.DETAIL_FIELDS))
+        if details.count(None) == len(details) - (
+            details[cls.RECURRING_INDEX] is not None
+        ):
+            details = cls.SHARED_DETAILS.setdefault(details, details)
+        entry._details = details
+        entry._setup(
+            record.uid,
+            record.summary,
+            record.start,
+            record.end,
+            record.categories,
+            max_hours_by_day,
+            morning_hour,
+            evening_hour,
+            classifier,
         )
+        return entry
 
     def calculate_duration_hours(self, max_hours_by_day, morning_hour, evening_hour):
         """
@@ -148,234 +308,4030 @@ class EventEntry:
                  time is missing.
         """
         if self.start is not None and self.end is not None:
-            start = max(self.start, self.start.replace(hour=morning_hour, minute=0))
-            end = min(self.end, self.end.replace(hour=evening_hour, minute=0))
-            logging.debug(f"Event {self.summary} start: {start} / end: {end}")
+            EVENT_LOGGER.debug(
+                "Event %s start: %s / end: %s", self.summary, self.start, self.end
+            )
+            return business_hours(
+                self.start, self.end, max_hours_by_day, morning_hour, evening_hour
+            )
+        else:
+            return None
 
-            if start >= end:
-                return 0
+    def category_matches_subject_list(self):
+        """
+        Checks if any category in the list matches the subject list.
 
-            total_hours = 0
-            while start.date() <= end.date():
-                if start.weekday() < 5:  # Exclude weekends (Monday = 0, Sunday = 6)
-                    day_end = min(end, start.replace(hour=evening_hour, minute=0))
-                    hours_this_day = (day_end - start).seconds / 3600
-                    total_hours += min(hours_this_day, max_hours_by_day)
-                    logging.debug(
-                        f"Event {self.summary} for day {start.date()} with counting {total_hours} hours"  # noqa: E501
-                    )
-                else:
-                    logging.debug(
-                        f"EXCLUDED - Event {self.summary} for day {start.date()} is on weekend"
+        Returns:
+            str: The matched category if found, None otherwise.
+        """
+        return self.subject
+
+    def category_matches_company(self):
+        """
+        Returns a list of companies that match the category.
+
+        Returns:
+            list: A list of dictionaries containing the id and name of
+                  the matching companies.
+        """
+        return [dict(company) for company in self.companies]
+
+    def category_matches_opportunities(self):
+        """
+        Returns a list of opportunities that match the categories.
+
+        Returns:
+            list: A list of dictionaries representing the opportunities. Each dictionary
+            contains the 'id' and 'name' of the opportunity.
+        """
+        return [dict(opportunity) for opportunity in self.opportunities]
+
+
+class CategoryClassifier:
+    """Class representing the rules used to classify event categories"""
+
+    PREFIXES = {"subject": "SU::", "company": "CU::", "opportunity": "OP::"}
+    CACHE_SIZE = 4096
+
+    _default = None
+
+    def __init__(self, subjects=None, prefixes=None, index=None):
+        """
+        Initializes a classifier.
+
+        Args:
+            subjects (iterable): The known subjects (default: EventEntry.SUBJECT_LIST).
+            prefixes (dict): The prefix of each kind of category, keyed on
+                "subject", "company" and "opportunity" (default: PREFIXES).
+            index (SalesforceIndex): The Accounts and Opportunities used to
+                validate and resolve companies and opportunities, if any.
+        """
+        self.subjects = frozenset(
+            EventEntry.SUBJECT_LIST if subjects is None else subjects
+        )
+        self.prefixes = {**self.PREFIXES, **(prefixes or {})}
+        self.index = index
+        self._interned = {}
+        self._kinds = {}
+        for kind, prefix in self.prefixes.items():
+            self._kinds.setdefault(len(prefix), {})[prefix] = kind
+        self.classify = lru_cache(maxsize=self.CACHE_SIZE)(self._classify)
+
+    @classmethod
+    def default(cls):
+        """Returns the shared classifier of the built-in subjects and prefixes."""
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Loads a classifier from a JSON file.
+
+        The file may define "subjects" (a list of subjects) and "prefixes"
+        (an object with "subject", "company" and "opportunity" keys).
+        Missing keys keep their default value.
+
+        Args:
+            filename (str): The path of the JSON file.
+
+        Returns:
+            CategoryClassifier: The classifier.
+
+        Raises:
+            OSError: If the file can't be read.
+            ValueError: If the file is not valid.
+        """
+        with open(filename, encoding="utf-8") as config_file:
+            config = json.load(config_file)
+        if not isinstance(config, dict):
+            raise ValueError("the configuration must be a JSON object")
+        subjects = config.get("subjects")
+        prefixes = config.get("prefixes", {})
+        if subjects is not None and (
+            not isinstance(subjects, list)
+            or not all(isinstance(s, str) for s in subjects)
+        ):
+            raise ValueError("subjects must be a list of strings")
+        if not isinstance(prefixes, dict) or set(prefixes) - set(cls.PREFIXES):
+            raise ValueError(
+                f"prefixes must be an object with keys {', '.join(cls.PREFIXES)}"
+            )
+        for kind, prefix in prefixes.items():
+            if not isinstance(prefix, str) or not prefix:
+                raise ValueError(f"the {kind} prefix must be a non-empty string")
+        return cls(subjects, prefixes)
+
+    def intern(self, categories):
+        """
+        Returns a tuple equal to categories shared by the events with the
+        same categories, once CACHE_SIZE different tuples are shared.
+
+        Args:
+            categories (tuple): The categories of an event.
+
+        Returns:
+            tuple: The shared tuple, or categories itself.
+        """
+        shared = self._interned.get(categories)
+        if shared is not None:
+            return shared
+        if len(self._interned) < self.CACHE_SIZE:
+            self._interned[categories] = categories
+        return categories
+
+    def _classify(self, categories):
+        """
+        Classifies categories in a single pass.
+
+        The result is cached for each tuple of categories, so it is shared by
+        all the events with the same categories and must not be modified.
+        With an index, companies and opportunities are resolved by
+        SalesforceIndex.resolve, and categories without an ID (e.g.
+        "CU::Name") are resolved by name.
+
+        Args:
+            categories (tuple): The categories of an event.
+
+        Returns:
+            tuple: The first known subject (or None), and tuples of the id
+                and name dictionaries of the companies and the opportunities.
+        """
+        subject = None
+        companies = []
+        opportunities = []
+        for category in categories:
+            for length, kinds in self._kinds.items():
+                kind = kinds.get(category[:length])
+                if kind is not None:
+                    break
+            if kind == "subject":
+                if subject is None:
+                    stripped_category = category.replace(self.prefixes["subject"], "")
+                    if stripped_category in self.subjects:
+                        subject = stripped_category
+            elif kind is not None:
+                parts = category.split("::")
+                found = companies if kind == "company" else opportunities
+                if len(parts) >= 3:
+                    found.append({"id": parts[2], "name": parts[1]})
+                elif len(parts) == 2 and self.index is not None:
+                    found.append({"id": None, "name": parts[1]})
+        if self.index is not None:
+            companies = self.index.resolve(companies, "account")
+            opportunities = self.index.resolve(opportunities, "opportunity")
+        return subject, tuple(companies), tuple(opportunities)
+
+
+SALESFORCE_ID_SUFFIX = "ABCDEFGHIJKLMNOPQRSTUVWXYZ012345"
+SALESFORCE_KEY_PREFIXES = {"account": "001", "opportunity": "006"}
+# Bytes of the index database mapped in memory instead of read
+INDEX_MMAP_SIZE = 1024**3
+INDEX_CACHE_SIZE = 65536
+
+
+def salesforce_id(value):
+    """
+    Validates a Salesforce ID and returns its 18-character form.
+
+    15-character IDs are case-sensitive. The last 3 characters of an
+    18-character ID encode the case of the first 15, so 18-character IDs
+    are accepted in any case and returned with their original case.
+
+    Args:
+        value (str): The ID.
+
+    Returns:
+        str: The 18-character ID, or None if value is not a valid ID.
+    """
+    if (
+        not isinstance(value, str)
+        or len(value) not in (15, 18)
+        or not (value.isascii() and value.isalnum())
+    ):
+        return None
+    if len(value) == 15:
+        suffix = "".join(
+            SALESFORCE_ID_SUFFIX[
+                sum(1 << bit for bit, char in enumerate(chunk) if char.isupper())
+            ]
+            for chunk in (value[0:5], value[5:10], value[10:15])
+        )
+        return value + suffix
+    suffix = value[15:].upper()
+    chars = []
+    for position, char in enumerate(value[:15].lower()):
+        flags = SALESFORCE_ID_SUFFIX.find(suffix[position // 5])
+        if flags < 0:
+            return None
+        if flags >> (position % 5) & 1:
+            if not char.isalpha():
+                return None
+            char = char.upper()
+        chars.append(char)
+    return "".join(chars) + suffix
+
+
+class SalesforceIndex:
+    """Class representing a local extract of Salesforce Accounts and Opportunities"""
+
+    def __init__(self, path=":memory:", readonly=False):
+        """
+        Opens (and creates if needed) the index database.
+
+        Records are keyed on their 18-character ID and indexed on their
+        name. A database file is mapped in memory, so that large extracts
+        are not loaded in the process.
+
+        Args:
+            path (str): The path of the SQLite database file.
+            readonly (bool): Whether to open an existing database read-only.
+        """
+        self.path = path
+        self.csv_files = ()
+        if readonly:
+            self.connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(f"PRAGMA mmap_size = {INDEX_MMAP_SIZE}")
+        if not readonly:
+            with self.connection:
+                self.connection.execute("""CREATE TABLE IF NOT EXISTS records (
+                        id TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        is_closed INTEGER NOT NULL
+                    ) WITHOUT ROWID""")
+                self.connection.execute(
+                    "CREATE INDEX IF NOT EXISTS records_name"
+                    " ON records (kind, name COLLATE NOCASE)"
+                )
+        # Exports of a batch share the classifier, and so the connection
+        self.lock = threading.Lock()
+        self.lookup = lru_cache(maxsize=INDEX_CACHE_SIZE)(self._lookup)
+
+    @classmethod
+    def open(cls, csv_files=(), db_path=None):
+        """
+        Opens the index of Salesforce extracts.
+
+        Args:
+            csv_files (iterable): CSV extracts of Accounts and Opportunities
+                to load (see load_csv).
+            db_path (str): SQLite file storing the extracts. It is rebuilt
+                from csv_files if any, and used read-only otherwise. The
+                extracts are loaded in memory if not given.
+
+        Returns:
+            SalesforceIndex: The index.
+
+        Raises:
+            OSError: If a file can't be read.
+            ValueError: If a CSV extract is not valid.
+            sqlite3.Error: If the database can't be used.
+        """
+        if db_path and not csv_files:
+            return cls(db_path, readonly=True)
+        index = cls(db_path or ":memory:")
+        with index.connection:
+            index.connection.execute("DELETE FROM records")
+        for filename in csv_files:
+            index.load_csv(filename)
+        index.csv_files = tuple(csv_files)
+        return index
+
+    def spec(self):
+        """Returns the arguments of open giving the same index in another process."""
+        if self.path == ":memory:":
+            return self.csv_files, None
+        return (), self.path
+
+    def close(self):
+        """Closes the index database."""
+        self.connection.close()
+
+    def load_csv(self, filename):
+        """
+        Loads a CSV extract of Accounts and/or Opportunities.
+
+        The extract needs Id and Name columns, and an optional IsClosed
+        column for Opportunities (column names are not case-sensitive, as
+        written by the Data Loader or the Data Export Service). The kind of
+        each record is given by the prefix of its ID.
+
+        Args:
+            filename (str): The path of the CSV file.
+
+        Returns:
+            int: The number of records loaded.
+
+        Raises:
+            OSError: If the file can't be read.
+            ValueError: If the Id or Name column is missing.
+        """
+        kinds = {prefix: kind for kind, prefix in SALESFORCE_KEY_PREFIXES.items()}
+        with open(filename, newline="", encoding="utf-8-sig") as csvfile:
+            reader = csv.reader(csvfile)
+            header = [name.strip().lower() for name in next(reader, [])]
+            if "id" not in header or "name" not in header:
+                raise ValueError(f"{filename} needs Id and Name columns")
+            id_column, name_column = header.index("id"), header.index("name")
+            closed_column = header.index("isclosed") if "isclosed" in header else None
+            records = []
+            skipped = 0
+            for row in reader:
+                record_id = salesforce_id(row[id_column]) if row else None
+                kind = kinds.get(record_id[:3]) if record_id else None
+                if kind is None:
+                    skipped += 1
+                    continue
+                is_closed = closed_column is not None and row[
+                    closed_column
+                ].strip().lower() in ("true", "1")
+                records.append((record_id, kind, row[name_column], int(is_closed)))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", records
+            )
+        logging.info("%d Salesforce records loaded from %s", len(records), filename)
+        if skipped:
+            logging.warning(
+                "%d rows of %s are not Accounts or Opportunities", skipped, filename
+            )
+        return len(records)
+
+    def get(self, record_id, kind):
+        """
+        Returns the record of an ID.
+
+        Args:
+            record_id (str): The 18-character ID.
+            kind (str): "account" or "opportunity".
+
+        Returns:
+            tuple: The ID, name and closed flag of the record, or None.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, name, is_closed FROM records WHERE id = ? AND kind = ?",
+                (record_id, kind),
+            ).fetchone()
+
+    def find(self, name, kind):
+        """
+        Returns the records named name, regardless of case.
+
+        Args:
+            name (str): The name of the record.
+            kind (str): "account" or "opportunity".
+
+        Returns:
+            tuple: The ID, name and closed flag of each record.
+        """
+        with self.lock:
+            return tuple(
+                self.connection.execute(
+                    "SELECT id, name, is_closed FROM records"
+                    " WHERE kind = ? AND name = ? COLLATE NOCASE",
+                    (kind, name.strip()),
+                )
+            )
+
+    def _lookup(self, entry_id, name, kind):
+        """
+        Validates and resolves one company or opportunity, memoized by lookup.
+
+        Args:
+            entry_id (str): The ID of the category, or None.
+            name (str): The name of the category.
+            kind (str): "account" or "opportunity".
+
+        Returns:
+            tuple: The ID to export and the record of the extract (or None),
+                or None if the category must be ignored.
+        """
+        record_id = salesforce_id(entry_id)
+        if record_id and not record_id.startswith(SALESFORCE_KEY_PREFIXES[kind]):
+            record_id = None
+        record = self.get(record_id, kind) if record_id else None
+        if record is None:
+            matches = self.find(name, kind)
+            if len(matches) > 1:
+                matches = [match for match in matches if not match[2]]
+            if len(matches) == 1:
+                record = matches[0]
+                logging.info("%s %s resolved to %s", kind.title(), name, record[0])
+        if record is not None:
+            return record[0], record
+        if record_id:
+            logging.warning(
+                "%s %s (%s) not found in the Salesforce extract",
+                kind.title(),
+                name,
+                record_id,
+            )
+            return record_id, None
+        logging.warning(
+            "%s %s ignored: %s and no single record has this name",
+            kind.title(),
+            name,
+            f"invalid ID {entry_id}" if entry_id else "no ID",
+        )
+        return None
+
+    def resolve(self, entries, kind):
+        """
+        Validates and resolves the companies or opportunities of an event.
+
+        The ID of each entry is validated and looked up. An entry with an
+        unknown or invalid ID is resolved by its name, if only one record
+        (or only one open opportunity) has this name. Valid IDs missing from
+        the extract are kept, while invalid ones are dropped. When several
+        opportunities are tagged and only one of them is open, it is the
+        only one kept.
+
+        Args:
+            entries (list): The id and name dictionaries of the categories.
+            kind (str): "account" or "opportunity".
+
+        Returns:
+            list: The id and name dictionaries, with 18-character IDs.
+        """
+        resolved = []
+        for entry in entries:
+            found = self.lookup(entry["id"], entry["name"], kind)
+            if found is not None:
+                resolved.append(({"id": found[0], "name": entry["name"]}, found[1]))
+        if kind == "opportunity" and len(resolved) > 1:
+            opened = [item for item in resolved if item[1] and not item[1][2]]
+            if len(opened) == 1:
+                resolved = opened
+        return [entry for entry, _ in resolved]
+
+
+class EventColumns:
+    """
+    Class representing a batch of event entries stored column by column
+
+    Only the fields used by the export are kept: start, end and duration
+    are stored in arrays, and subjects and categories are interned so that
+    recurring values are stored once. Rows are rebuilt on access, with the
+    attributes read by write_events_to_csv.
+    """
+
+    Row = namedtuple(
+        "Row",
+        [
+            "uid",
+            "start",
+            "end",
+            "summary",
+            "subject",
+            "duration_hours",
+            "companies",
+            "opportunities",
+            "is_recurring",
+        ],
+    )
+    NAIVE = -(2**31)  # Offset stored for naive datetimes
+
+    def __init__(self, events=()):
+        """
+        Initializes the columns, optionally with events.
+
+        Args:
+            events (iterable): The event entries to append.
+        """
+        self.starts = array("d")
+        self.ends = array("d")
+        self.offsets = array("l")
+        self.durations = array("l")
+        self.recurring = bytearray()
+        self.uids = []
+        self.summaries = []
+        self.subjects = []
+        self.companies = []
+        self.opportunities = []
+        self._interned = {}
+        self._timezones = {}
+        for event in events:
+            self.append(event)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def _intern(self, values):
+        """Returns a shared tuple of the category dictionaries."""
+        key = tuple((value["id"], value["name"]) for value in values)
+        if key not in self._interned:
+            self._interned[key] = tuple(
+                {"id": sys.intern(str(id_)), "name": sys.intern(str(name))}
+                for id_, name in key
+            )
+        return self._interned[key]
+
+    def _offset(self, moment):
+        offset = moment.utcoffset()
+        return self.NAIVE if offset is None else int(offset.total_seconds())
+
+    def _datetime(self, timestamp, offset):
+        if offset == self.NAIVE:
+            return datetime.fromtimestamp(timestamp)
+        if offset not in self._timezones:
+            self._timezones[offset] = timezone(timedelta(seconds=offset))
+        return datetime.fromtimestamp(timestamp, self._timezones[offset])
+
+    def append(self, event):
+        """
+        Appends an event entry.
+
+        Args:
+            event (EventEntry): The event to append.
+        """
+        self.starts.append(event.start.timestamp())
+        self.ends.append(event.end.timestamp())
+        self.offsets.append(self._offset(event.start))
+        self.offsets.append(self._offset(event.end))
+        self.durations.append(event.duration_hours)
+        self.recurring.append(bool(event.is_recurring))
+        self.uids.append(event.uid)
+        self.summaries.append(event.summary)
+        self.subjects.append(sys.intern(event.subject) if event.subject else None)
+        self.companies.append(self._intern(event.companies))
+        self.opportunities.append(self._intern(event.opportunities))
+
+    def __getitem__(self, index):
+        """
+        Rebuilds one row.
+
+        Args:
+            index (int): The index of the row.
+
+        Returns:
+            EventColumns.Row: The fields of the event used by the export.
+        """
+        return self.Row(
+            self.uids[index],
+            self._datetime(self.starts[index], self.offsets[2 * index]),
+            self._datetime(self.ends[index], self.offsets[2 * index + 1]),
+            self.summaries[index],
+            self.subjects[index],
+            self.durations[index],
+            self.companies[index],
+            self.opportunities[index],
+            bool(self.recurring[index]),
+        )
+
+
+def _day_hours(start, end, day, max_hours_by_day, morning_hour, evening_hour):
+    """
+    Returns the hours counted on one day of an event, or None on weekends.
+
+    Args:
+        start (datetime): The start of the event, clipped to the morning hour.
+        end (datetime): The end of the event, clipped to the evening hour.
+        day (int): The day of the event, 0 being the day of its start.
+    """
+    if day:
+        start = (start + timedelta(days=day)).replace(hour=morning_hour, minute=0)
+    if start.weekday() >= 5:  # Exclude weekends (Monday = 0, Sunday = 6)
+        return None
+    day_end = min(end, start.replace(hour=evening_hour, minute=0))
+    return min((day_end - start).seconds / 3600, max_hours_by_day)
+
+
+def _count_weekdays(first_weekday, days):
+    """Counts the weekdays among consecutive days starting on first_weekday."""
+    full_weeks, remaining_days = divmod(days, 7)
+    return full_weeks * 5 + sum(
+        1 for day in range(remaining_days) if (first_weekday + day) % 7 < 5
+    )
+
+
+def _add_repeatedly(total, value, count):
+    """
+    Adds value count times to total, in O(log) instead of O(count).
+
+    The result is exactly the one of count successive float additions: as
+    long as value is a whole number, the additions are exact until total
+    reaches the next power of two, where a single rounding happens.
+    """
+    if value != int(value):
+        for _ in range(count):
+            total += value
+        return total
+    while count and value:
+        if total == int(total):
+            return total + count * value  # Whole numbers are added exactly
+        boundary = math.ldexp(1.0, math.frexp(total)[1])
+        exact_steps = math.ceil(Fraction(boundary - total) / Fraction(value)) - 1
+        if exact_steps >= count:
+            return total + count * value
+        total = total + exact_steps * value + value  # Rounded when crossing
+        count -= exact_steps + 1
+    return total
+
+
+def business_hours(start, end, max_hours_by_day, morning_hour, evening_hour):
+    """
+    Calculates the business hours spent between start and end.
+
+    Each weekday counts the time between the morning and the evening hour,
+    up to max_hours_by_day. Weekends are excluded. The days in the middle
+    of the event all count the same hours, so they are counted at once
+    instead of looping over them: the result is the same as summing the
+    hours of each day in order, so multi-week events cost O(1).
+
+    Args:
+        start (datetime): The start of the event.
+        end (datetime): The end of the event.
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+
+    Returns:
+        int: The duration in hours, rounded up.
+    """
+    start = max(start, start.replace(hour=morning_hour, minute=0))
+    end = min(end, end.replace(hour=evening_hour, minute=0))
+    if start >= end:
+        return 0
+
+    def add_day(total_hours, day):
+        day_hours = _day_hours(
+            start, end, day, max_hours_by_day, morning_hour, evening_hour
+        )
+        return total_hours if day_hours is None else total_hours + day_hours
+
+    total_hours = 0
+    last_day = (end.date() - start.date()).days
+    middle_days = range(1, last_day - 1)
+    middle_start = (start + timedelta(days=1)).replace(hour=morning_hour, minute=0)
+    if middle_days and end > (
+        middle_start + timedelta(days=len(middle_days) - 1)
+    ).replace(hour=evening_hour, minute=0):
+        middle_hours = min(
+            (middle_start.replace(hour=evening_hour, minute=0) - middle_start).seconds
+            / 3600,
+            max_hours_by_day,
+        )
+        total_hours = add_day(total_hours, 0)
+        total_hours = _add_repeatedly(
+            total_hours,
+            middle_hours,
+            _count_weekdays(middle_start.weekday(), len(middle_days)),
+        )
+        for day in (last_day - 1, last_day):
+            total_hours = add_day(total_hours, day)
+    else:
+        # Short events, or very different UTC offsets at start and end
+        for day in range(last_day + 1):
+            total_hours = add_day(total_hours, day)
+    return math.ceil(total_hours)
+
+
+def business_hours_batch(events, max_hours_by_day, morning_hour, evening_hour):
+    """
+    Calculates the business hours of many events at once.
+
+    Args:
+        events (iterable): (start, end) datetime pairs.
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+
+    Returns:
+        list: The duration in hours of each event, see business_hours.
+    """
+    return [
+        business_hours(start, end, max_hours_by_day, morning_hour, evening_hour)
+        for start, end in events
+    ]
+
+
+def _business_segments(start, end, morning_hour, evening_hour):
+    """
+    Yields the business hours of an event on each weekday it covers.
+
+    Days are the ones of the timezone of the start of the event, like in
+    business_hours.
+
+    Yields:
+        tuple: The date, and the start and end timestamps of the segment.
+    """
+    if start.tzinfo is not None and end.tzinfo is not None:
+        end = end.astimezone(start.tzinfo)
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day.date() <= end.date():
+        if day.weekday() < 5:  # Exclude weekends (Monday = 0, Sunday = 6)
+            segment_start = max(start, day.replace(hour=morning_hour))
+            segment_end = min(end, day.replace(hour=evening_hour))
+            if segment_start < segment_end:
+                yield day.date(), segment_start.timestamp(), segment_end.timestamp()
+        day += timedelta(days=1)
+
+
+def _sweep_shares(segments):
+    """
+    Shares the time of overlapping segments between them.
+
+    Each moment covered by k segments counts 1/k for each of them, so the
+    shares add up to the length of the union of the segments. The running
+    total of 1/k is accumulated once over the sorted boundaries: the share
+    of a segment is its value at the segment end minus at its start.
+
+    Args:
+        segments (list): The (start, end, index) of each segment, in seconds.
+
+    Returns:
+        dict: The shared seconds of each index.
+    """
+    boundaries = sorted(
+        chain(
+            ((start, 1, index) for start, _, index in segments),
+            ((end, -1, index) for _, end, index in segments),
+        )
+    )
+    shares = {}
+    active = 0
+    cumulated = 0.0
+    previous = None
+    for moment, change, index in boundaries:
+        if active:
+            cumulated += (moment - previous) / active
+        previous = moment
+        active += change
+        # Segments of the same event can't overlap, so the index is unique
+        shares[index] = cumulated - shares.get(index, 0.0)
+    return shares
+
+
+def daily_ledger(events, max_hours_by_day, morning_hour, evening_hour):
+    """
+    Calculates the hours of events with a daily cap shared between them.
+
+    For each day, the business hours of all events are merged with a
+    sweep line, so double-booked time is only counted once and split
+    between the overlapping events. When the merged time exceeds
+    max_hours_by_day, the hours of the day are reduced in proportion. The
+    minutes of each day are allocated with the largest remainder method,
+    so their total never exceeds the cap. Costs O(n log n) for n event-days.
+
+    Args:
+        events (iterable): (start, end) datetime pairs.
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+
+    Returns:
+        list: The duration in hours of each event, rounded down to 0.01.
+    """
+    days = {}
+    count = 0
+    for index, (start, end) in enumerate(events):
+        for day, segment_start, segment_end in _business_segments(
+            start, end, morning_hour, evening_hour
+        ):
+            days.setdefault(day, []).append((segment_start, segment_end, index))
+        count = index + 1
+    minutes = [0] * count
+    cap = max_hours_by_day * 60
+    for segments in days.values():
+        shares = {
+            index: seconds / 60 for index, seconds in _sweep_shares(segments).items()
+        }
+        merged = sum(shares.values())
+        total = min(merged, cap)
+        if not merged:
+            continue
+        exact = {index: share * total / merged for index, share in shares.items()}
+        allocated = {index: int(share) for index, share in exact.items()}
+        remaining = int(total) - sum(allocated.values())
+        for index in sorted(
+            exact, key=lambda index: exact[index] - allocated[index], reverse=True
+        )[:remaining]:
+            allocated[index] += 1
+        for index, allocated_minutes in allocated.items():
+            minutes[index] += allocated_minutes
+    return [math.floor(event_minutes * 100 / 60) / 100 for event_minutes in minutes]
+
+
+def apply_daily_ledger(
+    events, max_hours_by_day, morning_hour, evening_hour, export_all=False
+):
+    """
+    Replaces the duration of events with the one of daily_ledger.
+
+    All events are needed before the first one can be returned: they are
+    kept in an EventColumns. Like filter_events, events whose shared
+    duration is 0 are dropped unless export_all is set.
+
+    Args:
+        events (iterable): The event entries to export.
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+        export_all (bool): Whether to keep the events without shared duration.
+
+    Yields:
+        EventColumns.Row: Each event, with its shared duration.
+    """
+    columns = EventColumns(events)
+    hours = daily_ledger(
+        ((row.start, row.end) for row in columns),
+        max_hours_by_day,
+        morning_hour,
+        evening_hour,
+    )
+    logging.info(
+        "Daily ledger of %d events: %s hours instead of %s",
+        len(columns),
+        round(sum(hours), 2),
+        sum(columns.durations),
+    )
+    excluded = 0
+    for row, duration_hours in zip(columns, hours):
+        if duration_hours <= 0 and not export_all:
+            excluded += 1
+            continue
+        yield row._replace(duration_hours=duration_hours)
+    if excluded:
+        logging.info(
+            "%d events without duration left by the daily ledger are excluded",
+            excluded,
+        )
+
+
+class EventRecord(
+    namedtuple("EventRecord", ["uid", "summary", "start", "end", "categories", "raw"])
+):
+    """
+    Class representing an event parsed once from the API payload
+
+    Holds the fields used by the exporter, with start and end parsed to
+    datetimes and categories as a tuple. The other fields are left unparsed
+    in the raw event.
+    """
+
+    __slots__ = ()
+
+
+def normalize_events(events):
+    """
+    Parses each raw event once into an EventRecord.
+
+    Args:
+        events (iterable): The events returned by the API.
+
+    Yields:
+        EventRecord: Each normalized event.
+    """
+    for event in events:
+        categories = event.get("categories")
+        yield EventRecord._make(
+            (
+                event["uid"],
+                event["summary"],
+                datetime.fromisoformat(event["start"]),
+                datetime.fromisoformat(event["end"]),
+                tuple(categories) if categories else (),
+                event,
+            )
+        )
+
+
+RECURRENCE_CACHE_SIZE = 1024
+RECURRENCE_FIELDS = ("rrule", "exdate", "timezone")
+RECURRENCE_PERIODS = {
+    "SECONDLY": timedelta(seconds=1),
+    "MINUTELY": timedelta(minutes=1),
+    "HOURLY": timedelta(hours=1),
+    "DAILY": timedelta(days=1),
+    "WEEKLY": timedelta(weeks=1),
+}
+RECURRENCE_MONTHS = {"MONTHLY": 1, "YEARLY": 12}
+
+
+@lru_cache(maxsize=RECURRENCE_CACHE_SIZE)
+def _recurrence_set(rules, dtstart):
+    """Parses the recurrence rules of a series, once per series and start."""
+    from dateutil.rrule import rrulestr
+
+    return rrulestr(rules, dtstart=dtstart, forceset=True)
+
+
+def _recurrence_start(rules, dtstart, start_date):
+    """
+    Moves the start of a series forward to near start_date.
+
+    The rules are evaluated from their start, so that the cost of an
+    expansion would grow with the age of the series. The start is moved
+    by a whole number of periods of the rule, at least one period before
+    start_date, so that the same occurrences are generated in the range.
+    It is kept when the rule has a COUNT, several RRULE or EXRULE lines,
+    or when moving it would change its day of the month.
+
+    Args:
+        rules (str): The recurrence lines of the series.
+        dtstart (datetime): The start of the first occurrence.
+        start_date (datetime): The start date of the date range.
+
+    Returns:
+        datetime: The start to evaluate the rules from.
+    """
+    lines = [
+        line.split(":", 1)[-1]
+        for line in rules.upper().splitlines()
+        if line.startswith(("RRULE:", "EXRULE:")) or "FREQ=" in line
+    ]
+    if len(lines) != 1 or "COUNT=" in lines[0]:
+        return dtstart
+    parts = dict(part.partition("=")[::2] for part in lines[0].split(";"))
+    interval = int(parts.get("INTERVAL") or 1)
+    # A day of margin for the wall time changes of the timezone
+    start = start_date.astimezone(dtstart.tzinfo) - timedelta(days=1)
+    freq = parts.get("FREQ")
+    if freq in RECURRENCE_PERIODS:
+        period = RECURRENCE_PERIODS[freq] * interval
+        periods = (start.replace(tzinfo=None) - dtstart.replace(tzinfo=None)) // period
+        return dtstart + period * (periods - 1) if periods > 1 else dtstart
+    if freq in RECURRENCE_MONTHS:
+        step = RECURRENCE_MONTHS[freq] * interval
+        months = (start.year - dtstart.year) * 12 + start.month - dtstart.month
+        periods = months // step
+        if periods <= 1:
+            return dtstart
+        year, month = divmod(dtstart.month - 1 + step * (periods - 1), 12)
+        try:
+            return dtstart.replace(year=dtstart.year + year, month=month + 1)
+        except ValueError:  # e.g. the 31st of a shorter month
+            return dtstart
+    return dtstart
+
+
+@lru_cache(maxsize=RECURRENCE_CACHE_SIZE)
+def _series_timezone(name):
+    """Returns the timezone of a series, or None if it is unknown."""
+    from dateutil.tz import gettz
+
+    return gettz(name)
+
+
+def expand_recurrences(events, start_date, end_date, counters=None):
+    """
+    Expands series masters into their occurrences within the date range.
+
+    A series master has an "rrule" field with its RFC 5545 recurrence lines
+    (RRULE, RDATE and EXDATE, as a string or a list) or a bare RRULE value.
+    Its optional "exdate" field lists the starts of cancelled occurrences
+    in ISO format, and its optional "timezone" field the IANA timezone in
+    which the rules are evaluated, so that occurrences follow DST changes.
+    Only the occurrences starting within the date range are generated, and
+    the rules are evaluated from near the date range (see
+    _recurrence_start), so a long series only costs its occurrences in the
+    range. Parsed rules are cached per series. Other events are yielded
+    unchanged.
+
+    Args:
+        events (iterable): The EventRecords returned by the API.
+        start_date (datetime): The start date of the date range.
+        end_date (datetime): The end date of the date range.
+        counters (Counter): Incremented with the number of "series" expanded
+            and of "occurrences" generated, if given.
+
+    Yields:
+        EventRecord: Each event, or each occurrence of a series master.
+    """
+    for event in events:
+        rules = event.raw.get("rrule")
+        if not rules:
+            yield event
+            continue
+        if not isinstance(rules, str):
+            rules = "\n".join(rules)
+        dtstart = event.start
+        zone = (
+            _series_timezone(event.raw["timezone"])
+            if event.raw.get("timezone")
+            else None
+        )
+        if zone is not None:
+            dtstart = dtstart.astimezone(zone)
+        try:
+            occurrences = _recurrence_set(
+                rules, _recurrence_start(rules, dtstart, start_date)
+            ).between(start_date, end_date, inc=True)
+        except (ValueError, TypeError) as e:
+            logging.warning(
+                "Invalid recurrence of event %s (%s), exported as a single event",
+                event.summary,
+                str(e),
+            )
+            yield event
+            continue
+        cancelled = {
+            datetime.fromisoformat(start) for start in event.raw.get("exdate") or ()
+        }
+        duration = event.end - event.start
+        raw = {
+            key: value
+            for key, value in event.raw.items()
+            if key not in ("rrule", "exdate")
+        }
+        raw["is_recurring"] = True
+        if counters is not None:
+            counters["series"] += 1
+        for start in occurrences:
+            if start in cancelled:
+                continue
+            end = start + duration
+            if counters is not None:
+                counters["occurrences"] += 1
+            yield EventRecord._make(
+                (
+                    event.uid,
+                    event.summary,
+                    start,
+                    end,
+                    event.categories,
+                    {**raw, "start": start.isoformat(), "end": end.isoformat()},
+                )
+            )
+
+
+class PipelineMetrics:
+    """
+    Class representing the timing, volume and memory metrics of an export.
+
+    Stages are streamed: they run interleaved, so the memory of a stage
+    can't be isolated. Instead, the peak RSS of the process is recorded
+    when each stage finishes, and the growth of this high-water mark from
+    one stage to the next shows where the memory is allocated. The peak
+    RSS is the one of the whole process: it includes the other exports of
+    a batch running at the same time, but not the --workers processes.
+    """
+
+    STAGES = (
+        "network",
+        "decode",
+        "normalize",
+        "expand",
+        "cache",
+        "validate",
+        "parse",
+        "filter",
+        "index",
+        "ledger",
+        "write",
+    )
+
+    def __init__(self, name):
+        """
+        Initializes empty metrics.
+
+        Args:
+            name (str): The name of the export (the Salesforce user ID).
+        """
+        self.name = name
+        self.seconds = 0.0
+        self.stages = {}
+        self.counters = {}
+
+    def _stage(self, stage):
+        return self.stages.setdefault(
+            stage, {"seconds": 0.0, "items": 0, "bytes": 0, "peak_rss_bytes": None}
+        )
+
+    def track(self, stage, iterable, size=None):
+        """
+        Yields the items of iterable, measuring the time spent to produce them.
+
+        Args:
+            stage (str): The pipeline stage producing the items.
+            iterable (iterable): The items produced by the stage.
+            size (callable): Returns the size in bytes of an item, if any.
+
+        Yields:
+            object: Each item, unchanged.
+        """
+        stats = self._stage(stage)
+        iterator = iter(iterable)
+        clock = time.perf_counter
+        try:
+            while True:
+                started = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    stats["seconds"] += clock() - started
+                    return
+                stats["seconds"] += clock() - started
+                stats["items"] += 1
+                if size is not None:
+                    stats["bytes"] += size(item)
+                yield item
+        finally:
+            stats["peak_rss_bytes"] = _peak_rss_bytes()
+
+    def add(self, stage, seconds, items):
+        """Records the time spent by a stage which doesn't produce items one by one."""
+        stats = self._stage(stage)
+        stats["seconds"] += seconds
+        stats["items"] += items
+        stats["peak_rss_bytes"] = _peak_rss_bytes()
+
+    def report(self):
+        """
+        Returns the metrics as a dictionary.
+
+        Stages consume the items of the previous ones, so the time measured
+        for a stage includes theirs: the reported time of each stage only
+        counts its own work.
+
+        Returns:
+            dict: The metrics of the export.
+        """
+        stages = {}
+        upstream_seconds = 0.0
+        for stage in self.STAGES:
+            if stage in self.stages:
+                stats = self.stages[stage]
+                stages[stage] = {
+                    **stats,
+                    "seconds": max(stats["seconds"] - upstream_seconds, 0.0),
+                }
+                upstream_seconds = max(stats["seconds"], upstream_seconds)
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "stages": stages,
+            "counters": dict(self.counters),
+        }
+
+
+def _tracked(metrics, stage, iterable, size=None):
+    """Tracks a stage if metrics are recorded, or returns iterable unchanged."""
+    return iterable if metrics is None else metrics.track(stage, iterable, size)
+
+
+def _peak_rss_bytes():
+    """Returns the peak resident memory of the process, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write_metrics(filename, reports, prometheus=False):
+    """
+    Writes export metrics to a JSON file or to a Prometheus textfile.
+
+    Args:
+        filename (str): The path of the metrics file.
+        reports (list): The metrics of each export, see PipelineMetrics.report.
+        prometheus (bool): Whether to use the Prometheus text format.
+
+    Returns:
+        None
+    """
+    peak_rss = _peak_rss_bytes()
+    if prometheus:
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{_prometheus_escape(value)}"' for key, value in labels
+                )
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        metric(
+            "sfdc_export_seconds",
+            "Wall time of the export.",
+            [((("user", r["name"]),), r["seconds"]) for r in reports],
+        )
+        for field, help_text in (
+            ("seconds", "Time spent in each pipeline stage."),
+            ("items", "Items produced by each pipeline stage."),
+            (
+                "bytes",
+                "Bytes received by each pipeline stage, before decompression.",
+            ),
+        ):
+            metric(
+                f"sfdc_export_stage_{field}",
+                help_text,
+                [
+                    ((("user", r["name"]), ("stage", stage)), stats[field])
+                    for r in reports
+                    for stage, stats in r["stages"].items()
+                ],
+            )
+        metric(
+            "sfdc_export_events",
+            "Events counted by the export.",
+            [
+                ((("user", r["name"]), ("counter", counter)), value)
+                for r in reports
+                for counter, value in r["counters"].items()
+            ],
+        )
+        metric(
+            "sfdc_export_stage_peak_rss_bytes",
+            "Peak resident memory of the process when each pipeline stage finished.",
+            [
+                ((("user", r["name"]), ("stage", stage)), stats["peak_rss_bytes"])
+                for r in reports
+                for stage, stats in r["stages"].items()
+                if stats["peak_rss_bytes"] is not None
+            ],
+        )
+        if peak_rss is not None:
+            lines.append("# HELP sfdc_export_peak_rss_bytes Peak resident memory.")
+            lines.append("# TYPE sfdc_export_peak_rss_bytes gauge")
+            lines.append(f"sfdc_export_peak_rss_bytes {peak_rss}")
+        content = "\n".join(lines) + "\n"
+    else:
+        content = json.dumps(
+            {
+                "generated": datetime.now().astimezone().isoformat(),
+                "peak_rss_bytes": peak_rss,
+                "exports": reports,
+            },
+            indent=2,
+        )
+    tmp_filename = f"{filename}.part"
+    with open(tmp_filename, "w", encoding="utf-8") as metrics_file:
+        metrics_file.write(content)
+    os.replace(tmp_filename, filename)
+
+
+def _prometheus_escape(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 15
+DEFAULT_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Libraries sending the HTTP requests, see --http-client
+HTTP_CLIENTS = ("auto", "requests", "stdlib")
+STDLIB_ACCEPT_ENCODING = "gzip, deflate"
+DEFAULT_BATCH_WORKERS = 8
+DEFAULT_DAEMON_INTERVAL = 3600
+PAGE_PARAM = "page"
+TOTAL_PAGES_HEADER = "X-Total-Pages"
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Fields of the API events read by the export, see --include-fields
+# is_recurring tells ExportManifest the occurrences of a series from one-off events
+PROJECTED_FIELDS = (
+    "uid",
+    "summary",
+    "start",
+    "end",
+    "categories",
+    "is_recurring",
+) + RECURRENCE_FIELDS
+
+
+def iter_json_array(chunks, fields=None):
+    """
+    Incrementally decodes a JSON array and yields its items one at a time.
+
+    Only the item being decoded is kept in memory, so the size of the whole
+    array does not matter. When fields are given, the other fields of the
+    objects of the array are dropped as soon as each object is decoded, so
+    that they are never referenced by the following stages. A number, string
+    or literal is only yielded once the comma or bracket following it is
+    received, since a number ending a chunk may continue in the next one.
+
+    Args:
+        chunks (iterable): Text chunks which, concatenated, hold a JSON array.
+        fields (frozenset): The fields of the objects to keep, or None to
+            keep all of them.
+
+    Yields:
+        object: Each item of the array, in order.
+
+    Raises:
+        json.JSONDecodeError: If the data is not a JSON array or is truncated.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    # Whether the next token is a comma or the closing bracket, and whether
+    # the previous one was a comma
+    after_item = after_comma = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise json.JSONDecodeError("Expecting a JSON array", buffer, pos)
+                started = True
+                pos += 1
+                continue
+            if after_item:
+                if buffer[pos] == "]":
+                    return
+                if buffer[pos] != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                after_item, after_comma = False, True
+                pos += 1
+                continue
+            if buffer[pos] == "]" and not after_comma:
+                return
+            if buffer[pos] in ",]":
+                raise json.JSONDecodeError("Expecting value", buffer, pos)
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Item is not complete yet, wait for the next chunk
+            if not isinstance(item, (dict, list)):
+                # A number may continue in the next chunk (e.g. "1." then "5"):
+                # wait until a delimiter follows it
+                after = JSON_WHITESPACE.match(buffer, end).end()
+                if after == len(buffer) or (
+                    buffer[after] not in ",]"
+                    and buffer.find(",", after) < 0
+                    and buffer.find("]", after) < 0
+                ):
+                    break
+            pos = end
+            after_item, after_comma = True, False
+            if fields is not None and isinstance(item, dict):
+                item = {key: item[key] for key in fields if key in item}
+            yield item
+    raise json.JSONDecodeError("Unterminated JSON array", buffer, len(buffer))
+
+
+def parse_fields(text):
+    """
+    Parses the fields of the API events to decode, see --include-fields.
+
+    Args:
+        text (str): Comma separated fields of EventEntry.DETAIL_FIELDS to
+            decode on top of PROJECTED_FIELDS, or "all".
+
+    Returns:
+        frozenset: The fields to decode, or None to decode all of them.
+
+    Raises:
+        ValueError: If a field is unknown.
+    """
+    names = {name.strip() for name in text.split(",") if name.strip()}
+    if "all" in names:
+        return None
+    unknown = names - set(EventEntry.DETAIL_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}")
+    return frozenset(PROJECTED_FIELDS) | names
+
+
+def _iter_response_events(response, metrics=None, fields=None):
+    """Decodes the events of a streamed response one at a time."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = _tracked(
+        metrics,
+        "network",
+        response.iter_content(chunk_size=STREAM_CHUNK_SIZE),
+        _wire_bytes(response),
+    )
+    return _tracked(
+        metrics,
+        "decode",
+        iter_json_array((decoder.decode(chunk) for chunk in chunks), fields),
+    )
+
+
+def _wire_bytes(response):
+    """
+    Returns a function giving the bytes of response received on the wire
+    since its last call, to count the compressed size of the decompressed
+    chunks of iter_content.
+    """
+    received = 0
+
+    def size(chunk):
+        nonlocal received
+        previous, received = received, response.raw.tell()
+        return received - previous
+
+    return size
+
+
+class NotModified(Exception):
+    """Raised when a conditional request is answered with 304 Not Modified"""
+
+
+class HttpError(OSError):
+    """Raised when a request sent with http.client fails"""
+
+
+def request_errors():
+    """
+    Returns the exceptions raised by failed requests.
+
+    requests is only imported by the clients using it, so its exceptions
+    can only be raised, and are only caught, once it is loaded.
+    """
+    requests = sys.modules.get("requests")
+    if requests is None:
+        return (HttpError,)
+    return (HttpError, requests.exceptions.RequestException)
+
+
+class StdlibResponse:
+    """Class representing a response received with http.client, with the
+    part of the requests.Response interface used by the export"""
+
+    def __init__(self, session, key, connection, response, url, stream=False):
+        """
+        Initializes the response, and reads its body unless it is streamed.
+
+        Args:
+            session (StdlibSession): The session owning the connection.
+            key (tuple): The key of the connection in the session pool.
+            connection (http.client.HTTPConnection): The connection to give
+                back to the session once the body is read.
+            response (http.client.HTTPResponse): The response to wrap.
+            url (str): The requested URL.
+            stream (bool): Whether to stream the response body.
+        """
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = url
+        self._session = session
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._content = None
+        self._received = 0
+        if not stream:
+            self._content = self.content
+
+    @property
+    def content(self):
+        """The decompressed body of the response."""
+        if self._content is None:
+            self._content = b"".join(self.iter_content(STREAM_CHUNK_SIZE))
+        return self._content
+
+    def iter_content(self, chunk_size=1):
+        """
+        Reads the body of the response in chunks.
+
+        Args:
+            chunk_size (int): The size of the chunks read from the connection.
+
+        Yields:
+            bytes: Each chunk of the body, decompressed.
+
+        Raises:
+            HttpError: If the body can't be read or decompressed.
+        """
+        import http.client
+
+        if self._content is not None:
+            yield self._content
+            return
+        decoder = None
+        if self.headers.get("Content-Encoding", "").strip().lower() in (
+            "gzip",
+            "deflate",
+        ):
+            # Detects both the gzip and the zlib headers
+            decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        try:
+            while True:
+                chunk = self._response.read(chunk_size)
+                if not chunk:
+                    break
+                self._received += len(chunk)
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decoder is not None:
+                chunk = decoder.flush()
+                if chunk:
+                    yield chunk
+        except (OSError, http.client.HTTPException, zlib.error) as e:
+            raise HttpError(f"Failed to read the response of {self.url}: {e}") from e
+        finally:
+            self.close()
+
+    @property
+    def raw(self):
+        """The response itself, whose tell method is the one of urllib3."""
+        return self
+
+    def tell(self):
+        """Returns the bytes of the body read from the connection, before
+        decompression."""
+        return self._received
+
+    def json(self):
+        """Returns the decoded JSON body of the response."""
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """
+        Raises an HttpError if the response status is an error.
+
+        Raises:
+            HttpError: If the status code is 4xx or 5xx.
+        """
+        if 400 <= self.status_code < 600:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise HttpError(
+                f"{self.status_code} {kind} Error: {self.reason} for url: {self.url}"
+            )
+
+    def close(self):
+        """
+        Closes the response. Its connection is kept open for the next
+        requests if the body was fully read and the server allows it.
+        """
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._session.release(self._key, connection)
+        else:
+            self._response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StdlibSession:
+    """Class representing a pool of keep-alive connections sending requests
+    with http.client, with the part of the requests.Session interface used
+    by HttpClient"""
+
+    def __init__(self, pool_size=DEFAULT_FETCH_WORKERS):
+        """
+        Initializes an empty pool.
+
+        Args:
+            pool_size (int): Idle connections kept open per host.
+        """
+        self.pool_size = pool_size
+        self.headers = {"Accept": "*/*", "Accept-Encoding": STDLIB_ACCEPT_ENCODING}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, key, timeout):
+        """Opens a new connection to the host of key."""
+        import http.client
+
+        scheme, host, port, verify = key
+        if scheme == "https":
+            import ssl
+
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            connection = http.client.HTTPSConnection(
+                host, port, timeout=timeout[0], context=context
+            )
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout[0])
+        connection.connect()
+        return connection
+
+    def release(self, key, connection):
+        """Keeps a connection whose response was fully read for the next requests."""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(
+        self,
+        method,
+        url,
+        params=None,
+        headers=None,
+        timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+        verify=True,
+        stream=False,
+        data=None,
+        json=None,
+    ):
+        """
+        Sends a request once, on an idle connection to the host if any.
+
+        A request failing on an idle connection closed by the server is sent
+        again on a new connection.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The requested URL.
+            params (dict): The query parameters, if any.
+            headers (dict): Additional request headers, if any.
+            timeout (tuple): The connect and read timeouts, in seconds.
+            verify (bool): Whether to verify the TLS certificate.
+            stream (bool): Whether to stream the response body.
+            data (bytes): The request body, if any.
+            json (object): The request body, encoded to JSON, if any.
+
+        Returns:
+            StdlibResponse: The response, whose status is not checked.
+
+        Raises:
+            HttpError: If the connection or the request fails.
+        """
+        import http.client
+        from json import dumps
+        from urllib.parse import urlencode, urlsplit
+
+        if json is not None:
+            data = dumps(json).encode("utf-8")
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        parts = urlsplit(url)
+        if params:
+            url = f"{url}{'&' if parts.query else '?'}{urlencode(params)}"
+            parts = urlsplit(url)
+        target = (
+            f"{parts.path or '/'}?{parts.query}" if parts.query else parts.path or "/"
+        )
+        key = (parts.scheme, parts.hostname, parts.port, verify)
+        headers = {**self.headers, **(headers or {})}
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                connection = idle.pop() if idle else None
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self._connect(key, timeout)
+                connection.sock.settimeout(timeout[1])
+                connection.request(method, target, body=data, headers=headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                if connection is not None:
+                    connection.close()
+                if reused and isinstance(
+                    e,
+                    (
+                        http.client.RemoteDisconnected,
+                        ConnectionResetError,
+                        BrokenPipeError,
+                    ),
+                ):
+                    continue
+                raise HttpError(f"{method} request to {url} failed: {e}") from e
+            return StdlibResponse(self, key, connection, response, url, stream)
+
+    def get(self, url, **kwargs):
+        """Sends a GET request once, see request."""
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class HttpClient:
+    """Class representing a pooled HTTP client with timeouts and retries"""
+
+    # Transient statuses retried like connection errors
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        pool_size=DEFAULT_FETCH_WORKERS,
+        library="auto",
+    ):
+        """
+        Initializes the client and its connection pool.
+
+        Requests are sent with requests, or with http.client when library is
+        "stdlib" (or "auto" and requests is not installed), which starts
+        faster as neither requests nor urllib3 are imported.
+
+        Responses are requested compressed with every encoding urllib3 can
+        decode (gzip and deflate, plus br when brotli is installed), or with
+        gzip and deflate with http.client.
+
+        Args:
+            connect_timeout (float): Seconds to wait for a connection.
+            read_timeout (float): Seconds to wait for data from the server.
+            retries (int): Times a failed GET request is sent again.
+            pool_size (int): Connections kept open per host.
+            library (str): The library sending requests, see HTTP_CLIENTS.
+        """
+        requests = None
+        if library != "stdlib":
+            try:
+                import requests
+            except ImportError:
+                if library == "requests":
+                    raise
+        if requests is None:
+            self.session = StdlibSession(pool_size)
+            self.transient_errors = (HttpError,)
+        else:
+            from urllib3.util.request import ACCEPT_ENCODING
+
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+            self.transient_errors = (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            )
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+
+    @classmethod
+    def from_args(cls, args, pool_size=DEFAULT_FETCH_WORKERS):
+        """Returns a client configured by the command line options."""
+        return cls(
+            args.connect_timeout,
+            args.read_timeout,
+            args.retries,
+            pool_size,
+            args.http_client,
+        )
+
+    def close(self):
+        """Closes the pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, url, params=None, headers=None, stream=False, verify=True):
+        """
+        Sends a GET request, retrying connection errors, timeouts and
+        transient statuses with a jittered exponential backoff.
+
+        Only sending the request and receiving its headers are retried: a
+        streamed body interrupted while it is read is not. A Retry-After
+        header is honoured up to RETRY_MAX_DELAY seconds.
+
+        Args:
+            url (str): The requested URL.
+            params (dict): The query parameters, if any.
+            headers (dict): Additional request headers, if any.
+            stream (bool): Whether to stream the response body.
+            verify (bool): Whether to verify the TLS certificate.
+
+        Returns:
+            requests.Response: The response (a StdlibResponse with
+                http.client), whose status is not checked.
+
+        Raises:
+            requests.exceptions.RequestException: If the last attempt fails
+                (an HttpError with http.client).
+        """
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                response = self.session.get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=self.timeout,
+                    verify=verify,
+                    stream=stream,
+                )
+            except self.transient_errors as e:
+                if attempt == self.retries:
+                    raise
+                error = str(e)
+            else:
+                if (
+                    response.status_code not in self.RETRY_STATUSES
+                    or attempt == self.retries
+                ):
+                    return response
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+            delay = random.uniform(
+                0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+            )
+            if retry_after and retry_after.isdigit():
+                # A server asking to wait longer doesn't stall the export
+                delay = max(delay, min(float(retry_after), RETRY_MAX_DELAY))
+            logging.warning(
+                "Request to %s failed (%s), retrying in %.1f seconds", url, error, delay
+            )
+            time.sleep(delay)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """
+        Sends a request once, without retry.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The requested URL.
+            timeout (float): The read timeout, if not the default one.
+            **kwargs: The other arguments of requests.Session.request.
+
+        Returns:
+            requests.Response: The response (a StdlibResponse with
+                http.client), whose status is not checked.
+        """
+        if timeout is not None:
+            timeout = (self.timeout[0], timeout)
+        return self.session.request(
+            method, url, timeout=timeout or self.timeout, **kwargs
+        )
+
+
+def _request_events(url, params, client, fallback=True, headers=None):
+    """
+    Sends a streamed GET request for events.
+
+    If fallback is set and the API rejects the query parameters, the request
+    is sent again without them, and the full calendar is returned instead.
+
+    Returns:
+        tuple: The response, with its status already checked, and the query
+            parameters it was actually sent with.
+    """
+    response = client.get(url, params, headers, stream=True, verify=False)
+    if fallback and params and response.status_code in (400, 422):
+        logging.warning(
+            "API rejected query parameters %s (HTTP %d), fetching all events",
+            params,
+            response.status_code,
+        )
+        response.close()
+        params = {}
+        response = client.get(url, headers=headers, stream=True, verify=False)
+    try:
+        response.raise_for_status()  # Raise an exception for non-200 status codes
+    except request_errors():
+        response.close()
+        raise
+    return response, params
+
+
+def _fetch_page(url, params, page, client, metrics=None, fields=None):
+    """Fetches one page of events and returns them as a list."""
+    response, _ = _request_events(url, {**params, PAGE_PARAM: page}, client, False)
+    with response:
+        return list(_iter_response_events(response, metrics, fields))
+
+
+def fetch_events(
+    url,
+    start_date=None,
+    end_date=None,
+    workers=DEFAULT_FETCH_WORKERS,
+    client=None,
+    metrics=None,
+    validators=None,
+    fields=None,
+):
+    """
+    Fetches events from url and returns them as an iterator.
+
+    The response is read in chunks and decoded incrementally, so events
+    are available as soon as they are received and the whole payload is
+    never held in memory.
+
+    When a date range is given, it is sent to the API so that it can only
+    return the matching events. APIs ignoring these parameters return the
+    whole calendar, which is then filtered locally by validate_events_timing.
+    If the API paginates its results (announced by the X-Total-Pages header),
+    the following pages are fetched concurrently while the first one is
+    decoded, and events are still yielded in page order.
+
+    The first request is sent before returning, so that a conditional
+    request answered with 304 Not Modified can be handled by the caller.
+
+    Args:
+        url (str): The URL of the events endpoint.
+        start_date (datetime): The start date of the date range.
+        end_date (datetime): The end date of the date range.
+        workers (int): The maximum number of pages fetched concurrently.
+        client (HttpClient): The client used to send requests.
+        metrics (PipelineMetrics): Records the network and decode stages, if any.
+        validators (dict): The ETag and Last-Modified of a previous response,
+            sent as a conditional request, if any. Updated with the ones of
+            the new response.
+        fields (frozenset): The fields of the events to decode, or None to
+            decode all of them.
+
+    Returns:
+        iterator: The events returned by the API, as dictionaries.
+
+    Raises:
+        NotModified: If the events didn't change since validators were returned.
+        requests.exceptions.RequestException: If the request fails or the
+            response status code is not 200 (an HttpError with http.client).
+        json.JSONDecodeError: If the response is not a valid JSON array.
+    """
+    params = {}
+    if start_date is not None and end_date is not None:
+        params = {"start": start_date.isoformat(), "end": end_date.isoformat()}
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    response, params = _request_events(url, params, client, headers=headers)
+    if response.status_code == 304:
+        response.close()
+        raise NotModified(url)
+    if validators is not None:
+        validators.clear()
+        validators.update(
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+    return _iter_events(response, url, params, workers, client, metrics, fields)
+
+
+def _iter_events(response, url, params, workers, client, metrics, fields):
+    """Yields the events of response and of the following pages, if any."""
+    with response:
+        total_pages = int(response.headers.get(TOTAL_PAGES_HEADER, 1))
+        if total_pages <= 1:
+            yield from _iter_response_events(response, metrics, fields)
+            return
+        logging.info(
+            "Fetching %d pages of events with %d workers", total_pages, workers
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            next_page = 2
+            while next_page <= total_pages and len(pending) < workers:
+                pending.append(
+                    executor.submit(
+                        _fetch_page, url, params, next_page, client, metrics, fields
+                    )
+                )
+                next_page += 1
+            yield from _iter_response_events(response, metrics, fields)
+            while pending:
+                page_events = pending.popleft().result()
+                if next_page <= total_pages:
+                    pending.append(
+                        executor.submit(
+                            _fetch_page,
+                            url,
+                            params,
+                            next_page,
+                            client,
+                            metrics,
+                            fields,
+                        )
+                    )
+                    next_page += 1
+                yield from page_events
+
+
+def fetch_validator(url, client):
+    """
+    Fetches the JCALAPI metadata used to detect calendar changes.
+
+    Args:
+        url (str): The URL of the metadata endpoint.
+        client (HttpClient): The client used to send requests.
+
+    Returns:
+        str: A canonical representation of the metadata.
+        None: If the request fails.
+    """
+    try:
+        response = client.get(url, verify=False)
+        response.raise_for_status()
+        return json.dumps(response.json(), sort_keys=True)
+    except (*request_errors(), ValueError) as e:
+        logging.warning("Failed to retrieve metadata from %s: %s", url, str(e))
+        return None
+
+
+class EventCache:
+    """Class representing a local SQLite store of events"""
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        """
+        Opens (and creates if needed) the event store.
+
+        Events are keyed on their uid and start (occurrences of a recurring
+        event share the same uid) and indexed on their start time.
+
+        Args:
+            path (str): The path of the SQLite database file.
+        """
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            if self.get_meta("schema_version") != str(self.SCHEMA_VERSION):
+                self.connection.execute("DROP TABLE IF EXISTS events")
+                self.connection.execute("DELETE FROM meta")
+                self.set_meta("schema_version", self.SCHEMA_VERSION)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS events (
+                    uid TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    start_ts REAL NOT NULL,
+                    end_ts REAL NOT NULL,
+                    categories TEXT,
+                    generation INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    PRIMARY KEY (uid, start)
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_start_ts ON events (start_ts)"
+            )
+
+    def close(self):
+        """Closes the event store."""
+        self.connection.close()
+
+    def get_meta(self, key):
+        """Returns the value stored for key, or None."""
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        """Stores value for key."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    def clear(self):
+        """Removes all cached events."""
+        with self.connection:
+            self.connection.execute("DELETE FROM events")
+            self.connection.execute(
+                "DELETE FROM meta WHERE key IN ('validator', 'coverage')"
+                " OR key LIKE 'http:%'"
+            )
+
+    def get_http_validators(self, request):
+        """
+        Returns the ETag and Last-Modified of the last complete response to
+        request, as stored by store.
+
+        Args:
+            request (str): The URL and date range of the request.
+
+        Returns:
+            dict: The validators, empty if unknown.
+        """
+        return json.loads(self.get_meta(f"http:{request}") or "{}")
+
+    def covers(self, start_date, end_date, validator):
+        """
+        Checks whether the date range can be answered from the store.
+
+        Args:
+            start_date (datetime): The start date of the date range.
+            end_date (datetime): The end date of the date range.
+            validator (str): The current JCALAPI metadata.
+
+        Returns:
+            bool: True if the range was synchronized with the same metadata.
+        """
+        if validator is None or self.get_meta("validator") != validator:
+            return False
+        start_ts, end_ts = start_date.timestamp(), end_date.timestamp()
+        return any(
+            low <= start_ts and end_ts <= high
+            for low, high in json.loads(self.get_meta("coverage") or "[]")
+        )
+
+    def query(self, start_date, end_date):
+        """
+        Yields the cached events within the date range, ordered by start.
+
+        Args:
+            start_date (datetime): The start date of the date range.
+            end_date (datetime): The end date of the date range.
+
+        Yields:
+            EventRecord: Each cached event.
+        """
+        cursor = self.connection.execute(
+            "SELECT event FROM events WHERE start_ts BETWEEN ? AND ? AND end_ts <= ?"
+            " ORDER BY start_ts",
+            (start_date.timestamp(), end_date.timestamp(), end_date.timestamp()),
+        )
+        return normalize_events(json.loads(event) for (event,) in cursor)
+
+    def store(
+        self,
+        events,
+        start_date,
+        end_date,
+        validator,
+        request=None,
+        http_validators=None,
+    ):
+        """
+        Stores events in the cache while yielding them.
+
+        Once all events are consumed, cached events of the date range which
+        were not returned again are removed, and the range is recorded as
+        synchronized. If the events are not fully consumed, nothing is kept.
+
+        Args:
+            events (iterable): The EventRecords fetched for the date range.
+            start_date (datetime): The start date of the date range.
+            end_date (datetime): The end date of the date range.
+            validator (str): The JCALAPI metadata the events were fetched with.
+            request (str): The URL and date range of the request, if any.
+            http_validators (dict): The ETag and Last-Modified of the response
+                to request, read once all events are consumed.
+
+        Yields:
+            EventRecord: Each event, unchanged.
+        """
+        generation = int(self.get_meta("generation") or 0) + 1
+        start_ts, end_ts = start_date.timestamp(), end_date.timestamp()
+        with self.connection:
+            for event in events:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        event.uid,
+                        event.raw["start"],
+                        event.start.timestamp(),
+                        event.end.timestamp(),
+                        json.dumps(event.categories),
+                        generation,
+                        json.dumps(event.raw),
+                    ),
+                )
+                yield event
+            self.connection.execute(
+                "DELETE FROM events WHERE generation != ?"
+                " AND start_ts BETWEEN ? AND ? AND end_ts <= ?",
+                (generation, start_ts, end_ts, end_ts),
+            )
+            coverage = []
+            if self.get_meta("validator") == validator:
+                coverage = json.loads(self.get_meta("coverage") or "[]")
+            self.set_meta(
+                "coverage", json.dumps(_merge_ranges(coverage, start_ts, end_ts))
+            )
+            self.set_meta("validator", validator)
+            self.set_meta("generation", generation)
+            if request is not None:
+                self.set_meta(f"http:{request}", json.dumps(http_validators or {}))
+
+
+def _merge_ranges(ranges, low, high):
+    """Adds the range [low, high] to a list of ranges, merging overlaps."""
+    merged = []
+    for range_low, range_high in sorted([*ranges, [low, high]]):
+        if merged and range_low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_high)
+        else:
+            merged.append([range_low, range_high])
+    return merged
+
+
+class CalendarState:
+    """Class representing the events of a calendar kept in memory by the
+    daemon between its runs"""
+
+    def __init__(self):
+        """
+        Creates an empty state: the first run fetches all events.
+
+        The events of the last complete response are kept with its request
+        and its ETag and Last-Modified, and each output with the digest of
+        the events it was last exported with, as well as the time report of
+        the last export.
+        """
+        self.request = None
+        self.http_validators = {}
+        self.records = []
+        self.exported = {}
+        self.report = None
+
+    def get_http_validators(self, request):
+        """
+        Returns the ETag and Last-Modified of the events kept, as a copy
+        updated by fetch_events.
+
+        Args:
+            request (str): The URL and date range of the request.
+
+        Returns:
+            dict: The validators, empty if the events kept were fetched
+                with another request.
+        """
+        return dict(self.http_validators) if request == self.request else {}
+
+    def store(self, events, request, http_validators):
+        """
+        Keeps events in memory while yielding them.
+
+        The events replace the ones kept once they are all consumed; if
+        they are not, the previous events are kept.
+
+        Args:
+            events (iterable): The EventRecords fetched for request.
+            request (str): The URL and date range of the request.
+            http_validators (dict): The ETag and Last-Modified of the response,
+                read once all events are consumed.
+
+        Yields:
+            EventRecord: Each event, unchanged.
+        """
+        records = []
+        for event in events:
+            records.append(event)
+            yield event
+        self.request = request
+        self.http_validators = http_validators
+        self.records = records
+
+    @staticmethod
+    def digest(records, start_date, end_date):
+        """
+        Returns the hash of the records within a date range.
+
+        Args:
+            records (list): The EventRecords of the calendar.
+            start_date (datetime): The start date of the date range.
+            end_date (datetime): The end date of the date range.
+
+        Returns:
+            str: The hash of the uid, summary, dates and categories of the
+                records, in their order.
+        """
+        digest = hashlib.sha256()
+        for record in records:
+            if (
+                start_date <= record.start <= end_date
+                and start_date <= record.end <= end_date
+            ):
+                digest.update(
+                    repr(
+                        (
+                            record.uid,
+                            record.summary,
+                            record.start.isoformat(),
+                            record.end.isoformat(),
+                            record.categories,
+                            record.raw.get("is_recurring"),
+                        )
+                    ).encode("utf-8")
+                )
+        return digest.hexdigest()
+
+
+class ExportManifest:
+    """Class representing the events already exported, stored in SQLite"""
+
+    CHANGED_COMMENT = (
+        "Event changed since its last export. "
+        "Please update or delete the previously imported task."
+    )
+
+    def __init__(self, path):
+        """
+        Opens (and creates if needed) the export manifest.
+
+        Exported events are recorded with the Salesforce user ID, their uid
+        and start, and the hash of their CSV row. One-off events are keyed
+        on their uid, so that a moved event is reported as changed, and the
+        occurrences of a recurring series, which share the uid of the
+        series, on their uid and start.
+
+        Args:
+            path (str): The path of the SQLite database file.
+        """
+        # Exports of a batch share the manifest and commit concurrently
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.skipped = 0
+        self.pending = {}
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS exported (
+                    owner TEXT NOT NULL,
+                    uid TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    exported_at TEXT NOT NULL,
+                    PRIMARY KEY (owner, uid, start)
+                )""")
+
+    def close(self):
+        """Closes the manifest. Events selected but not committed are not recorded."""
+        self.connection.close()
+
+    @classmethod
+    def _digest(cls, row):
+        """Returns the hash of a CSV row, ignoring the comment added by select."""
+        values = [str(value) for value in row]
+        suffix = f" // {cls.CHANGED_COMMENT}"
+        if values[-1].endswith(suffix):
+            values[-1] = values[-1][: -len(suffix)]
+        return hashlib.sha256("\x1f".join(values).encode("utf-8")).hexdigest()
+
+    def retain(self, rows):
+        """
+        Forgets the selected events except the ones finally exported.
+
+        Args:
+            rows (iterable): The CSV rows of the exported events, as yielded
+                by select.
+        """
+        digests = {self._digest(row) for row in rows}
+        for key, (_, digest, _) in list(self.pending.items()):
+            if digest not in digests:
+                del self.pending[key]
+
+    def commit(self):
+        """Records the events selected since the last commit as exported."""
+        with self.connection:
+            # A one-off event replaces its record at its previous start
+            self.connection.executemany(
+                "DELETE FROM exported WHERE owner = ? AND uid = ?",
+                (key for key in self.pending if len(key) == 2),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?, ?)",
+                (
+                    (*key[:2], start, digest, exported_at)
+                    for key, (start, digest, exported_at) in self.pending.items()
+                ),
+            )
+        self.pending.clear()
+
+    def _previous(self, key):
+        """Returns the hashes recorded for the event of key."""
+        pending = self.pending.get(key)
+        if pending:
+            return {pending[1]}
+        if len(key) == 2:
+            query = "SELECT hash FROM exported WHERE owner = ? AND uid = ?"
+        else:
+            query = (
+                "SELECT hash FROM exported WHERE owner = ? AND uid = ? AND start = ?"
+            )
+        return {digest for (digest,) in self.connection.execute(query, key)}
+
+    def select(self, owner, entries):
+        """
+        Yields the rows of the events which are new or changed.
+
+        A changed event, including a one-off event moved to another start,
+        gets a comment asking to update the task imported by its previous
+        export. Selected events are recorded in the manifest when commit is
+        called.
+
+        Args:
+            owner (str): The Salesforce user ID.
+            entries (iterable): The (EventEntry, CSV row) of each event.
+
+        Yields:
+            list: The CSV row of each new or changed event.
+        """
+        exported_at = datetime.now(timezone.utc).isoformat()
+        for event, row in entries:
+            start = event.start.isoformat()
+            if event.is_recurring:
+                key = (owner, event.uid, start)
+            else:
+                key = (owner, event.uid)
+            digest = self._digest(row)
+            previous = self._previous(key)
+            if digest in previous:
+                self.skipped += 1
+                continue
+            self.pending[key] = (start, digest, exported_at)
+            if previous:
+                row[-1] = f"{row[-1]} // {self.CHANGED_COMMENT}"
+            yield row
+
+
+def validate_events_timing(events, start_date, end_date, counters):
+    """
+    Validates the timing of events based on the given start and end dates.
+
+    Args:
+        events (iterable): The EventRecords to be validated.
+        start_date (datetime): The start date of the date range.
+        end_date (datetime): The end date of the date range.
+        counters (Counter): Incremented with the number of events "collected",
+            "in_range" and "excluded_out_of_range".
+
+    Yields:
+        EventRecord: Each valid event that falls within the specified date range.
+    """
+    logging.info(
+        "Validating if events are within the date range %s - %s", start_date, end_date
+    )
+    debug = EVENT_LOGGER.isEnabledFor(logging.DEBUG)
+    for event in events:
+        counters["collected"] += 1
+        if (
+            start_date <= event.start <= end_date
+            and start_date <= event.end <= end_date
+        ):
+            counters["in_range"] += 1
+            yield event
+            if debug:
+                EVENT_LOGGER.debug(
+                    "INCLUDED - Event %s at %s is within the date range",
+                    event.summary,
+                    event.start,
+                )
+        else:
+            counters["excluded_out_of_range"] += 1
+            if debug:
+                EVENT_LOGGER.debug(
+                    "EXCLUDED - Event %s at %s is NOT within the date range",
+                    event.summary,
+                    event.start,
+                )
+
+
+def filter_events(events, counters):
+    """
+    Filters events based on certain criteria.
+
+    Args:
+        events (iterable): The events to be filtered.
+        counters (Counter): Incremented with the number of events "filtered",
+            "valid", "excluded_no_duration" and "excluded_no_subject".
+
+    Yields:
+        EventEntry: Each event matching the criteria.
+    """
+    logging.info("Filtering events based on duration > 0 and subject is defined")
+    debug = EVENT_LOGGER.isEnabledFor(logging.DEBUG)
+    for event in events:
+        counters["filtered"] += 1
+        if event.duration_hours > 0 and event.subject:
+            if debug:
+                EVENT_LOGGER.debug(
+                    "INCLUDED - Event %s at %s match the criteria",
+                    event.summary,
+                    event.start,
+                )
+            counters["valid"] += 1
+            yield event
+        else:
+            if event.duration_hours <= 0:
+                counters["excluded_no_duration"] += 1
+            else:
+                counters["excluded_no_subject"] += 1
+            if debug:
+                EVENT_LOGGER.debug(
+                    "EXCLUDED - Event %s at %s does not match the criteria",
+                    event.summary,
+                    event.start,
+                )
+    logging.info(
+        "%d events are valid (matching duration > 0 and subject is defined) on %d events",  # noqa: E501
+        counters["valid"],
+        counters["filtered"],
+    )
+
+
+DEFAULT_WORKERS = 1
+# Shards are cut at month or week boundaries once they hold this many events
+SHARD_MIN_EVENTS = 1000
+SHARD_KEYS = {
+    "month": lambda start: (start.year, start.month),
+    "week": lambda start: start.isocalendar()[:2],
+}
+_shard_classifiers = {}
+
+
+def _parse_shard(
+    events, rules, max_hours_by_day, morning_hour, evening_hour, export_all
+):
+    """
+    Parses and filters a shard of events, in a worker process.
+
+    Only INFO and more severe messages are logged: the messages written
+    for each event are only logged by serial exports.
+
+    Args:
+        events (list): The (uid, summary, start, end, categories, is_recurring)
+            of each event.
+        rules (tuple): The subjects, the prefixes and the index specification
+            of the classifier.
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+        export_all (bool): Whether to keep the events filter_events excludes.
+
+    Returns:
+        tuple: The EventColumns of the events kept, and the Counter of
+            filter_events.
+    """
+    logging.disable(logging.INFO)
+    if rules not in _shard_classifiers:
+        subjects, prefixes, index_spec = rules
+        index = SalesforceIndex.open(*index_spec) if index_spec else None
+        _shard_classifiers[rules] = CategoryClassifier(subjects, dict(prefixes), index)
+    classifier = _shard_classifiers[rules]
+    counters = Counter()
+    entries = (
+        EventEntry.from_record(
+            EventRecord(*event[:5], {"is_recurring": event[5]}),
+            max_hours_by_day,
+            morning_hour,
+            evening_hour,
+            classifier,
+        )
+        for event in events
+    )
+    if not export_all:
+        entries = filter_events(entries, counters)
+    return EventColumns(entries), counters
+
+
+def _worker_pool(workers):
+    """
+    Returns a pool of worker processes, see --workers.
+
+    Workers are started lazily, once the fetch and batch threads run: they
+    are started by a fork server (or spawned where fork servers are not
+    available) rather than forked from the export, which could copy a lock
+    held by one of these threads into the worker.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(method)
+    )
+
+
+def parse_events_sharded(
+    events,
+    executor,
+    workers,
+    shard_by,
+    max_hours_by_day,
+    morning_hour,
+    evening_hour,
+    classifier=None,
+    export_all=False,
+    counters=None,
+):
+    """
+    Parses and filters events in worker processes, shard by shard.
+
+    Events are cut into shards of consecutive events, at the month (or
+    week) boundaries, and only the fields used by the export are sent to
+    the workers. Shards are returned in order, so events are yielded in
+    the order of the serial export and the output is identical. At most
+    twice as many shards as workers are in flight.
+
+    Args:
+        events (iterable): The EventRecords within the date range.
+        executor (ProcessPoolExecutor): The pool of worker processes.
+        workers (int): The number of worker processes.
+        shard_by (str): "month" or "week".
+        max_hours_by_day (int): The maximum number of hours allowed per day.
+        morning_hour (int): The start hour of the day.
+        evening_hour (int): The end hour of the day.
+        classifier (CategoryClassifier): The classifier of the categories.
+        export_all (bool): Whether to keep the events filter_events excludes.
+        counters (Counter): Incremented like filter_events does, if given.
+
+    Yields:
+        EventColumns.Row: Each event kept, with its duration and categories.
+    """
+    classifier = classifier or CategoryClassifier.default()
+    rules = (
+        tuple(sorted(classifier.subjects)),
+        tuple(sorted(classifier.prefixes.items())),
+        classifier.index.spec() if classifier.index else None,
+    )
+    shard_key = SHARD_KEYS[shard_by]
+    counters = Counter() if counters is None else counters
+    pending = deque()
+    logging.info("Parsing events by %s in %d processes", shard_by, workers)
+
+    def submit(shard):
+        pending.append(
+            executor.submit(
+                _parse_shard,
+                shard,
+                rules,
+                max_hours_by_day,
+                morning_hour,
+                evening_hour,
+                export_all,
+            )
+        )
+
+    def completed(limit):
+        while len(pending) > limit:
+            columns, shard_counters = pending.popleft().result()
+            counters.update(shard_counters)
+            yield from columns
+
+    shard = []
+    key = None
+    for event in events:
+        event_key = shard_key(event.start)
+        if event_key != key and len(shard) >= SHARD_MIN_EVENTS:
+            submit(shard)
+            shard = []
+            yield from completed(2 * workers)
+        key = event_key
+        shard.append((*event[:5], event.raw.get("is_recurring")))
+    if shard:
+        submit(shard)
+    yield from completed(0)
+    if not export_all:
+        logging.info(
+            "%d events are valid (matching duration > 0 and subject is defined) on %d events",  # noqa: E501
+            counters["valid"],
+            counters["filtered"],
+        )
+
+
+CSV_PART_BUFFER_SIZE = 1024 * 1024
+BULK_API_VERSION = "v59.0"
+ACCESS_TOKEN_ENV = "SFDC_ACCESS_TOKEN"
+INSTANCE_URL_ENV = "SFDC_INSTANCE_URL"
+DEFAULT_BULK_WORKERS = 4
+DEFAULT_BULK_BATCH_ROWS = 10000
+# Salesforce accepts up to 150 MB of base64-encoded data per job
+BULK_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+BULK_REQUEST_TIMEOUT = 120
+BULK_POLL_INITIAL_DELAY = 1.0
+BULK_POLL_MAX_DELAY = 30.0
+BULK_POLL_TIMEOUT = 3600
+CSV_HEADER = [
+    "OwnerId",
+    "ActivityDate",
+    "WhatId",
+    "Status",
+    "Subject",
+    "Time_Spent_hrs__c",
+    "Comments",
+]
+
+
+def write_events_to_csv(
+    sfdc_user_id,
+    events,
+    filename,
+    max_hours_by_day,
+    manifest=None,
+    chunk_rows=None,
+    chunk_bytes=None,
+    compress=False,
+):
+    """
+    Write events to a CSV file.
+
+    Events are written as they are produced. The file is first written next
+    to its final location and only renamed once complete, so a failure while
+    events are streamed never leaves a truncated export behind.
+
+    When chunk_rows, chunk_bytes or compress is set, events are split into
+    parts instead (see write_csv_parts).
+
+    Args:
+        sfdc_user_id (str): The Salesforce user ID.
+        events (iterable): Events to write.
+        filename (str): Name of the CSV file.
+        max_hours_by_day (int): Maximum number of hours allowed per day.
+        manifest (ExportManifest): If set, only the events which are new or
+            changed since their last export are written, and the manifest is
+            updated once the file is complete.
+        chunk_rows (int): Maximum number of rows of each part, if any.
+        chunk_bytes (int): Maximum uncompressed size of each part, if any.
+        compress (bool): Whether to gzip each part.
+
+    Returns:
+        int: The number of events written.
+    """
+    entries = (
+        (event, _event_row(sfdc_user_id, event, max_hours_by_day)) for event in events
+    )
+    if manifest:
+        rows = manifest.select(sfdc_user_id, entries)
+    else:
+        rows = (row for _, row in entries)
+    if chunk_rows or chunk_bytes or compress:
+        count = write_csv_parts(rows, filename, chunk_rows, chunk_bytes, compress)
+    else:
+        tmp_filename = f"{filename}.part"
+        try:
+            count = _write_rows(rows, tmp_filename)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        logging.info(f"{count} events exported to {filename}")
+    if manifest:
+        manifest.commit()
+        logging.info(
+            f"{manifest.skipped} events unchanged since their last export are skipped"
+        )
+    return count
+
+
+def _write_rows(rows, filename):
+    """Writes the CSV header and rows to filename and returns the number of rows."""
+    count = 0
+    with open(filename, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(CSV_HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_csv_parts(rows, filename, chunk_rows=None, chunk_bytes=None, compress=False):
+    """
+    Writes CSV rows to numbered parts and lists them in a JSON manifest.
+
+    The parts of export.csv are export-0001.csv, export-0002.csv... (with a
+    .gz suffix when compressed), each with the CSV header, and the manifest
+    is export.manifest.json. A new part is started before a row which would
+    exceed chunk_rows or chunk_bytes. Parts are renamed to their final names
+    and the manifest is written only once all rows are written.
+
+    Args:
+        rows (iterable): The CSV rows, following CSV_HEADER.
+        filename (str): The CSV file name the parts are named after.
+        chunk_rows (int): Maximum number of rows of each part, if any.
+        chunk_bytes (int): Maximum uncompressed size in bytes of each part,
+            header included, if any.
+        compress (bool): Whether to gzip each part.
+
+    Returns:
+        int: The number of rows written.
+    """
+    stem = filename[: -len(".csv")] if filename.endswith(".csv") else filename
+    suffix = ".csv.gz" if compress else ".csv"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def format_row(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    header = format_row(CSV_HEADER)
+    header_bytes = len(header.encode("utf-8"))
+    parts = []
+    tmp_filenames = []
+    part_file = None
+
+    def open_part():
+        part_filename = f"{stem}-{len(parts) + 1:04d}{suffix}"
+        tmp_filename = f"{part_filename}.part"
+        parts.append({"file": part_filename, "rows": 0, "bytes": header_bytes})
+        tmp_filenames.append(tmp_filename)
+        if compress:
+            part = gzip.open(
+                tmp_filename, "wt", encoding="utf-8", newline="", compresslevel=6
+            )
+        else:
+            part = open(
+                tmp_filename,
+                "w",
+                encoding="utf-8",
+                newline="",
+                buffering=CSV_PART_BUFFER_SIZE,
+            )
+        part.write(header)
+        return part
+
+    try:
+        part_file = open_part()
+        for row in rows:
+            text = format_row(row)
+            size = len(text.encode("utf-8"))
+            current = parts[-1]
+            if current["rows"] and (
+                (chunk_rows and current["rows"] >= chunk_rows)
+                or (chunk_bytes and current["bytes"] + size > chunk_bytes)
+            ):
+                part_file.close()
+                part_file = open_part()
+                current = parts[-1]
+            part_file.write(text)
+            current["rows"] += 1
+            current["bytes"] += size
+        part_file.close()
+        for part, tmp_filename in zip(parts, tmp_filenames):
+            os.replace(tmp_filename, part["file"])
+    finally:
+        if part_file:
+            part_file.close()
+        for tmp_filename in tmp_filenames:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+    count = sum(part["rows"] for part in parts)
+    manifest_filename = f"{stem}.manifest.json"
+    with open(f"{manifest_filename}.part", "w", encoding="utf-8") as manifest_file:
+        json.dump(
+            {
+                "created": datetime.now().astimezone().isoformat(),
+                "compressed": compress,
+                "rows": count,
+                "parts": [
+                    {**part, "file": os.path.basename(part["file"])} for part in parts
+                ],
+            },
+            manifest_file,
+            indent=2,
+        )
+    os.replace(f"{manifest_filename}.part", manifest_filename)
+    logging.info(
+        f"{count} events exported to {len(parts)} parts listed in {manifest_filename}"
+    )
+    return count
+
+
+def parse_size(text):
+    """
+    Parses a size in bytes with an optional K, M or G suffix (powers of 1024).
+
+    Args:
+        text (str): The size, e.g. 1048576, 512K or 100M.
+
+    Returns:
+        int: The size in bytes.
+
+    Raises:
+        ValueError: If text is not a positive size.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    text = text.strip().upper()
+    multiplier = units.get(text[-1:], 1)
+    size = int(text[:-1] if text[-1:] in units else text) * multiplier
+    if size <= 0:
+        raise ValueError(f"Invalid size {text}")
+    return size
+
+
+class TimeReport:
+    """Class representing the hours of events aggregated by week, subject,
+    company and opportunity"""
+
+    FIELDS = ["week", "subject", "company_id", "opportunity_id", "events", "hours"]
+
+    def __init__(self):
+        """Initializes an empty report."""
+        self.totals = {}
+        self.exports = []
+
+    def track(self, events, sfdc_user_id=None):
+        """
+        Adds events to the report while yielding them.
+
+        Events are keyed on the ISO week of their start, their subject and
+        the IDs of their companies and opportunities, joined like the WhatId
+        column of the CSV file. Only the number of events and the total
+        hours of each key are kept.
+
+        Args:
+            events (iterable): The events to export.
+            sfdc_user_id (str): The Salesforce user ID of the events, if any.
+
+        Yields:
+            object: Each event, unchanged.
+        """
+        if sfdc_user_id is not None:
+            self.exports.append(sfdc_user_id)
+        totals = self.totals
+        for event in events:
+            year, week, _ = event.start.isocalendar()
+            key = (
+                f"{year}-W{week:02d}",
+                event.subject or "",
+                "; ".join(str(company["id"]) for company in event.companies),
+                "; ".join(
+                    str(opportunity["id"]) for opportunity in event.opportunities
+                ),
+            )
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [1, event.duration_hours]
+            else:
+                total[0] += 1
+                total[1] += event.duration_hours
+            yield event
+
+    def merge(self, other):
+        """
+        Adds the totals of another report, e.g. of another user of a batch.
+
+        Args:
+            other (TimeReport): The report to add.
+        """
+        self.exports.extend(other.exports)
+        for key, (count, hours) in other.totals.items():
+            total = self.totals.get(key)
+            if total is None:
+                self.totals[key] = [count, hours]
+            else:
+                total[0] += count
+                total[1] += hours
+
+    def rows(self):
+        """Returns the totals as dictionaries following FIELDS, sorted by key."""
+        return [
+            dict(zip(self.FIELDS, (*key, count, round(hours, 2))))
+            for key, (count, hours) in sorted(self.totals.items())
+        ]
+
+    def write(self, filename):
+        """
+        Writes the report to a JSON file if filename ends with .json, and
+        to a CSV file otherwise.
+
+        Args:
+            filename (str): The path of the report.
+
+        Returns:
+            None
+        """
+        tmp_filename = f"{filename}.part"
+        with open(tmp_filename, "w", newline="", encoding="utf-8") as report_file:
+            if filename.endswith(".json"):
+                json.dump(
+                    {
+                        "created": datetime.now().astimezone().isoformat(),
+                        "exports": sorted(self.exports),
+                        "rows": self.rows(),
+                    },
+                    report_file,
+                    indent=2,
+                )
+            else:
+                writer = csv.DictWriter(report_file, self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows())
+        os.replace(tmp_filename, filename)
+        logging.info(f"Report of {len(self.totals)} rows written to {filename}")
+
+
+def _event_row(sfdc_user_id, event, max_hours_by_day):
+    """Returns the CSV row of an event, following CSV_HEADER."""
+    companies = "; ".join([str(company["id"]) for company in event.companies])
+    opportunities = "; ".join(
+        [str(opportunity["id"]) for opportunity in event.opportunities]
+    )
+    comments = []
+    comments.append(f"Event Summary: {event.summary}")
+    if not companies and not opportunities:
+        comments.append(
+            "No companies or opportunities are defined. Please verify if it is needed for this subject."  # noqa: E501
+        )
+        task_related_to = ""
+    else:
+        task_related_to = opportunities if opportunities else companies
+    if len(event.companies) > 1:
+        comments.append(
+            "Multiple companies are defined. You need to choose one manually."
+        )
+    if len(event.opportunities) > 1:
+        comments.append(
+            "Multiple opportunities are defined. You need to choose one manually."
+        )
+    if event.duration_hours > max_hours_by_day:
+        comments.append(
+            f"Duration is greater than {max_hours_by_day} hours. Probably a multi-day event."  # noqa: E501
+        )
+    return [
+        sfdc_user_id,
+        event.start.date(),
+        task_related_to,
+        "Completed",
+        event.subject,
+        event.duration_hours,
+        " // ".join(comments),
+    ]
+
+
+BulkResult = namedtuple("BulkResult", ["jobs", "processed", "failed", "rejected"])
+
+
+class BulkUploadError(Exception):
+    """Raised when Tasks can't be uploaded to Salesforce"""
+
+
+class BulkUploader:
+    """Class representing the upload of Tasks with the Salesforce Bulk API 2.0"""
+
+    # The Comments column of the Data Import Wizard is the Description field
+    FIELDS = [*CSV_HEADER[:-1], "Description"]
+    FINAL_STATES = ("JobComplete", "Failed", "Aborted")
+
+    def __init__(
+        self,
+        instance_url,
+        access_token,
+        api_version=BULK_API_VERSION,
+        workers=DEFAULT_BULK_WORKERS,
+        batch_rows=DEFAULT_BULK_BATCH_ROWS,
+        client=None,
+        poll_timeout=BULK_POLL_TIMEOUT,
+    ):
+        """
+        Initializes the uploader.
+
+        Args:
+            instance_url (str): The URL of the Salesforce instance.
+            access_token (str): The OAuth access token of the API user.
+            api_version (str): The version of the REST API, e.g. v59.0.
+            workers (int): The maximum number of jobs run concurrently.
+            batch_rows (int): The maximum number of rows of each job.
+            client (HttpClient): The client used to send requests, if any. A
+                pooled client is created otherwise.
+            poll_timeout (float): The maximum time waited for a job to complete.
+        """
+        self.base_url = (
+            f"{instance_url.rstrip('/')}/services/data/{api_version}/jobs/ingest"
+        )
+        self.headers = {"Authorization": f"Bearer {access_token}"}
+        self.workers = workers
+        self.batch_rows = batch_rows
+        self.poll_timeout = poll_timeout
+        self.client = client or HttpClient(pool_size=workers)
+
+    def _request(self, method, path="", **kwargs):
+        """Sends a request to the ingest API and checks its status."""
+        url = f"{self.base_url}/{path}" if path else self.base_url
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        response = self.client.request(
+            method, url, timeout=BULK_REQUEST_TIMEOUT, headers=headers, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def _batches(self, rows):
+        """Yields the rows as CSV payloads of at most batch_rows rows."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        batch = []
+        for row in rows:
+            if not batch:
+                writer.writerow(self.FIELDS)
+            writer.writerow(row)
+            batch.append(row)
+            if len(batch) >= self.batch_rows or buffer.tell() >= BULK_MAX_UPLOAD_BYTES:
+                yield buffer.getvalue(), batch
+                buffer.seek(0)
+                buffer.truncate()
+                batch = []
+        if batch:
+            yield buffer.getvalue(), batch
+
+    def run_job(self, payload, rows):
+        """
+        Creates an insert job for Tasks, uploads its data and waits for it.
+
+        The Bulk API 2.0 accepts a single upload per job, so each batch of
+        rows gets its own job.
+
+        Args:
+            payload (str): The CSV data of the job, header included.
+            rows (list): The rows of payload.
+
+        Returns:
+            tuple: The final job information, and the rejected rows with
+                their error as first column.
+        """
+        job = self._request(
+            "POST",
+            json={
+                "object": "Task",
+                "operation": "insert",
+                "contentType": "CSV",
+                "lineEnding": "LF",
+            },
+        ).json()
+        job_id = job["id"]
+        self._request(
+            "PUT",
+            f"{job_id}/batches",
+            data=payload.encode("utf-8"),
+            headers={"Content-Type": "text/csv"},
+        )
+        self._request("PATCH", job_id, json={"state": "UploadComplete"})
+        delay = BULK_POLL_INITIAL_DELAY
+        deadline = time.monotonic() + self.poll_timeout
+        while job["state"] not in self.FINAL_STATES:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Bulk job {job_id} is still {job['state']}")
+            time.sleep(delay)
+            delay = min(delay * 2, BULK_POLL_MAX_DELAY)
+            job = self._request("GET", job_id).json()
+        if job["state"] != "JobComplete":
+            error = job.get("errorMessage") or job["state"]
+            logging.error("Bulk job %s %s: %s", job_id, job["state"], error)
+            return job, [[error, *row] for row in rows]
+        rejected = []
+        if int(job.get("numberRecordsFailed") or 0):
+            failed = self._request("GET", f"{job_id}/failedResults/")
+            reader = csv.DictReader(io.StringIO(failed.content.decode("utf-8")))
+            rejected = [
+                [record["sf__Error"], *(record.get(field) for field in self.FIELDS)]
+                for record in reader
+            ]
+        logging.info(
+            "Bulk job %s completed: %s records processed, %d failed",
+            job_id,
+            job.get("numberRecordsProcessed"),
+            len(rejected),
+        )
+        return job, rejected
+
+    @staticmethod
+    def _finish(future, batch, accepted, rejected):
+        """Collects the rows accepted and rejected by a completed job."""
+        _, job_rejected = future.result()
+        rejected.extend(job_rejected)
+        failed = {tuple(str(value) for value in row[1:]) for row in job_rejected}
+        accepted.extend(
+            row for row in batch if tuple(str(value) for value in row) not in failed
+        )
+
+    def upload(self, rows, reject_filename, accepted=None):
+        """
+        Uploads rows as Tasks, running several jobs concurrently.
+
+        Rows are batched while they are produced, and at most workers jobs
+        are in progress at any time. Rows rejected by Salesforce, or part of
+        a job which failed, are written to reject_filename with their error.
+
+        If a job can't be run, the jobs already in progress still complete,
+        and the rows accepted by all the completed jobs are in accepted.
+
+        Args:
+            rows (iterable): The CSV rows of the Tasks, following CSV_HEADER.
+            reject_filename (str): The CSV file receiving the rejected rows.
+            accepted (list): Receives the rows accepted by Salesforce, as
+                soon as their job completes, if given.
+
+        Returns:
+            BulkResult: The number of jobs, of rows processed and of rows
+                rejected, with the rejected rows (without their error).
+
+        Raises:
+            BulkUploadError: If a job can't be created, its data uploaded or
+                if it doesn't complete in time.
+        """
+        jobs = processed = 0
+        rejected = []
+        accepted = [] if accepted is None else accepted
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = deque()
+                try:
+                    for payload, batch in self._batches(rows):
+                        if len(pending) >= self.workers:
+                            self._finish(*pending.popleft(), accepted, rejected)
+                        pending.append(
+                            (executor.submit(self.run_job, payload, batch), batch)
+                        )
+                        jobs += 1
+                        processed += len(batch)
+                    while pending:
+                        self._finish(*pending.popleft(), accepted, rejected)
+                finally:
+                    # Jobs in progress when another one failed still insert Tasks
+                    for future, batch in pending:
+                        if future.exception() is None:
+                            self._finish(future, batch, accepted, rejected)
+        except (*request_errors(), TimeoutError) as e:
+            raise BulkUploadError(str(e)) from e
+        if rejected:
+            with open(reject_filename, "w", newline="", encoding="utf-8") as rejects:
+                writer = csv.writer(rejects)
+                writer.writerow(["Error", *CSV_HEADER])
+                writer.writerows(rejected)
+            logging.warning(
+                "%d Tasks rejected by Salesforce written to %s",
+                len(rejected),
+                reject_filename,
+            )
+        return BulkResult(jobs, processed, len(rejected), [row[1:] for row in rejected])
+
+
+def upload_events_to_salesforce(
+    sfdc_user_id, events, uploader, reject_filename, max_hours_by_day, manifest=None
+):
+    """
+    Uploads events as Salesforce Tasks with the Bulk API 2.0.
+
+    Args:
+        sfdc_user_id (str): The Salesforce user ID.
+        events (iterable): Events to upload.
+        uploader (BulkUploader): The uploader of the Tasks.
+        reject_filename (str): The CSV file receiving the rejected Tasks.
+        max_hours_by_day (int): Maximum number of hours allowed per day.
+        manifest (ExportManifest): If set, only the events which are new or
+            changed since their last export are uploaded, and the manifest is
+            updated with the ones accepted by Salesforce, even if the upload
+            fails.
+
+    Returns:
+        int: The number of Tasks created.
+    """
+    entries = (
+        (event, _event_row(sfdc_user_id, event, max_hours_by_day)) for event in events
+    )
+    if manifest:
+        rows = manifest.select(sfdc_user_id, entries)
+    else:
+        rows = (row for _, row in entries)
+    accepted = []
+    try:
+        result = uploader.upload(rows, reject_filename, accepted)
+    finally:
+        if manifest:
+            # Tasks of the completed jobs exist even if another job failed
+            manifest.retain(accepted)
+            manifest.commit()
+    if manifest:
+        logging.info(
+            f"{manifest.skipped} events unchanged since their last export are skipped"
+        )
+    created = result.processed - result.failed
+    logging.info(
+        f"{created} Tasks created in Salesforce by {result.jobs} Bulk API jobs"
+    )
+    return created
+
+
+def _write_events(
+    args, sfdc_user_id, events, output, client, manifest, metrics=None, report=None
+):
+    """
+    Writes events to the output CSV file, or uploads them to Salesforce.
+
+    Args:
+        args (argparse.Namespace): The command line options shared by all exports.
+        sfdc_user_id (str): The Salesforce user ID.
+        events (iterable): The events to export.
+        output (str): Output CSV file name and path.
+        client (HttpClient): The client used to upload events.
+        manifest (ExportManifest): The manifest of exported events, if any.
+        metrics (PipelineMetrics): Records the ledger stage, if any. The
+            ledger of each window of an export is added to the same stage.
+        report (TimeReport): Receives the events written, if any.
+
+    Returns:
+        int: The number of events exported.
+    """
+    if args.daily_cap:
+        events = _tracked(
+            metrics,
+            "ledger",
+            apply_daily_ledger(
+                events,
+                args.max_hours_by_day,
+                args.morning_hour,
+                args.evening_hour,
+                args.export_all,
+            ),
+        )
+    if report is not None:
+        events = report.track(events, sfdc_user_id)
+    if args.bulk_upload:
+        uploader = BulkUploader(
+            args.sfdc_instance_url,
+            os.environ[ACCESS_TOKEN_ENV],
+            args.sfdc_api_version,
+            args.bulk_workers,
+            args.bulk_batch_rows,
+            client,
+        )
+        return upload_events_to_salesforce(
+            sfdc_user_id,
+            events,
+            uploader,
+            f"{os.path.splitext(output)[0]}-rejected.csv",
+            args.max_hours_by_day,
+            manifest,
+        )
+    return write_events_to_csv(
+        sfdc_user_id,
+        events,
+        output,
+        args.max_hours_by_day,
+        manifest,
+        args.chunk_rows,
+        args.chunk_bytes,
+        args.gzip,
+    )
+
+
+def export_events(
+    args,
+    sfdc_user_id,
+    api_url,
+    output,
+    start_date,
+    end_date,
+    client=None,
+    cache_path=None,
+    classifier=None,
+    metrics=None,
+    executor=None,
+    windows=None,
+    report=None,
+    state=None,
+):
+    """
+    Exports the events of one calendar to a CSV file.
+
+    Events are streamed from the API: each event goes through validation,
+    parsing, filtering and CSV export before the next one is decoded.
+    With a cache, events are fetched with a conditional request, and are
+    read from the cache when the API answers that they are not modified.
+
+    With windows, the events of several date ranges are exported to their
+    own output from a single fetch: events are parsed once, kept in an
+    EventColumns sorted by start, and the events of each window are found
+    by bisection. They are written ordered by start.
+
+    With a state, the events are kept in memory between the runs of a
+    daemon: they are fetched with a conditional request, reused when the
+    API answers that they are not modified, and only the outputs whose
+    events changed since their last export are written again.
+
+    Args:
+        args (argparse.Namespace): The command line options shared by all exports.
+        sfdc_user_id (str): The Salesforce user ID.
+        api_url (str): URL and port of the JCALAPI Container API.
+        output (str): Output CSV file name and path.
+        start_date (datetime): The start date of the date range.
+        end_date (datetime): The end date of the date range.
+        client (HttpClient): The client used to send requests. A new one is
+            created for the export if not given.
+        cache_path (str): SQLite file used to cache events, if any.
+        classifier (CategoryClassifier): The classifier of the categories.
+        metrics (PipelineMetrics): Records the metrics of the export, if any.
+        executor (ProcessPoolExecutor): The worker processes parsing events
+            when args.workers is more than 1. A new pool is created for the
+            export if not given.
+        windows (list): The (start, end, output) of each date range to
+            export instead of output. start_date and end_date must cover
+            all of them.
+        report (TimeReport): Receives the events exported, if any.
+        state (CalendarState): The events kept by the daemon, if any.
+
+    Returns:
+        int: The number of events exported, or None if no event is within
+            the date range.
+
+    Raises:
+        requests.exceptions.RequestException: If events can't be fetched.
+        json.JSONDecodeError: If the API response is not valid.
+        sqlite3.Error: If the event cache or the export manifest can't be used.
+        BulkUploadError: If events can't be uploaded to Salesforce.
+    """
+    counters = Counter()
+    cache = None
+    manifest = None
+    own_client = client is None
+    if own_client:
+        client = HttpClient.from_args(args, args.fetch_workers)
+    own_executor = executor is None and args.workers > 1
+    if own_executor:
+        executor = _worker_pool(args.workers)
+    started = time.perf_counter()
+    try:
+        if args.incremental:
+            manifest = ExportManifest(args.incremental)
+        if cache_path:
+            cache = EventCache(cache_path)
+            if args.refresh:
+                cache.clear()
+            validator = fetch_validator(api_url + "/meta", client)
+            if validator is not None and args.include_fields is not None:
+                # Events cached with other fields can't be reused
+                validator += " fields=" + ",".join(sorted(args.include_fields))
+        if cache and cache.covers(start_date, end_date, validator):
+            logging.info("Calendar unchanged, using events cached in %s", cache_path)
+            events = _tracked(metrics, "cache", cache.query(start_date, end_date))
+        else:
+            request = (
+                f"{api_url}/events {start_date.isoformat()} {end_date.isoformat()}"
+            )
+            if args.include_fields is not None:
+                request += " fields=" + ",".join(sorted(args.include_fields))
+            if cache:
+                http_validators = cache.get_http_validators(request)
+            elif state is not None:
+                http_validators = state.get_http_validators(request)
+            else:
+                http_validators = None
+            try:
+                events = fetch_events(
+                    api_url + "/events",
+                    start_date,
+                    end_date,
+                    args.fetch_workers,
+                    client,
+                    metrics,
+                    http_validators,
+                    args.include_fields,
+                )
+            except NotModified:
+                if cache:
+                    logging.info(
+                        "Events not modified, using events cached in %s", cache_path
+                    )
+                    events = _tracked(
+                        metrics, "cache", cache.query(start_date, end_date)
+                    )
+                else:
+                    logging.info("Events not modified, using events kept in memory")
+                    events = _tracked(metrics, "cache", iter(state.records))
+            else:
+                events = _tracked(metrics, "normalize", normalize_events(events))
+                events = _tracked(
+                    metrics,
+                    "expand",
+                    expand_recurrences(events, start_date, end_date, counters),
+                )
+                if cache:
+                    events = _tracked(
+                        metrics,
+                        "cache",
+                        cache.store(
+                            events,
+                            start_date,
+                            end_date,
+                            validator,
+                            request,
+                            http_validators,
+                        ),
+                    )
+                elif state is not None:
+                    events = _tracked(
+                        metrics,
+                        "cache",
+                        state.store(events, request, http_validators),
+                    )
+        if state is not None:
+            events = list(events)
+            digests = {
+                target_output: CalendarState.digest(events, target_start, target_end)
+                for target_start, target_end, target_output in (
+                    windows or [(start_date, end_date, output)]
+                )
+            }
+            changed = {
+                target_output
+                for target_output, digest in digests.items()
+                if state.exported.get(target_output) != digest
+            }
+            if not changed:
+                logging.info("Events unchanged since their last export, export skipped")
+                if report is not None and state.report is not None:
+                    report.merge(state.report)
+                return 0
+            if windows:
+                windows = [window for window in windows if window[2] in changed]
+                start_date = min(window_start for window_start, _, _ in windows)
+                end_date = max(window_end for _, window_end, _ in windows)
+        valid_events = _tracked(
+            metrics,
+            "validate",
+            validate_events_timing(events, start_date, end_date, counters),
+        )
+        first_event = next(valid_events, None)
+        if first_event is None:
+            logging.info("No events are within the date range")
+            return None
+        if args.workers > 1:
+            filtered_events = _tracked(
+                metrics,
+                "parse",
+                parse_events_sharded(
+                    chain([first_event], valid_events),
+                    executor,
+                    args.workers,
+                    args.shard_by,
+                    args.max_hours_by_day,
+                    args.morning_hour,
+                    args.evening_hour,
+                    classifier,
+                    args.export_all,
+                    counters,
+                ),
+            )
+        else:
+            matching_events = _tracked(
+                metrics,
+                "parse",
+                (
+                    EventEntry.from_record(
+                        event,
+                        args.max_hours_by_day,
+                        args.morning_hour,
+                        args.evening_hour,
+                        classifier,
+                    )
+                    for event in chain([first_event], valid_events)
+                ),
+            )
+            filtered_events = (
+                _tracked(metrics, "filter", filter_events(matching_events, counters))
+                if not args.export_all
+                else matching_events
+            )
+        # Write events to CSV file, or upload them to Salesforce
+        write_started = time.perf_counter()
+        if windows:
+            columns = EventColumns(filtered_events)
+            order = sorted(range(len(columns)), key=columns.starts.__getitem__)
+            starts = [columns.starts[index] for index in order]
+            if metrics:
+                metrics.add("index", time.perf_counter() - write_started, len(order))
+            count = 0
+            for window_start, window_end, window_output in windows:
+                low_ts, high_ts = window_start.timestamp(), window_end.timestamp()
+                indexes = [
+                    index
+                    for index in order[
+                        bisect_left(starts, low_ts) : bisect_right(starts, high_ts)
+                    ]
+                    if low_ts <= columns.ends[index] <= high_ts
+                ]
+                if not indexes:
+                    logging.info(
+                        "No events are within the date range %s - %s",
+                        window_start,
+                        window_end,
                     )
-                start = (start + timedelta(days=1)).replace(hour=morning_hour, minute=0)
-            return math.ceil(total_hours)
+                    continue
+                count += _write_events(
+                    args,
+                    sfdc_user_id,
+                    (columns[index] for index in indexes),
+                    window_output,
+                    client,
+                    manifest,
+                    metrics,
+                )
         else:
-            return None
-
-    def category_matches_subject_list(self):
-        """
-        Checks if any category in the list matches the subject list.
-
-        Returns:
-            str: The matched category if found, None otherwise.
-        """
-        for category in self.categories if self.categories is not None else []:
-            if category.startswith("SU::"):
-                stripped_category = category.replace("SU::", "")
-                if stripped_category in self.SUBJECT_LIST:
-                    return stripped_category
-        return None
+            count = _write_events(
+                args,
+                sfdc_user_id,
+                filtered_events,
+                output,
+                client,
+                manifest,
+                metrics,
+                report,
+            )
+        if metrics:
+            metrics.add("write", time.perf_counter() - write_started, count)
+        logging.info(
+            "%d events are within the date range on %d events collected",
+            counters["in_range"],
+            counters["collected"],
+        )
+        if args.debug_summary:
+            logging.debug(
+                "Events by reason: %s",
+                ", ".join(f"{key}={value}" for key, value in sorted(counters.items())),
+            )
+        if state is not None:
+            state.exported.update(digests)
+            state.report = report
+        return count
+    finally:
+        if metrics:
+            metrics.seconds = time.perf_counter() - started
+            metrics.counters = counters
+        if cache:
+            cache.close()
+        if manifest:
+            manifest.close()
+        if own_client:
+            client.close()
+        if own_executor:
+            executor.shutdown()
 
-    def category_matches_company(self):
-        """
-        Returns a list of companies that match the category.
 
-        Returns:
-            list: A list of dictionaries containing the id and name of
-                  the matching companies.
-        """
-        companies = []
-        for category in self.categories if self.categories is not None else []:
-            if category.startswith("CU::"):
-                parts = category.split("::")
-                if len(parts) >= 3:
-                    company = {"id": parts[2], "name": parts[1]}
-                    companies.append(company)
-        return companies
+def read_batch_manifest(filename):
+    """
+    Reads the list of exports to run in batch mode.
 
-    def category_matches_opportunities(self):
-        """
-        Returns a list of opportunities that match the categories.
+    The manifest is a CSV file with a header. The sfdc_user_id and output
+    columns are required, the api_url and cache columns are optional. Each
+    Salesforce user ID can only be listed once, since the metrics and time
+    report of an export are keyed on it.
 
-        Returns:
-            list: A list of dictionaries representing the opportunities. Each dictionary
-            contains the 'id' and 'name' of the opportunity.
-        """
-        opportunities = []
-        for category in self.categories if self.categories is not None else []:
-            if category.startswith("OP::"):
-                parts = category.split("::")
-                if len(parts) >= 3:
-                    opportunity = {"id": parts[2], "name": parts[1]}
-                    opportunities.append(opportunity)
-        return opportunities
+    Args:
+        filename (str): The path of the manifest.
 
+    Returns:
+        list: A list of dictionaries, one per export.
 
-def fetch_data(url):
+    Raises:
+        ValueError: If a required column is missing, or a Salesforce user ID
+            is listed more than once.
     """
-    Fetches data from url and returns it as JSON.
+    with open(filename, newline="", encoding="utf-8") as manifest:
+        reader = csv.DictReader(manifest)
+        missing = {"sfdc_user_id", "output"} - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"missing column(s) {', '.join(sorted(missing))}")
+        entries = [entry for entry in reader if entry["sfdc_user_id"]]
+    counts = Counter(entry["sfdc_user_id"] for entry in entries)
+    duplicates = sorted(
+        sfdc_user_id for sfdc_user_id, count in counts.items() if count > 1
+    )
+    if duplicates:
+        raise ValueError(f"duplicate sfdc_user_id {', '.join(duplicates)}")
+    return entries
 
-    Returns:
-        dict: The fetched data as a JSON dictionary.
-        None: If the request fails or the response status code is not 200.
-    """
-    try:
-        response = requests.get(url, timeout=15, verify=False)
-        response.raise_for_status()  # Raise an exception for non-200 status codes
-        json_data = response.json()
-        return json_data
-    except requests.exceptions.RequestException as e:
-        logging.error("Failed to retrieve JSON from %s: %s", url, str(e))
-        return None
+
+def _pooled_client(args):
+    """Returns a client with a connection pool sized for concurrent exports."""
+    return HttpClient.from_args(
+        args, args.batch_workers * args.fetch_workers + args.bulk_workers
+    )
 
 
-def validate_events_timing(events, start_date, end_date):
+def run_batch(
+    args,
+    entries,
+    start_date,
+    end_date,
+    classifier=None,
+    reports=None,
+    client=None,
+    executor=None,
+    time_reports=None,
+    windows=None,
+    states=None,
+):
     """
-    Validates the timing of events based on the given start and end dates.
+    Exports the events of several users concurrently.
+
+    All exports share one pooled HTTP client, and one pool of worker
+    processes when args.workers is more than 1. A failing export is logged
+    and does not stop the others. With args.report, the latest successful
+    time report of each user is merged into a single report, which is not
+    written when no export succeeded.
 
     Args:
-        events (list): A list of events to be validated.
+        args (argparse.Namespace): The command line options shared by all exports.
+        entries (list): The exports to run, as returned by read_batch_manifest.
         start_date (datetime): The start date of the date range.
         end_date (datetime): The end date of the date range.
+        classifier (CategoryClassifier): The classifier of the categories.
+        reports (list): Receives the metrics of each export, if given.
+        client (HttpClient): The pooled client to use. A new one is created
+            for the batch if not given.
+        executor (ProcessPoolExecutor): The worker processes to use. A new
+            pool is created for the batch if not given.
+        time_reports (dict): The latest successful time report of each user,
+            updated with the successful exports of the batch. Kept between
+            the runs of a daemon, which only exports the changed calendars.
+        windows (list): The (start, end, output) of each date range to
+            export instead of the output of the entries, see export_events.
+        states (dict): The CalendarState of each user, kept by the daemon.
 
     Returns:
-        list: A list of valid events that fall within the specified date range.
+        dict: The error of each failed export, keyed on the Salesforce user ID.
     """
+    succeeded = 0
+    failures = {}
+    metrics = {
+        entry["sfdc_user_id"]: (
+            PipelineMetrics(entry["sfdc_user_id"]) if reports is not None else None
+        )
+        for entry in entries
+    }
+    run_reports = {
+        entry["sfdc_user_id"]: TimeReport() if args.report else None
+        for entry in entries
+    }
+    own_client = client is None
+    if own_client:
+        client = _pooled_client(args)
+    own_executor = executor is None and args.workers > 1
+    if own_executor:
+        executor = _worker_pool(args.workers)
+    try:
+        with ThreadPoolExecutor(max_workers=args.batch_workers) as threads:
+            futures = {
+                threads.submit(
+                    export_events,
+                    args,
+                    entry["sfdc_user_id"],
+                    entry.get("api_url") or args.api_url,
+                    entry["output"],
+                    start_date,
+                    end_date,
+                    client,
+                    entry.get("cache") or None,
+                    classifier,
+                    metrics[entry["sfdc_user_id"]],
+                    executor,
+                    windows,
+                    run_reports[entry["sfdc_user_id"]],
+                    states[entry["sfdc_user_id"]] if states is not None else None,
+                ): entry["sfdc_user_id"]
+                for entry in entries
+            }
+            for future in as_completed(futures):
+                sfdc_user_id = futures[future]
+                if reports is not None:
+                    reports.append(metrics[sfdc_user_id].report())
+                try:
+                    future.result()
+                    succeeded += 1
+                except Exception as e:  # Isolate each user from the others
+                    logging.error("Export failed for %s: %s", sfdc_user_id, str(e))
+                    failures[sfdc_user_id] = str(e)
+    finally:
+        if own_client:
+            client.close()
+        if own_executor:
+            executor.shutdown()
     logging.info(
-        "Validating if events are within the date range %s - %s", start_date, end_date
+        "Batch finished: %d exports succeeded, %d failed", succeeded, len(failures)
     )
-    valid_events = []
-    for event in events:
-        event_start = datetime.fromisoformat(event["start"])
-        event_end = datetime.fromisoformat(event["end"])
-        if (
-            start_date <= event_start <= end_date
-            and start_date <= event_end <= end_date
-        ):
-            valid_events.append(event)
-            logging.debug(
-                "INCLUDED - Event %s at %s is within the date range",
-                event["summary"],
-                event["start"],
-            )
+    for sfdc_user_id, error in sorted(failures.items()):
+        logging.info("FAILED - %s: %s", sfdc_user_id, error)
+    if args.report:
+        if time_reports is None:
+            time_reports = {}
+        time_reports.update(
+            (sfdc_user_id, time_report)
+            for sfdc_user_id, time_report in run_reports.items()
+            if sfdc_user_id not in failures
+        )
+        if succeeded:
+            report = TimeReport()
+            for time_report in time_reports.values():
+                report.merge(time_report)
+            report.write(args.report)
         else:
-            logging.debug(
-                "EXCLUDED - Event %s at %s is NOT within the date range",
-                event["summary"],
-                event["start"],
-            )
-    return valid_events
+            logging.warning("No export succeeded, %s is not written", args.report)
+    return failures
 
 
-def filter_events(events):
+def run_daemon(args, entries, date_range, classifier=None, window_ranges=None):
     """
-    Filters a list of events based on certain criteria.
+    Runs the exports every args.interval seconds until SIGTERM or SIGINT.
+
+    The process keeps its pooled HTTP client, its worker processes, its
+    memoized category classifications and the events of each calendar
+    between runs. An export is skipped when its date range and the JCALAPI
+    metadata (/meta) didn't change since its last successful run. Otherwise
+    the events are fetched with a conditional request, and only the outputs
+    whose events changed are written again. A running export is completed
+    before stopping.
 
     Args:
-        events (list): The list of events to be filtered.
+        args (argparse.Namespace): The command line options shared by all exports.
+        entries (list): The exports to run, as returned by read_batch_manifest.
+        date_range (callable): Returns the (start, end) dates of each run.
+        classifier (CategoryClassifier): The classifier of the categories.
+        window_ranges (callable): Returns the (start, end, output) of each
+            date range to export at each run instead of date_range, if any.
 
     Returns:
-        list: The filtered list of events.
+        None
     """
-    filtered_events = []
-    logging.info("Filtering events based on duration > 0 and subject is defined")
-    for event in events:
-        if event.duration_hours > 0 and event.subject:
-            logging.debug(
-                "INCLUDED - Event %s at %s match the criteria",
-                event.summary,
-                event.start,
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info("Received signal %d, stopping after the current run", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    status = {
+        "pid": os.getpid(),
+        "state": "starting",
+        "started": datetime.now().astimezone().isoformat(),
+        "interval": args.interval,
+        "runs": 0,
+        "failed_runs": 0,
+        "exports": {},
+    }
+    exported = {}
+    time_reports = {}
+    calendars = {entry["sfdc_user_id"]: CalendarState() for entry in entries}
+    executor = _worker_pool(args.workers) if args.workers > 1 else None
+    with _pooled_client(args) as client:
+        while not stop.is_set():
+            windows = window_ranges() if window_ranges else None
+            if windows:
+                start_date = min(start for start, _, _ in windows)
+                end_date = max(end for _, end, _ in windows)
+            else:
+                start_date, end_date = date_range()
+            status.update(
+                state="running", last_run=datetime.now().astimezone().isoformat()
             )
-            filtered_events.append(event)
-        else:
-            logging.debug(
-                "EXCLUDED - Event %s at %s does not match the criteria",
-                event.summary,
-                event.start,
+            write_status(args.status_file, status)
+            changed = []
+            for entry in entries:
+                api_url = entry.get("api_url") or args.api_url
+                validator = fetch_validator(api_url + "/meta", client)
+                state = (start_date, end_date, validator)
+                if (
+                    validator is not None
+                    and exported.get(entry["sfdc_user_id"]) == state
+                ):
+                    logging.info(
+                        "Calendar of %s unchanged, export skipped",
+                        entry["sfdc_user_id"],
+                    )
+                else:
+                    changed.append((entry, state))
+            reports = [] if args.metrics_json or args.metrics_prom else None
+            failures = {}
+            if changed:
+                logging.info("Start date: %s, End date: %s", start_date, end_date)
+                failures = run_batch(
+                    args,
+                    [entry for entry, _ in changed],
+                    start_date,
+                    end_date,
+                    classifier,
+                    reports,
+                    client,
+                    executor,
+                    time_reports,
+                    windows,
+                    calendars,
+                )
+                # --refresh only rebuilds the caches on the first run
+                args.refresh = False
+            finished = datetime.now().astimezone().isoformat()
+            for entry, state in changed:
+                sfdc_user_id = entry["sfdc_user_id"]
+                if sfdc_user_id in failures:
+                    status["exports"][sfdc_user_id] = {
+                        **status["exports"].get(sfdc_user_id, {}),
+                        "last_error": failures[sfdc_user_id],
+                        "last_failure": finished,
+                    }
+                else:
+                    exported[sfdc_user_id] = state
+                    status["exports"][sfdc_user_id] = {"last_export": finished}
+            for filename, prometheus in (
+                (args.metrics_json, False),
+                (args.metrics_prom, True),
+            ):
+                if filename and reports:
+                    write_metrics(filename, reports, prometheus)
+            status["runs"] += 1
+            status["failed_runs"] += bool(failures)
+            status.update(
+                state="idle",
+                last_run_finished=finished,
+                next_run=(
+                    datetime.now().astimezone() + timedelta(seconds=args.interval)
+                ).isoformat(),
             )
-    logging.info(
-        "%d events are valid (matching duration > 0 and subject is defined) on %d events",  # noqa: E501
-        len(filtered_events),
-        len(events),
-    )
-    return filtered_events
+            write_status(args.status_file, status)
+            stop.wait(args.interval)
+    if executor:
+        executor.shutdown()
+    status.update(state="stopped", next_run=None)
+    write_status(args.status_file, status)
+    logging.info("Daemon stopped after %d runs", status["runs"])
 
 
-def write_events_to_csv(sfdc_user_id, events, filename, max_hours_by_day):
-    """
-    Write events to a CSV file.
+class LocalTimezone(tzinfo):
+    """Class representing the timezone of the system, following its
+    daylight saving time changes like dateutil.tz.tzlocal"""
 
-    Args:
-        sfdc_user_id (str): The Salesforce user ID.
-        events (list): List of events to write.
-        filename (str): Name of the CSV file.
-        max_hours_by_day (int): Maximum number of hours allowed per day.
+    STD_OFFSET = timedelta(seconds=-time.timezone)
+    DST_OFFSET = timedelta(seconds=-time.altzone) if time.daylight else STD_OFFSET
+    EPOCH = datetime(1970, 1, 1)
 
-    Returns:
-        None
-    """
-    with open(filename, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(
-            [
-                "OwnerId",
-                "ActivityDate",
-                "WhatId",
-                "Status",
-                "Subject",
-                "Time_Spent_hrs__c",
-                "Comments",
-            ]
+    def _offset(self, dt):
+        """
+        Returns the UTC offset of the wall time dt.
+
+        An ambiguous wall time (when clocks are set back) has both offsets,
+        the first occurrence is picked unless dt.fold is 1. A wall time
+        skipped when clocks are set forward gets the offset after the
+        change, like tzlocal.
+        """
+        return self._wall_offset(dt.replace(tzinfo=None), dt.fold)
+
+    @lru_cache(maxsize=1024)
+    def _wall_offset(self, wall, fold):
+        """Returns the UTC offset of a naive wall time, see _offset."""
+        offsets = [
+            offset
+            for offset in dict.fromkeys((self.DST_OFFSET, self.STD_OFFSET))
+            if time.localtime(
+                (wall - offset - self.EPOCH) // timedelta(seconds=1)
+            ).tm_gmtoff
+            == offset.total_seconds()
+        ]
+        if len(offsets) == 1:
+            return offsets[0]
+        if offsets:
+            return offsets[fold]
+        # The instant after the gap, in the offset used before it
+        after = wall - min(self.DST_OFFSET, self.STD_OFFSET) - self.EPOCH
+        return timedelta(
+            seconds=time.localtime(after // timedelta(seconds=1)).tm_gmtoff
         )
-        for event in events:
-            companies = "; ".join([str(company["id"]) for company in event.companies])
-            opportunities = "; ".join(
-                [str(opportunity["id"]) for opportunity in event.opportunities]
-            )
-            comments = []
-            comments.append(f"Event Summary: {event.summary}")
-            if not companies and not opportunities:
-                comments.append(
-                    "No companies or opportunities are defined. Please verify if it is needed for this subject."  # noqa: E501
-                )
-                task_related_to = ""
-            else:
-                task_related_to = opportunities if opportunities else companies
-            if len(event.companies) > 1:
-                comments.append(
-                    "Multiple companies are defined. You need to choose one manually."
-                )
-            if len(event.opportunities) > 1:
-                comments.append(
-                    "Multiple opportunities are defined. You need to choose one manually."  # noqa: E501
-                )
-            if event.duration_hours > max_hours_by_day:
-                comments.append(
-                    f"Duration is greater than {max_hours_by_day} hours. Probably a multi-day event."  # noqa: E501
-                )
-            writer.writerow(
-                [
-                    sfdc_user_id,
-                    event.start.date(),
-                    task_related_to,
-                    "Completed",
-                    event.subject,
-                    event.duration_hours,
-                    " // ".join(comments),
-                ]
-            )
-        logging.info(f"{len(events)} events exported to {filename}")
+
+    def utcoffset(self, dt):
+        return self._offset(dt)
+
+    def dst(self, dt):
+        return self._offset(dt) - self.STD_OFFSET
+
+    def tzname(self, dt):
+        return time.tzname[self._offset(dt) != self.STD_OFFSET]
+
+    def fromutc(self, dt):
+        offset = timedelta(
+            seconds=time.localtime(
+                (dt.replace(tzinfo=None) - self.EPOCH) // timedelta(seconds=1)
+            ).tm_gmtoff
+        )
+        local = dt + offset
+        if self._offset(local) != offset:
+            local = local.replace(fold=1)
+        return local
+
+
+LOCAL_TIMEZONE = LocalTimezone()
+
+
+def write_status(filename, status):
+    """Writes the daemon status to a JSON file, if any."""
+    if not filename:
+        return
+    tmp_filename = f"{filename}.part"
+    with open(tmp_filename, "w", encoding="utf-8") as status_file:
+        json.dump(status, status_file, indent=2)
+    os.replace(tmp_filename, filename)
 
 
 def main():
@@ -393,16 +4349,33 @@ def main():
     file in a format suitable for Salesforce import.
 
     Usage:
-    python import-sfdc-task.py [--api-url API_URL] [--sfdc-user-id USER_ID]
+    python import-sfdc-task.py [--api-url API_URL] (--sfdc-user-id USER_ID | --batch MANIFEST)
                               [--this-week] [--last-week] [--last-month]
                               [--start START_DATE] [--end END_DATE]
                               [--max-hours-by-day MAX_HOURS] [--morning-hour START_HOUR]
-                              [--evening-hour END_HOUR] [--output OUTPUT_FILE]
-                              [--export-all] [--verbose]
+                              [--evening-hour END_HOUR] [--daily-cap] [--output OUTPUT_FILE]
+                              [--windows WINDOWS] [--report REPORT_FILE]
+                              [--workers WORKERS] [--shard-by {month,week}]
+                              [--export-all] [--categories-config CONFIG_FILE]
+                              [--sfdc-index EXTRACT_FILE] [--sfdc-index-db INDEX_FILE]
+                              [--include-fields FIELDS]
+                              [--fetch-workers WORKERS] [--connect-timeout SECONDS]
+                              [--read-timeout SECONDS] [--retries RETRIES]
+                              [--http-client {auto,requests,stdlib}]
+                              [--cache CACHE_FILE] [--refresh]
+                              [--incremental MANIFEST_FILE]
+                              [--chunk-rows ROWS] [--chunk-bytes SIZE] [--gzip]
+                              [--bulk-upload] [--sfdc-instance-url URL]
+                              [--sfdc-api-version VERSION] [--bulk-workers WORKERS]
+                              [--bulk-batch-rows ROWS]
+                              [--daemon] [--interval SECONDS] [--status-file STATUS_FILE]
+                              [--batch MANIFEST] [--batch-workers WORKERS]
+                              [--metrics-json METRICS_FILE] [--metrics-prom METRICS_FILE]
+                              [--profile PROFILE_FILE] [--verbose] [--debug-summary]
 
     Arguments:
     --api-url, -u: URL of the JCALAPI (default: http://host.docker.internal:7042)
-    --sfdc-user-id, -i: Salesforce ID of the user (required)
+    --sfdc-user-id, -i: Salesforce ID of the user (required unless --batch is used)
     --this-week: Export events from this week (takes precedence over --start and --end)
     --last-week: Export events from last week (takes precedence over --start and --end)
     --last-month: Export events from last month (takes precedence over --start and --end)
@@ -411,14 +4384,52 @@ def main():
     --max-hours-by-day: Max hours by day (default: 8)
     --morning-hour: Start hour of day used in duration calculation (default: 8)
     --evening-hour: End hour of day used in duration calculation (default: 19)
+    --daily-cap: Merge overlapping events and share --max-hours-by-day between each day's events
     --output, -o: Output CSV file name and path (default: sfdc_task.csv)
+    --report: CSV or JSON file receiving the hours by week, subject, company and opportunity
+    --windows: Comma separated windows (this-week, last-week, last-month) exported from a
+               single fetch, each to <output>-<window>.csv
+    --workers: Number of processes parsing events, by shards of the date range (default: 1)
+    --shard-by: Cut the date range into shards by month or week (default: month)
     --export-all, -a: Export all events from Exchange including events without SFDC Task subject
+    --categories-config: JSON file defining the known subjects and the category prefixes
+    --sfdc-index: CSV extract of Salesforce Accounts/Opportunities validating and resolving
+                  companies and opportunities (can be repeated)
+    --sfdc-index-db: SQLite file storing the --sfdc-index extracts, reused when no extract is given
+    --include-fields: Fields of the events kept on top of the ones used by the export, or all
+    --fetch-workers: Max number of pages fetched concurrently (default: 4)
+    --connect-timeout: Seconds to wait for a connection to an API (default: 5)
+    --read-timeout: Seconds to wait for data from an API (default: 15)
+    --retries: Times a failed request to JCALAPI is retried (default: 3)
+    --http-client: Library sending requests, stdlib starts faster and doesn't need requests
+                   (default: auto, requests if installed)
+    --cache: SQLite file used to cache events between runs
+    --refresh: Ignore and rebuild the events cached in --cache
+    --incremental: SQLite manifest of exported events, only new or changed events are exported
+    --chunk-rows: Split the output into parts of at most ROWS events
+    --chunk-bytes: Split the output into parts of at most SIZE bytes (e.g. 100M)
+    --gzip: Write gzip-compressed parts
+    --bulk-upload: Create the Tasks in Salesforce with the Bulk API 2.0 instead of writing
+                   the CSV file (access token read from SFDC_ACCESS_TOKEN)
+    --sfdc-instance-url: URL of the Salesforce instance (default: SFDC_INSTANCE_URL)
+    --sfdc-api-version: Version of the Salesforce REST API (default: v59.0)
+    --bulk-workers: Max number of Bulk API jobs run concurrently (default: 4)
+    --bulk-batch-rows: Max number of Tasks of each Bulk API job (default: 10000)
+    --daemon: Keep running and export again every --interval seconds when calendars change
+    --interval: Seconds between two runs in daemon mode (default: 3600)
+    --status-file: JSON file receiving the status of the daemon
+    --batch: CSV manifest of exports (sfdc_user_id, output, api_url, cache) to run concurrently
+    --batch-workers: Max number of exports run concurrently in batch mode (default: 8)
+    --metrics-json: JSON file receiving the metrics of each pipeline stage
+    --metrics-prom: Prometheus textfile receiving the metrics of each pipeline stage
+    --profile: File receiving a cProfile dump of the export
     --verbose, -v: Verbose mode
+    --debug-summary: Log event counts by reason instead of one line per event
 
     """
 
     def this_week():
-        today = datetime.now(tz=tzlocal()).replace(
+        today = datetime.now(tz=LOCAL_TIMEZONE).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
         start = today - timedelta(days=today.weekday())
@@ -426,7 +4437,7 @@ def main():
         return start, end.replace(hour=23, minute=59, second=59, microsecond=0)
 
     def last_week():
-        today = datetime.now(tz=tzlocal()).replace(
+        today = datetime.now(tz=LOCAL_TIMEZONE).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
         start = today - timedelta(days=today.weekday(), weeks=1)
@@ -434,7 +4445,7 @@ def main():
         return start, end.replace(hour=23, minute=59, second=59, microsecond=0)
 
     def last_month():
-        today = datetime.now(tz=tzlocal()).replace(
+        today = datetime.now(tz=LOCAL_TIMEZONE).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
         start = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
@@ -442,7 +4453,7 @@ def main():
         return start, end.replace(hour=23, minute=59, second=59, microsecond=0)
 
     def current_week():
-        today = datetime.now(tz=tzlocal()).replace(
+        today = datetime.now(tz=LOCAL_TIMEZONE).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
         start = today - timedelta(days=today.weekday())
@@ -473,8 +4484,7 @@ def main():
         "-i",
         "--sfdc-user-id",
         type=str,
-        required=True,
-        help="Salesforce user ID",
+        help="Salesforce user ID (required unless --batch is used)",
     )
     parser.add_argument(
         "--this-week",
@@ -520,6 +4530,11 @@ def main():
         default=19,
         help="End hour of day used in duration calculation",
     )
+    parser.add_argument(
+        "--daily-cap",
+        action="store_true",
+        help="Merge the overlapping time of the events of each day and share --max-hours-by-day between them, instead of capping each event separately.",  # noqa: E501
+    )
     parser.add_argument(
         "-o",
         "--output",
@@ -527,15 +4542,202 @@ def main():
         default="/export/sfdc_task.csv",
         help="Output CSV file name and path.",
     )
+    parser.add_argument(
+        "--report",
+        type=str,
+        metavar="REPORT_FILE",
+        help="CSV (or JSON if it ends with .json) file receiving the number of events and hours by week, subject, company and opportunity. Batch exports are merged in a single report.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--windows",
+        type=str,
+        metavar="WINDOWS",
+        help="Comma separated windows among this-week, last-week and last-month, exported from a single fetch of the events, each to <output>-<window>.csv.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of processes computing the durations and categories of events, for long date ranges. The output is the same as with a single process.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=sorted(SHARD_KEYS),
+        default="month",
+        help="Cut the date range into shards of events by month or by week with --workers.",  # noqa: E501
+    )
     parser.add_argument(
         "-a",
         "--export-all",
         action="store_true",
         help="Export all events from Exchange including events without SFDC Task subject.",  # noqa: E501
     )
+    parser.add_argument(
+        "--categories-config",
+        type=str,
+        help="JSON file defining the known subjects and the category prefixes.",
+    )
+    parser.add_argument(
+        "--sfdc-index",
+        action="append",
+        default=[],
+        metavar="EXTRACT_FILE",
+        help="CSV extract of Salesforce Accounts and/or Opportunities (Id, Name and IsClosed columns) used to validate company and opportunity IDs, resolve names and keep the only open opportunity. Can be repeated.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--sfdc-index-db",
+        type=str,
+        metavar="INDEX_FILE",
+        help="SQLite file storing the --sfdc-index extracts, rebuilt when extracts are given and used alone otherwise (for large orgs).",  # noqa: E501
+    )
+    parser.add_argument(
+        "--include-fields",
+        type=parse_fields,
+        default="",
+        metavar="FIELDS",
+        help=f"Comma separated fields of the events to keep on top of the ones used by the export, among {', '.join(EventEntry.DETAIL_FIELDS)}, or all. The other fields are dropped as soon as the events are received.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=DEFAULT_FETCH_WORKERS,
+        help="Max number of pages fetched concurrently when the API paginates events",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help="Seconds to wait for a connection to an API",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help="Seconds to wait for data from an API",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Times a failed request to JCALAPI (connection error, timeout, HTTP 429 or 5xx) is retried, with a jittered exponential backoff",  # noqa: E501
+    )
+    parser.add_argument(
+        "--http-client",
+        choices=HTTP_CLIENTS,
+        default="auto",
+        help="Library sending the requests: requests, or http.client from the standard library (stdlib), which starts faster and doesn't need requests to be installed. auto uses requests if it is installed.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="SQLite file used to cache events between runs (e.g. /export/events.sqlite).",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore and rebuild the events cached in --cache.",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=str,
+        metavar="MANIFEST",
+        help="SQLite manifest of the events already exported (e.g. /export/exported.sqlite). Only new or changed events are written to the output.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        help="Split the output into parts of at most this number of events, listed in a JSON manifest.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--chunk-bytes",
+        type=parse_size,
+        metavar="SIZE",
+        help="Split the output into parts of at most this uncompressed size (e.g. 100M), listed in a JSON manifest.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Write the output as gzip-compressed parts, listed in a JSON manifest.",
+    )
+    parser.add_argument(
+        "--bulk-upload",
+        action="store_true",
+        help=f"Create the Tasks in Salesforce with the Bulk API 2.0 instead of writing the CSV file. The access token is read from the {ACCESS_TOKEN_ENV} environment variable, and rejected Tasks are written next to the output file (<output>-rejected.csv).",  # noqa: E501
+    )
+    parser.add_argument(
+        "--sfdc-instance-url",
+        type=str,
+        default=os.environ.get(INSTANCE_URL_ENV),
+        help=f"URL of the Salesforce instance (e.g. https://mycompany.my.salesforce.com), defaults to the {INSTANCE_URL_ENV} environment variable.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--sfdc-api-version",
+        type=str,
+        default=BULK_API_VERSION,
+        help="Version of the Salesforce REST API",
+    )
+    parser.add_argument(
+        "--bulk-workers",
+        type=int,
+        default=DEFAULT_BULK_WORKERS,
+        help="Max number of Bulk API jobs run concurrently",
+    )
+    parser.add_argument(
+        "--bulk-batch-rows",
+        type=int,
+        default=DEFAULT_BULK_BATCH_ROWS,
+        help="Max number of Tasks uploaded by each Bulk API job",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and export again every --interval seconds, only when the date range or the calendar changed. Stops on SIGTERM.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DEFAULT_DAEMON_INTERVAL,
+        help="Seconds between two runs in daemon mode",
+    )
+    parser.add_argument(
+        "--status-file",
+        type=str,
+        help="JSON file receiving the status of the daemon, for health checks.",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        help="CSV manifest of exports to run concurrently, with sfdc_user_id, output and optional api_url and cache columns.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=DEFAULT_BATCH_WORKERS,
+        help="Max number of exports run concurrently in batch mode",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        help="Write the time, events, bytes and memory of each pipeline stage to this JSON file.",  # noqa: E501
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        type=str,
+        help="Write the same metrics to this Prometheus textfile.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="Write a cProfile dump of the export to this file.",
+    )
     parser.add_argument(
         "--verbose", "-v", action="store_true", default=False, help="Verbose mode"
     )
+    parser.add_argument(
+        "--debug-summary",
+        action="store_true",
+        help="In verbose mode, log the number of events included or excluded by reason instead of one line per event.",  # noqa: E501
+    )
 
     args = parser.parse_args()
 
@@ -548,73 +4750,229 @@ def main():
         logging.basicConfig(
             level=logging.INFO, style="{", format="{levelname:8} {message}"
         )
+    if args.debug_summary:
+        EVENT_LOGGER.setLevel(logging.INFO)
 
-    # Validate output file path, permissions and extension
-    if not os.path.exists(os.path.dirname(os.path.abspath(args.output))):
-        parser.error(
-            f"The file path '{os.path.dirname(os.path.abspath(args.output))}' does not exist to store {args.output} file."  # noqa: E501
-        )
-    if not os.access(os.path.dirname(os.path.abspath(args.output)), os.W_OK):
-        parser.error(
-            f"The file path '{os.path.dirname(os.path.abspath(args.output))}' is not writable to store {args.output} file."  # noqa: E501
-        )
-    if not args.output.endswith(".csv"):
-        parser.error(f"The file extension of {args.output} must be .csv")
+    def validate_output(output):
+        # Validate output file path, permissions and extension
+        if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+            parser.error(
+                f"The file path '{os.path.dirname(os.path.abspath(output))}' does not exist to store {output} file."  # noqa: E501
+            )
+        if not os.access(os.path.dirname(os.path.abspath(output)), os.W_OK):
+            parser.error(
+                f"The file path '{os.path.dirname(os.path.abspath(output))}' is not writable to store {output} file."  # noqa: E501
+            )
+        if not output.endswith(".csv"):
+            parser.error(f"The file extension of {output} must be .csv")
 
-    # Validate date range
-    if args.this_week:
-        start_date, end_date = this_week()
-    elif args.last_week:
-        start_date, end_date = last_week()
-    elif args.last_month:
-        start_date, end_date = last_month()
-    elif args.start and args.end:
-        if validate_date(args.start) and validate_date(args.end):
-            start_date = datetime.strptime(args.start, "%Y-%m-%d").replace(
-                tzinfo=tzlocal()
+    if args.batch:
+        if args.cache:
+            # A cache holds the events of a single calendar
+            parser.error("--cache can't be used with --batch, use the cache column")
+        try:
+            batch_entries = read_batch_manifest(args.batch)
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid batch manifest {args.batch}: {e}")
+        for entry in batch_entries:
+            validate_output(entry["output"])
+        if args.batch_workers < 1:
+            parser.error("--batch-workers must be at least 1")
+    elif not args.sfdc_user_id:
+        parser.error("the following arguments are required: --sfdc-user-id/-i")
+    else:
+        validate_output(args.output)
+    if args.fetch_workers < 1:
+        parser.error("--fetch-workers must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        parser.error("--connect-timeout and --read-timeout must be positive")
+    if args.retries < 0:
+        parser.error("--retries can't be negative")
+    if args.http_client == "requests":
+        from importlib.util import find_spec
+
+        if find_spec("requests") is None:
+            parser.error("--http-client requests needs requests to be installed")
+    classifier = CategoryClassifier.default()
+    if args.categories_config:
+        try:
+            classifier = CategoryClassifier.from_file(args.categories_config)
+        except (OSError, ValueError) as e:
+            parser.error(
+                f"Invalid categories configuration {args.categories_config}: {e}"
             )
-            end_date = datetime.strptime(args.end, "%Y-%m-%d").replace(
-                hour=23, minute=59, second=59, microsecond=0, tzinfo=tzlocal()
+    if args.sfdc_index or args.sfdc_index_db:
+        try:
+            index = SalesforceIndex.open(args.sfdc_index, args.sfdc_index_db)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            parser.error(f"Invalid Salesforce extract: {e}")
+        classifier = CategoryClassifier(classifier.subjects, classifier.prefixes, index)
+    if args.chunk_rows is not None and args.chunk_rows <= 0:
+        parser.error("--chunk-rows must be a positive number")
+    if args.bulk_upload:
+        if not args.sfdc_instance_url:
+            parser.error(
+                f"--bulk-upload requires --sfdc-instance-url or {INSTANCE_URL_ENV}"
             )
-            if start_date > end_date:
-                parser.error("Start date must be before end date")
-        else:
+        if not os.environ.get(ACCESS_TOKEN_ENV):
+            parser.error(f"--bulk-upload requires the {ACCESS_TOKEN_ENV} variable")
+        if args.chunk_rows or args.chunk_bytes or args.gzip:
+            parser.error(
+                "--bulk-upload can't be used with --chunk-rows/--chunk-bytes/--gzip"
+            )
+        if args.bulk_workers <= 0 or args.bulk_batch_rows <= 0:
+            parser.error(
+                "--bulk-workers and --bulk-batch-rows must be positive numbers"
+            )
+    if args.profile and (args.batch or args.daemon):
+        parser.error("--profile can't be used with --batch or --daemon")
+    if args.daemon and args.interval < 1:
+        parser.error("--interval must be at least 1")
+    if args.status_file and not args.daemon:
+        parser.error("--status-file requires --daemon")
+    if args.refresh and not (args.cache or args.batch):
+        parser.error("--refresh requires --cache or --batch")
+    if args.report and not args.report.endswith((".csv", ".json")):
+        parser.error(f"The file extension of {args.report} must be .csv or .json")
+    named_windows = {
+        "this-week": this_week,
+        "last-week": last_week,
+        "last-month": last_month,
+    }
+    window_names = []
+    if args.windows:
+        if args.batch:
+            parser.error("--windows can't be used with --batch")
+        if args.this_week or args.last_week or args.last_month:
             parser.error(
-                "Invalid date format for --start or --end, should be YYYY-MM-DD"
+                "--windows can't be used with --this-week, --last-week or --last-month"
             )
-    elif args.start or args.end:
-        parser.error("--start and --end should be used together")
+        if args.report:
+            parser.error("--windows can't be used with --report")
+        names = [name.strip() for name in args.windows.split(",") if name.strip()]
+        unknown = sorted(set(names) - set(named_windows))
+        if unknown or not names:
+            parser.error(
+                f"--windows must be a list of {', '.join(named_windows)}, "
+                f"got {args.windows}"
+            )
+        window_names = list(dict.fromkeys(names))
+
+    def window_ranges():
+        # The daemon computes the windows again at each run
+        stem = os.path.splitext(args.output)[0]
+        return [(*named_windows[name](), f"{stem}-{name}.csv") for name in window_names]
+
+    def date_range():
+        # Validate date range
+        if args.this_week:
+            return this_week()
+        elif args.last_week:
+            return last_week()
+        elif args.last_month:
+            return last_month()
+        elif args.start and args.end:
+            if validate_date(args.start) and validate_date(args.end):
+                start_date = datetime.strptime(args.start, "%Y-%m-%d").replace(
+                    tzinfo=LOCAL_TIMEZONE
+                )
+                end_date = datetime.strptime(args.end, "%Y-%m-%d").replace(
+                    hour=23, minute=59, second=59, microsecond=0, tzinfo=LOCAL_TIMEZONE
+                )
+                if start_date > end_date:
+                    parser.error("Start date must be before end date")
+                return start_date, end_date
+            else:
+                parser.error(
+                    "Invalid date format for --start or --end, should be YYYY-MM-DD"
+                )
+        elif args.start or args.end:
+            parser.error("--start and --end should be used together")
+        else:
+            return current_week()
+
+    windows = window_ranges()
+    if windows:
+        start_date = min(start for start, _, _ in windows)
+        end_date = max(end for _, end, _ in windows)
     else:
-        start_date, end_date = current_week()
+        start_date, end_date = date_range()
+    if args.daemon:
+        entries = (
+            batch_entries
+            if args.batch
+            else [
+                {
+                    "sfdc_user_id": args.sfdc_user_id,
+                    "api_url": args.api_url,
+                    "output": args.output,
+                    "cache": args.cache,
+                }
+            ]
+        )
+        run_daemon(
+            args,
+            entries,
+            date_range,
+            classifier,
+            window_ranges if window_names else None,
+        )
+        return
 
     logging.info("Start date: %s, End date: %s", start_date, end_date)
-    # Fetch events from Exchange API
-    events = fetch_data(args.api_url + "/events")
-    if events is not None:
-        valid_events = validate_events_timing(events, start_date, end_date)
-        if valid_events:
-            logging.info(
-                "%d events are within the date range on %d events collected",
-                len(valid_events),
-                len(events),
-            )
-            matching_events = [
-                EventEntry(
-                    args.max_hours_by_day, args.morning_hour, args.evening_hour, **event
+    reports = [] if args.metrics_json or args.metrics_prom else None
+    if args.batch:
+        failures = run_batch(
+            args, batch_entries, start_date, end_date, classifier, reports
+        )
+    else:
+        failures = None
+        metrics = PipelineMetrics(args.sfdc_user_id) if reports is not None else None
+        report = TimeReport() if args.report else None
+        profiler = cProfile.Profile() if args.profile else None
+        try:
+            if profiler:
+                profiler.enable()
+            with HttpClient.from_args(
+                args, args.fetch_workers + args.bulk_workers
+            ) as client:
+                export_events(
+                    args,
+                    args.sfdc_user_id,
+                    args.api_url,
+                    args.output,
+                    start_date,
+                    end_date,
+                    client,
+                    cache_path=args.cache,
+                    classifier=classifier,
+                    metrics=metrics,
+                    windows=windows,
+                    report=report,
                 )
-                for event in valid_events
-            ]
-            filtered_events = (
-                filter_events(matching_events)
-                if not args.export_all
-                else matching_events
-            )
-            # Write events to CSV file
-            write_events_to_csv(
-                args.sfdc_user_id, filtered_events, args.output, args.max_hours_by_day
-            )
-        else:
-            logging.info("No events are within the date range")
+            if report is not None:
+                report.write(args.report)
+        except (*request_errors(), json.JSONDecodeError) as e:
+            logging.error("Failed to retrieve JSON from %s: %s", args.api_url, str(e))
+        except sqlite3.Error as e:
+            logging.error("Failed to use event cache or export manifest: %s", str(e))
+        except BulkUploadError as e:
+            logging.error("Failed to upload Tasks to Salesforce: %s", str(e))
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                logging.info("Profile written to %s", args.profile)
+        if metrics:
+            reports.append(metrics.report())
+    for filename, prometheus in ((args.metrics_json, False), (args.metrics_prom, True)):
+        if filename:
+            write_metrics(filename, reports, prometheus)
+            logging.info("Metrics written to %s", filename)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":